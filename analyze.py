@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# analyze.py (Piranha's TFTP trace analyzer) 0.1
+#
+# Copyright (C) 2024 Erick Mattos <erick.mattos@gmail.com>
+#
+# This is the packet trace analyzer of Piranha software.
+#
+# Piranha is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Piranha is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# On Debian systems, the complete text of the GNU General
+# Public License can be found in `/usr/share/common-licenses/GPL-3'.
+
+import argparse
+import json
+import statistics
+import sys
+import tftp
+
+TIMELINE_BIN = 1.0      # segs of each interval of the timeline
+IDLE_MIN     = 0.01     # segs without packets taken as idle, at least...
+IDLE_FACTOR  = 10       # ...and times the median gap between packets
+IDLE_SHOWN   = 10       # longest idle gaps reported
+HISTOGRAM_MS = [ 2**intExp for intExp in range( -3, 14 ) ]   # upper bounds of the RTT buckets
+
+def load( path: str ) -> list[tuple[dict, list[dict]]]:
+    """
+    This method reads a trace written by tftp.PacketTrace and returns
+    its transfers, each as its description and its packets in order.
+    """
+    dicTransfers = {}
+    for dicRecord in tftp.read_trace( path ):
+        if dicRecord["dir"] == tftp.TRACE_META:
+            dicTransfers[dicRecord["id"]] = ( dicRecord["meta"], [] )
+        elif dicRecord["id"] in dicTransfers:
+            dicTransfers[dicRecord["id"]][1].append( dicRecord )
+    return list( dicTransfers.values() )
+
+def unwrap( block: int, reference: int ) -> int:
+    """
+    This method maps a block number on the wire to the block counted
+    past the rollovers that is the nearest to 'reference'.
+    """
+    intBlock = reference - ( reference & tftp.MAX_BLOCK_NUMBER ) + block
+    if intBlock > reference + tftp.MAX_BLOCK_NUMBER // 2:
+        intBlock -= tftp.MAX_BLOCK_NUMBER + 1
+    elif intBlock < reference - tftp.MAX_BLOCK_NUMBER // 2:
+        intBlock += tftp.MAX_BLOCK_NUMBER + 1
+    return intBlock
+
+def analyze( meta: dict, packets: list[dict], bin_size: float = TIMELINE_BIN,
+             idle_min: float = IDLE_MIN ) -> dict:
+    """
+    This method works out the performance of a transfer from its packets:
+    - throughput, counting every byte of data once, however many times
+      it was sent;
+    - round trips, from a packet sent to the answer to it, skipping those
+      sent more than once (Karn's algorithm): the DAT whose ACK came back
+      in a put, the ACK that brought the next DAT in a get;
+    - retransmissions and duplicates of data and ACKs, over time;
+    - where the time went: gaps ending in a packet sent were spent here
+      (disk, CPU or pacing), gaps ending in a packet received waiting on
+      the other side (network or server);
+    - the idle gaps, longer than IDLE_FACTOR times the median gap.
+    """
+    intDataDir = tftp.TRACE_OUT if meta["mode"] == "put" else tftp.TRACE_IN
+    dicResult = { "id": meta["id"], "mode": meta["mode"], "name": meta["name"], "peer": meta["peer"],
+                  "bin": bin_size, "packets": len( packets ), "bytes": 0, "blocks": 0, "duration": 0.0,
+                  "throughput": 0.0, "data_retransmits": 0, "ack_retransmits": 0, "errors": [] }
+    if not packets:
+        return dicResult
+    floStart = meta["clock"]
+    floEnd = packets[-1]["t"]
+    intHigh = 0
+    dicDataSent = {}     # block => times the DAT was seen
+    dicAckSent = {}      # block => times the ACK was seen
+    lstTimeline = []
+    lstRTT = []
+    floLocal = floRemote = 0.0
+    lstGaps = []
+    floSetup = None
+    floLast = floStart
+    for dicPacket in packets:
+        floNow = dicPacket["t"]
+        intBin = int( ( floNow - floStart ) / bin_size )
+        while len( lstTimeline ) <= intBin:
+            lstTimeline.append( { "t": round( len( lstTimeline ) * bin_size, 6 ), "packets": 0, "bytes": 0,
+                                  "retransmits": 0 } )
+        dicBin = lstTimeline[intBin]
+        dicBin["packets"] += 1
+        floGap = floNow - floLast
+        if dicPacket["dir"] == tftp.TRACE_OUT:
+            floLocal += floGap
+            lstGaps.append( ( floGap, floLast - floStart, "local" ) )
+        else:
+            floRemote += floGap
+            lstGaps.append( ( floGap, floLast - floStart, "remote" ) )
+            if floSetup is None:
+                floSetup = floNow - floStart
+        floLast = floNow
+        intOpcode = dicPacket["op"]
+        if intOpcode == tftp.DAT and dicPacket["dir"] == intDataDir:
+            intBlock = unwrap( dicPacket["block"], intHigh )
+            intHigh = max( intHigh, intBlock )
+            lstTimes = dicDataSent.setdefault( intBlock, [] )
+            lstTimes.append( floNow )
+            if len( lstTimes ) == 1:
+                dicResult["bytes"] += dicPacket["len"] - 4
+                dicResult["blocks"] += 1
+                dicBin["bytes"] += dicPacket["len"] - 4
+                if intDataDir == tftp.TRACE_IN:
+                    # The answer to the ACK of the block before it.
+                    lstAcks = dicAckSent.get( intBlock - 1, [] )
+                    if len( lstAcks ) == 1 and lstAcks[0] <= floNow:
+                        lstRTT.append( floNow - lstAcks[0] )
+            else:
+                dicResult["data_retransmits"] += 1
+                dicBin["retransmits"] += 1
+        elif intOpcode == tftp.ACK:
+            intBlock = unwrap( dicPacket["block"], intHigh )
+            lstTimes = dicAckSent.setdefault( intBlock, [] )
+            lstTimes.append( floNow )
+            if len( lstTimes ) > 1:
+                dicResult["ack_retransmits"] += 1
+                dicBin["retransmits"] += 1
+            elif intDataDir == tftp.TRACE_OUT and dicPacket["dir"] == tftp.TRACE_IN:
+                lstSent = dicDataSent.get( intBlock, [] )
+                if len( lstSent ) == 1:
+                    lstRTT.append( floNow - lstSent[0] )
+        elif intOpcode == tftp.ERR:
+            dicResult["errors"].append( { "t": round( floNow - floStart, 6 ), "code": dicPacket["block"],
+                                          "sent": dicPacket["dir"] == tftp.TRACE_OUT } )
+    floDuration = floEnd - floStart
+    dicResult["duration"] = round( floDuration, 6 )
+    if floDuration > 0:
+        dicResult["throughput"] = round( dicResult["bytes"] / floDuration, 1 )
+    dicResult["setup"] = None if floSetup is None else round( floSetup, 6 )
+    dicResult["rtt"] = rtt_summary( lstRTT )
+    dicResult["time"] = { "local": round( floLocal, 6 ), "remote": round( floRemote, 6 ),
+                          "local_share": round( floLocal / ( floLocal + floRemote ), 3 )
+                                         if floLocal + floRemote else 0.0 }
+    floThreshold = max( IDLE_FACTOR * statistics.median( floGap for floGap, _, _ in lstGaps ), idle_min )
+    lstIdle = sorted( ( dicGap for dicGap in lstGaps if dicGap[0] >= floThreshold ), reverse=True )
+    dicResult["idle"] = {
+        "threshold": round( floThreshold, 6 ),
+        "total": round( sum( floGap for floGap, _, _ in lstIdle ), 6 ),
+        "local": round( sum( floGap for floGap, _, strSide in lstIdle if strSide == "local" ), 6 ),
+        "gaps": [ { "at": round( floAt, 6 ), "length": round( floGap, 6 ), "waiting": strSide }
+                  for floGap, floAt, strSide in lstIdle[:IDLE_SHOWN] ] }
+    dicResult["timeline"] = lstTimeline
+    return dicResult
+
+def rtt_summary( samples: list[float] ) -> dict:
+    """
+    This method summarizes the round trips measured: count, percentiles
+    and a histogram in milliseconds, each bucket up to twice the last.
+    """
+    if not samples:
+        return { "samples": 0 }
+    lstSorted = sorted( samples )
+    def percentile( percent: float ) -> float:
+        return round( lstSorted[min( int( len( lstSorted ) * percent / 100 ), len( lstSorted ) - 1 )], 6 )
+    lstHistogram = [ 0 ] * ( len( HISTOGRAM_MS ) + 1 )
+    for floRTT in samples:
+        intBucket = 0
+        while intBucket < len( HISTOGRAM_MS ) and floRTT * 1000 > HISTOGRAM_MS[intBucket]:
+            intBucket += 1
+        lstHistogram[intBucket] += 1
+    return { "samples": len( samples ), "min": round( lstSorted[0], 6 ), "p50": percentile( 50 ),
+             "p90": percentile( 90 ), "p99": percentile( 99 ), "max": round( lstSorted[-1], 6 ),
+             "histogram": [ { "ms": HISTOGRAM_MS[intBucket] if intBucket < len( HISTOGRAM_MS ) else None,
+                              "count": intCount }
+                            for intBucket, intCount in enumerate( lstHistogram ) if intCount ] }
+
+def report( result: dict ) -> str:
+    """
+    This method writes the analysis of a transfer for a human to read.
+    """
+    lstLines = [ f"Transfer {result['id']}: {result['mode']} '{result['name']}' with {result['peer']}" ]
+    lstLines.append( f"  {result['bytes']} bytes in {result['blocks']} blocks, {result['duration']:.3f} s, "
+                     f"{tftp.format_rate( result['throughput'] )}" )
+    if result["packets"] == 0:
+        return "\n".join( lstLines )
+    if result["setup"] is not None:
+        lstLines.append( f"  first answer after {result['setup'] * 1000:.1f} ms" )
+    lstLines.append( f"  retransmissions: {result['data_retransmits']} DAT, {result['ack_retransmits']} ACK" )
+    dicRTT = result["rtt"]
+    if dicRTT["samples"]:
+        lstLines.append( f"  round trips: {dicRTT['samples']} samples, min {dicRTT['min'] * 1000:.2f} ms, "
+                         f"p50 {dicRTT['p50'] * 1000:.2f} ms, p90 {dicRTT['p90'] * 1000:.2f} ms, "
+                         f"p99 {dicRTT['p99'] * 1000:.2f} ms, max {dicRTT['max'] * 1000:.2f} ms" )
+        intMost = max( dicBucket["count"] for dicBucket in dicRTT["histogram"] )
+        for dicBucket in dicRTT["histogram"]:
+            strBound = f"<= {dicBucket['ms']:g} ms" if dicBucket["ms"] is not None else "longer"
+            lstLines.append( f"    {strBound:>14} {dicBucket['count']:>8} "
+                             f"{'#' * max( 1, round( 40 * dicBucket['count'] / intMost ) )}" )
+    dicTime = result["time"]
+    lstLines.append( f"  time here (disk, CPU, pacing): {dicTime['local']:.3f} s, "
+                     f"waiting on the other side (network, server): {dicTime['remote']:.3f} s" )
+    dicIdle = result["idle"]
+    if dicIdle["gaps"]:
+        lstLines.append( f"  idle gaps over {dicIdle['threshold'] * 1000:.1f} ms: {dicIdle['total']:.3f} s, "
+                         f"{dicIdle['local']:.3f} s of them here" )
+        for dicGap in dicIdle["gaps"]:
+            lstLines.append( f"    at {dicGap['at']:9.3f} s {dicGap['length'] * 1000:9.1f} ms waiting on "
+                             f"{'us' if dicGap['waiting'] == 'local' else 'the other side'}" )
+    for dicError in result["errors"]:
+        lstLines.append( f"  error {dicError['code']} {'sent' if dicError['sent'] else 'received'} "
+                         f"at {dicError['t']:.3f} s" )
+    lstLines.append( "  timeline:" )
+    for dicBin in result["timeline"]:
+        lstLines.append( f"    {dicBin['t']:9.1f} s {tftp.format_rate( dicBin['bytes'] / result['bin'] ):>12} "
+                         f"{dicBin['packets']:>8} packets {dicBin['retransmits']:>6} retransmitted" )
+    return "\n".join( lstLines )
+
+if __name__ == '__main__':
+
+    parse = argparse.ArgumentParser(
+        prog="analyze.py",
+        description="Análise dos traços de pacotes do Piranha (client.py --trace).",
+        epilog="Copyright (C) 2024 Erick Mattos <erick.mattos@gmail.com>" )
+    parse.add_argument( "-t", "--transfer", type=int, action="append",
+                        help="Transferência a analisar (por omissão, todas)." )
+    parse.add_argument( "--idle", default=IDLE_MIN, type=float,
+                        help="Segundos sem pacotes contados como pausa, no mínimo." )
+    parse.add_argument( "--json", action="store_true", help="Resultados em JSON." )
+    parse.add_argument( "TRACE", help="Arquivo do traço." )
+    args = parse.parse_args()
+
+    try:
+        lstTransfers = load( args.TRACE )
+    except ( OSError, ValueError ) as e:
+        print( e )
+        sys.exit(1)
+    lstResults = [ analyze( dicMeta, lstPackets, TIMELINE_BIN, args.idle ) for dicMeta, lstPackets in lstTransfers
+                   if not args.transfer or dicMeta["id"] in args.transfer ]
+    if args.json:
+        print( json.dumps( lstResults, indent=2 ) )
+    else:
+        print( "\n\n".join( report( dicResult ) for dicResult in lstResults ) )
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# bench.py (Piranha's TFTP benchmarks) 0.1
+#
+# Copyright (C) 2024 Erick Mattos <erick.mattos@gmail.com>
+#
+# These are the benchmarks of Piranha software.
+#
+# Piranha is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Piranha is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# On Debian systems, the complete text of the GNU General
+# Public License can be found in `/usr/share/common-licenses/GPL-3'.
+
+import argparse
+import heapq
+import io
+import json
+import os
+import random
+import selectors
+import socket
+import statistics
+import struct
+import tempfile
+import threading
+import time
+import server
+import tftp
+
+BENCH_SECONDS   = 1.0           # segs spent on each microbenchmark
+REORDER_DELAY   = 0.001         # segs a reordered datagram is held back, at least
+SWEEP_SIZES     = "1K,1M,32M,1G"
+SWEEP_BLKSIZES  = "512,1428,8192"
+SWEEP_LOSSES    = "0,0.01"
+SWEEP_RUNS      = 3
+UNITS           = { "K": 2**10, "M": 2**20, "G": 2**30 }
+
+def measure( step, seconds: float = BENCH_SECONDS ) -> float:
+    """
+    This method calls 'step' over and over for about 'seconds' and
+    returns how many calls per second it made.
+    """
+    intCalls = 0
+    intBatch = 1000
+    floStart = time.perf_counter()
+    floEnd = floStart + seconds
+    while True:
+        for _ in range( intBatch ):
+            step()
+        intCalls += intBatch
+        floNow = time.perf_counter()
+        if floNow >= floEnd:
+            return intCalls / ( floNow - floStart )
+
+def bench_datapath( blksize: int, seconds: float ) -> dict[str, float]:
+    """
+    This method measures, in packets per second, the per-block work of
+    the transfer loops: the way it used to be done (a format string and
+    a copy per packet, the opcode unpacked twice and a fresh 8 KB buffer
+    per datagram) against the zero-copy path they take now.
+    """
+    binPayload = bytes( blksize )
+    fileIn = io.BytesIO( binPayload * 4 )
+    fileOut = io.BytesIO()
+    binPacket = tftp.pack_dat( 1, binPayload, blksize )
+    viewSlot = memoryview( bytearray( blksize + 4 ) )
+    header = struct.Struct( "!HH" )
+
+    def old_send():
+        fileIn.seek( 0 )
+        data = fileIn.read( blksize )
+        struct.pack( f"!HH{len( data )}s", tftp.DAT, 1, data )
+
+    def new_send():
+        fileIn.seek( 0 )
+        header.pack_into( viewSlot, 0, tftp.DAT, 1 )
+        fileIn.readinto( viewSlot[4:] )
+
+    def old_receive():
+        fileOut.seek( 0 )
+        if tftp.unpack_opcode( binPacket ) == tftp.DAT:
+            tftp.unpack_opcode( binPacket )
+            opcode, block = struct.unpack( "!HH", binPacket[:4] )
+            fileOut.write( binPacket[4:] )
+
+    viewPacket = memoryview( binPacket )
+    def new_receive():
+        fileOut.seek( 0 )
+        opcode, block = header.unpack_from( viewPacket )
+        if opcode == tftp.DAT:
+            fileOut.write( viewPacket[4:] )
+
+    return {
+        "send_before": measure( old_send, seconds ),
+        "send_after": measure( new_send, seconds ),
+        "receive_before": measure( old_receive, seconds ),
+        "receive_after": measure( new_receive, seconds ),
+    } | bench_socket( blksize, seconds )
+
+def bench_socket( blksize: int, seconds: float ) -> dict[str, float]:
+    """
+    This method measures, in packets per second, reading DAT datagrams
+    from a loopback socket with recvfrom (a new buffer per datagram)
+    against recvfrom_into (one buffer reused for all of them).
+    """
+    receiver = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    receiver.bind( ( "127.0.0.1", 0 ) )
+    sender = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sender.connect( receiver.getsockname() )
+    binPacket = tftp.pack_dat( 1, bytes( blksize ), blksize )
+    viewBuffer = memoryview( bytearray( max( tftp.DEFAULT_BUFFER_SIZE, blksize + 4 ) ) )
+
+    def old_recv():
+        sender.send( binPacket )
+        receiver.recvfrom( max( tftp.DEFAULT_BUFFER_SIZE, blksize + 4 ) )
+
+    def new_recv():
+        sender.send( binPacket )
+        receiver.recvfrom_into( viewBuffer )
+
+    try:
+        return {
+            "socket_before": measure( old_recv, seconds ),
+            "socket_after": measure( new_recv, seconds ),
+        }
+    finally:
+        sender.close()
+        receiver.close()
+
+def bench_codec( blksize: int, seconds: float ) -> dict[str, float]:
+    """
+    This method measures, in calls per second, the packet codec of the
+    tftp module on DAT and ACK packets.
+    """
+    binPayload = bytes( blksize )
+    binDat = tftp.pack_dat( 1, binPayload, blksize )
+    binAck = tftp.pack_ack( 1 )
+    return {
+        "pack_dat": measure( lambda: tftp.pack_dat( 1, binPayload, blksize ), seconds ),
+        "unpack_dat": measure( lambda: tftp.unpack_dat( binDat ), seconds ),
+        "pack_ack": measure( lambda: tftp.pack_ack( 1 ), seconds ),
+        "unpack_opcode": measure( lambda: tftp.unpack_opcode( binAck ), seconds ),
+    }
+
+def bench_core( blksize: int, windowsize: int, seconds: float ) -> dict[str, float]:
+    """
+    This method measures, in blocks per second, the state machines of
+    the transfers alone: a tftp.Sender reading from memory against a
+    tftp.Receiver, run by a tftp.MemoryTransport, without and with loss.
+    Blocks of 8 bytes leave the copies out of it.
+    """
+    dicResults = {}
+    for strName, intBlkSize, floLoss in ( ( "blocks", 8, 0.0 ), ( "blocks_lossy", 8, 0.01 ),
+                                          ( "blocks_blksize", blksize, 0.0 ) ):
+        binData = bytes( intBlkSize * 100000 )
+        intBlocks = 0
+        floStart = time.perf_counter()
+        while time.perf_counter() - floStart < seconds:
+            fileIn = io.BytesIO( binData )
+            sender = tftp.Sender( tftp.RingSource( fileIn.readinto, intBlkSize, windowsize ),
+                                  intBlkSize, windowsize )
+            receiver = tftp.Receiver( intBlkSize, windowsize )
+            tftp.MemoryTransport( loss=floLoss, seed=intBlocks ).run( sender, receiver )
+            intBlocks += receiver.received
+        dicResults[strName] = intBlocks / ( time.perf_counter() - floStart )
+    return dicResults
+
+class Relay:
+    """
+    A UDP relay standing between the client and the server, emulating a
+    bad network: every datagram, in both directions, may be lost,
+    duplicated, delayed by 'latency' plus up to 'jitter' segs or held
+    back so that the ones behind it pass it. The client talks to its
+    'address', and each client port gets a socket of its own upstream,
+    following the server to the port of the transfer.
+    """
+
+    def __init__( self, upstream: tftp.INET4Address, latency: float = 0.0, jitter: float = 0.0,
+                  loss: float = 0.0, duplicate: float = 0.0, reorder: float = 0.0,
+                  seed: int | None = None ):
+        self.upstream = upstream
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.counters = { "forwarded": 0, "dropped": 0, "duplicated": 0, "reordered": 0 }
+        self.running = False
+        self._random = random.Random( seed )
+        self._queue = []        # heap of ( when, sequence, socket, datagram, address )
+        self._sequence = 0
+        self._routes = {}       # client address => [ upstream socket, server address ]
+        self.selector = selectors.DefaultSelector()
+        self.sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        self.sock.bind( ( "127.0.0.1", 0 ) )
+        self.sock.setblocking( False )
+        self.address = self.sock.getsockname()
+        self.selector.register( self.sock, selectors.EVENT_READ, None )
+        self._thread = threading.Thread( target=self.run, daemon=True )
+
+    def start( self ) -> "Relay":
+        self.running = True
+        self._thread.start()
+        return self
+
+    def stop( self ):
+        self.running = False
+        self._thread.join()
+        for sock, _ in self._routes.values():
+            sock.close()
+        self.selector.close()
+        self.sock.close()
+
+    def run( self ):
+        while self.running:
+            floWait = server.SELECT_INTERVAL
+            if self._queue:
+                floWait = min( floWait, max( 0.0, self._queue[0][0] - time.monotonic() ) )
+            for key, _ in self.selector.select( floWait ):
+                while True:
+                    try:
+                        binData, addr = key.fileobj.recvfrom( tftp.MAX_BLKSIZE + 4 )
+                    except ( BlockingIOError, InterruptedError, ConnectionRefusedError ):
+                        break
+                    if key.data is None:
+                        lstRoute = self._routes.get( addr )
+                        if lstRoute is None:
+                            sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+                            sock.bind( ( "127.0.0.1", 0 ) )
+                            sock.setblocking( False )
+                            self.selector.register( sock, selectors.EVENT_READ, addr )
+                            lstRoute = self._routes[addr] = [ sock, self.upstream ]
+                        self.impair( lstRoute[0], binData, lstRoute[1] )
+                    else:
+                        # The server answers from the port of the transfer.
+                        self._routes[key.data][1] = addr
+                        self.impair( self.sock, binData, key.data )
+            floNow = time.monotonic()
+            while self._queue and self._queue[0][0] <= floNow:
+                _, _, sock, binData, addr = heapq.heappop( self._queue )
+                self.forward( sock, binData, addr )
+
+    def impair( self, sock: socket.socket, data: bytes, addr: tftp.INET4Address ):
+        rand = self._random.random
+        if rand() < self.loss:
+            self.counters["dropped"] += 1
+            return
+        intCopies = 1
+        if rand() < self.duplicate:
+            self.counters["duplicated"] += 1
+            intCopies = 2
+        for _ in range( intCopies ):
+            floDelay = self.latency + self.jitter * rand()
+            if rand() < self.reorder:
+                self.counters["reordered"] += 1
+                floDelay += max( self.latency + self.jitter, REORDER_DELAY )
+            if floDelay <= 0:
+                self.forward( sock, data, addr )
+            else:
+                self._sequence += 1
+                heapq.heappush( self._queue, ( time.monotonic() + floDelay, self._sequence, sock, data, addr ) )
+
+    def forward( self, sock: socket.socket, data: bytes, addr: tftp.INET4Address ):
+        try:
+            sock.sendto( data, addr )
+            self.counters["forwarded"] += 1
+        except ( BlockingIOError, InterruptedError ):
+            self.counters["dropped"] += 1
+
+def bench_transfers( sizes: list[int], blksizes: list[int], losses: list[float], windowsize: int,
+                     runs: int, modes: list[str], latency: float = 0.0, jitter: float = 0.0,
+                     duplicate: float = 0.0, reorder: float = 0.0 ) -> list[dict]:
+    """
+    This method sweeps whole transfers through a Relay to an in-process
+    server, 'runs' times each combination of mode, file size, block size
+    and loss rate, and reports their throughput, transfer times and
+    retransmissions.
+    """
+    lstResults = []
+    with tempfile.TemporaryDirectory() as strRoot:
+        tftpd = server.Server( strRoot, "127.0.0.1", 0 )
+        threading.Thread( target=tftpd.serve_forever, daemon=True ).start()
+        try:
+            for intSize in sizes:
+                strName = f"{intSize}.bin"
+                strPath = os.path.join( strRoot, strName )
+                make_file( strPath, intSize )
+                for intBlkSize in blksizes:
+                    for floLoss in losses:
+                        for strMode in modes:
+                            dicRecord = { "mode": strMode, "size": intSize, "blksize": intBlkSize,
+                                          "windowsize": windowsize, "loss": floLoss }
+                            relay = Relay( tftpd.address, latency, jitter, floLoss, duplicate, reorder ).start()
+                            try:
+                                dicRecord |= bench_transfer( relay.address, strMode, strRoot, strPath,
+                                                             strName, intSize, intBlkSize, windowsize, runs )
+                            finally:
+                                relay.stop()
+                            dicRecord["relay"] = relay.counters
+                            lstResults.append( dicRecord )
+                os.remove( strPath )
+        finally:
+            tftpd.shutdown()
+    return lstResults
+
+def bench_transfer( address: tftp.INET4Address, mode: str, root: str, path: str, name: str,
+                    size: int, blksize: int, windowsize: int, runs: int ) -> dict:
+    lstTimes = []
+    intRetransmits = 0
+    intFailed = 0
+    strCopy = os.path.join( root, f"copy-{name}" )
+    for _ in range( runs ):
+        try:
+            if mode == "get":
+                result = tftp.get_file( address[1], address[0], address[0], name, strCopy,
+                                        blksize, windowsize, verbose=False )
+            else:
+                result = tftp.put_file( address[1], address[0], address[0], path, f"copy-{name}",
+                                        blksize, windowsize, verbose=False )
+        except ( OSError, ValueError ):
+            intFailed += 1
+            continue
+        lstTimes.append( result.elapsed )
+        intRetransmits += result.retransmits
+    if os.path.exists( strCopy ):
+        os.remove( strCopy )
+    dicResult = { "runs": runs, "failed": intFailed, "retransmits": intRetransmits }
+    if lstTimes:
+        floP50 = percentile( lstTimes, 50 )
+        dicResult |= { "throughput": size / floP50 if floP50 else None,
+                       "p50": floP50, "p99": percentile( lstTimes, 99 ) }
+    return dicResult
+
+def percentile( values: list[float], percent: float ) -> float:
+    lstValues = sorted( values )
+    if len( lstValues ) == 1:
+        return lstValues[0]
+    return statistics.quantiles( lstValues, n=100, method="inclusive" )[percent - 1] \
+        if percent < 100 else lstValues[-1]
+
+def make_file( path: str, size: int ):
+    """
+    This method writes 'size' random bytes to 'path', a chunk at a time.
+    """
+    with open( path, "wb" ) as file:
+        intLeft = size
+        while intLeft:
+            intChunk = min( intLeft, 2**20 )
+            file.write( random.randbytes( intChunk ) )
+            intLeft -= intChunk
+
+def parse_size( size: str ) -> int:
+    size = size.strip().upper()
+    if size[-1:] in UNITS:
+        return int( float( size[:-1] ) * UNITS[size[-1]] )
+    return int( size )
+
+if __name__ == '__main__':
+
+    parse = argparse.ArgumentParser(
+        prog="bench.py",
+        description="Benchmarks do Piranha.",
+        epilog="Copyright (C) 2024 Erick Mattos <erick.mattos@gmail.com>" )
+    parse.add_argument( "-b", "--blksize", default=tftp.MAX_DATA_LEN, type=int,
+                        help="Tamanho dos blocos de dados." )
+    parse.add_argument( "-s", "--seconds", default=BENCH_SECONDS, type=float,
+                        help="Duração de cada medição." )
+    parse.add_argument( "-S", "--sizes", default=SWEEP_SIZES,
+                        help="Tamanhos dos arquivos transferidos (ex.: 1K,1M,1G)." )
+    parse.add_argument( "-B", "--blksizes", default=SWEEP_BLKSIZES,
+                        help="Tamanhos dos blocos a testar nas transferências." )
+    parse.add_argument( "-l", "--losses", default=SWEEP_LOSSES,
+                        help="Taxas de perda de pacotes a testar (ex.: 0,0.01)." )
+    parse.add_argument( "-w", "--windowsize", default=tftp.DEFAULT_WINDOWSIZE, type=int,
+                        help="Número de blocos enviados antes de cada ACK." )
+    parse.add_argument( "-r", "--runs", default=SWEEP_RUNS, type=int,
+                        help="Repetições de cada transferência." )
+    parse.add_argument( "-m", "--modes", default="get,put", help="Transferências a testar." )
+    parse.add_argument( "--latency", default=0.0, type=float, help="Latência da rede, em segundos." )
+    parse.add_argument( "--jitter", default=0.0, type=float, help="Variação da latência, em segundos." )
+    parse.add_argument( "--duplicate", default=0.0, type=float, help="Taxa de pacotes duplicados." )
+    parse.add_argument( "--reorder", default=0.0, type=float, help="Taxa de pacotes fora de ordem." )
+    parse.add_argument( "-o", "--output", help="Arquivo JSON para os resultados." )
+    parse.add_argument( "SUITE", nargs="?", default="micro", choices=[ "micro", "sweep", "all" ],
+                        help="micro: codec, caminho dos dados e máquinas de estado; sweep: transferências pela rede emulada." )
+    args = parse.parse_args()
+
+    dicResults = {}
+    if args.SUITE in ( "micro", "all" ):
+        dicResults["codec"] = { name: round( value ) for name, value
+                                in bench_codec( args.blksize, args.seconds ).items() }
+        dicResults["datapath"] = { name: round( value ) for name, value
+                                   in bench_datapath( args.blksize, args.seconds ).items() }
+        dicResults["core"] = { name: round( value ) for name, value
+                               in bench_core( args.blksize, args.windowsize, args.seconds ).items() }
+    if args.SUITE in ( "sweep", "all" ):
+        dicResults["transfers"] = bench_transfers(
+            [ parse_size( size ) for size in args.sizes.split( "," ) ],
+            [ int( blksize ) for blksize in args.blksizes.split( "," ) ],
+            [ float( loss ) for loss in args.losses.split( "," ) ],
+            args.windowsize, args.runs, args.modes.split( "," ),
+            args.latency, args.jitter, args.duplicate, args.reorder )
+    strResults = json.dumps( dicResults, indent=2 )
+    if args.output:
+        with open( args.output, "wt" ) as file:
+            file.write( strResults + "\n" )
+    print( strResults )
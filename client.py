@@ -19,17 +19,54 @@
 # Public License can be found in `/usr/share/common-licenses/GPL-3'.
 
 import argparse
+import asyncio
+import atexit
+import concurrent.futures
+import fnmatch
+import glob
+import io
+import json
 import os
 import sys
+import threading
+import time
 import tftp
 
-def interactive_mode(port: int, server: str, serverip: str):
+BATCH_JOBS       = 16    # transfers at once in batch mode
+BATCH_PER_SERVER = 4     # transfers at once with each server
+BATCH_RETRIES    = 2     # further attempts of a failed transfer
+BATCH_BACKOFF    = 1.0   # segs before the first retry, doubled each time
+SYNC_STATE       = ".tftpsync.json"   # state of a synced directory, kept in it
+SYNC_PARTIAL     = ".part"            # suffix of a file still being synced
+
+def interactive_mode(port: int, server: str, serverip: str, blksize: int | None = None,
+                     windowsize: int = tftp.DEFAULT_WINDOWSIZE,
+                     metrics: tftp.MetricsExporter | None = None,
+                     serverips: list[str] | None = None, mode: str = tftp.DEFAULT_MODE,
+                     jobs: int = BATCH_PER_SERVER):
     """
-    This is the interactive interface.
+    This is the interactive interface. Transfers put in the background
+    ('-b', mget, mput) run at most 'jobs' at a time (see JobQueue), and
+    the sockets of the transfers are kept open for the next ones.
     """
+    if tftp.endpoints is None:
+        tftp.endpoints = tftp.EndpointPool()
+    queue = None
+    bolWarned = False
     strCommand = ""
     while strCommand != "quit":
+        if queue is not None:
+            for strLine in queue.notices():
+                print( strLine )
         strCommand = input( "tftp client> " )
+        if not strCommand.split():
+            continue
+        lstArgs = strCommand.split()[1:]
+        bolBackground = "-b" in lstArgs
+        lstArgs = [ strArg for strArg in lstArgs if strArg != "-b" ]
+        if bolBackground or strCommand.split()[0] in ( "mget", "mput" ):
+            if queue is None:
+                queue = JobQueue( port, server, serverip, serverips, blksize, windowsize, metrics, jobs )
         # Estou usando o servidor de TFTP para Windows Tftpd64, que
         # gera automaticamente um arquivo 'dir.txt' com o conteúdo do
         # diretório em 3 colunas: nome, data e tamanho.  Caso fosse
@@ -37,82 +74,759 @@ def interactive_mode(port: int, server: str, serverip: str):
         # arquivo o resultado de um 'ls -Alh', no sistema Linux,
         # ou um 'dir' correspondente no Windows.
         if strCommand == "dir":
-            receive( port, server, serverip, "dir.txt", ".dir.txt" )
-            with open( ".dir.txt", "rt") as file:
-                for line in file.readlines(): 
-                    if line.split()[0] == "dir.txt":
-                        continue
-                    print( f"{line.split()[0]:<20} {line.split()[1]:<20} {line.split()[2]:>20}" )
-                print()
             try:
-                os.remove( os.path.join( os.getcwd(), ".dir.txt" ) )
-            except Exception:
-                # keep quit! Not important if the file is kept.
-                pass
+                lstListing = listing( port, server, serverip, blksize, windowsize, metrics, serverips )
+            except Exception as e:
+                print( e )
+                print()
+                continue
+            for lstFields in lstListing:
+                print( f"{lstFields[0]:<20} {lstFields[1]:<20} {lstFields[2]:>20}" )
+            print()
         elif strCommand.split()[0] == "get":
-            if len( strCommand.split() ) > 1:
-                origin      = strCommand.split()[1] 
-                if len( strCommand.split() ) > 2:
-                    destination = strCommand.split()[2] 
+            if len( lstArgs ) > 0:
+                origin      = lstArgs[0]
+                if len( lstArgs ) > 1:
+                    destination = lstArgs[1]
                 else:
-                    destination = origin
+                    destination = os.path.split( origin )[1]
             else:
-                print( "Usage: get remotefile [localfile]\n" )
+                print( "Usage: get [-b] remotefile [localfile]\n" )
+                continue
+            if bolBackground:
+                print( f"[{queue.submit( 'get', origin, destination, mode )}] get {origin}\n" )
                 continue
             try:
-                receive( port, server, serverip, origin, destination )
+                receive( port, server, serverip, origin, destination, blksize, windowsize, metrics,
+                         serverips=serverips, mode=mode )
             except Exception as e:
                 print( e )
                 print()
         elif strCommand.split()[0] == "put":
-            if len( strCommand.split() ) > 1:
-                origin          = strCommand.split()[1] 
-                if len( strCommand.split() ) > 2:
-                    destination = strCommand.split()[2] 
+            if len( lstArgs ) > 0:
+                origin          = lstArgs[0]
+                if len( lstArgs ) > 1:
+                    destination = lstArgs[1]
                 else:
-                    destination = origin
+                    destination = os.path.split( origin )[1]
             else:
-                print( "Usage: put localfile [remotefile]" )
+                print( "Usage: put [-b] localfile [remotefile]" )
                 continue
             if os.path.isfile( origin ) == False:
                 print( f"File '{origin}' not found.\n" )
+            elif bolBackground:
+                print( f"[{queue.submit( 'put', origin, destination, mode )}] put {origin}\n" )
             else:
                 try:
-                    send( port, server, serverip, origin, destination )
+                    send( port, server, serverip, origin, destination, blksize, windowsize, metrics,
+                          serverips, mode )
                 except Exception as e:
                     print( e )
                     print()
+        elif strCommand.split()[0] == "mget":
+            if not lstArgs:
+                print( "Usage: mget pattern...\n" )
+                continue
+            try:
+                lstListing = listing( port, server, serverip, blksize, windowsize, metrics, serverips )
+            except Exception as e:
+                print( e )
+                print()
+                continue
+            lstNames = [ lstFields[0] for lstFields in lstListing
+                         if lstFields[0] != tftp.DIR_LISTING
+                         and any( fnmatch.fnmatchcase( lstFields[0], strPattern ) for strPattern in lstArgs ) ]
+            for strName in lstNames:
+                print( f"[{queue.submit( 'get', strName, os.path.split( strName )[1], mode )}] get {strName}" )
+            print( f"{len( lstNames )} files queued.\n" )
+        elif strCommand.split()[0] == "mput":
+            if not lstArgs:
+                print( "Usage: mput pattern...\n" )
+                continue
+            lstNames = [ strName for strPattern in lstArgs for strName in sorted( glob.glob( strPattern ) )
+                         if os.path.isfile( strName ) ]
+            for strName in lstNames:
+                print( f"[{queue.submit( 'put', strName, os.path.split( strName )[1], mode )}] put {strName}" )
+            print( f"{len( lstNames )} files queued.\n" )
+        elif strCommand.split()[0] in ( "jobs", "wait", "cancel" ):
+            if queue is None or not queue.jobs:
+                print( "No jobs.\n" )
+                continue
+            try:
+                lstJobs = [ int( strArg.lstrip( "%" ) ) for strArg in lstArgs if strArg != "all" ]
+            except ValueError:
+                print( f"Usage: {strCommand.split()[0]} [job...]\n" )
+                continue
+            lstUnknown = [ str( intJob ) for intJob in lstJobs if intJob not in queue.jobs ]
+            if lstUnknown:
+                print( f"No such job: {', '.join( lstUnknown )}.\n" )
+                continue
+            if strCommand.split()[0] == "jobs":
+                for dicJob in queue.jobs.values():
+                    if not lstJobs or dicJob["id"] in lstJobs:
+                        print( queue.describe( dicJob ) )
+                print( queue.status() )
+            elif strCommand.split()[0] == "wait":
+                if not queue.wait( lstJobs or None ):
+                    print( "Stopped waiting: the jobs go on." )
+                for strLine in queue.notices():
+                    print( strLine )
+            elif not lstArgs:
+                print( "Usage: cancel job... | all\n" )
+                continue
+            else:
+                intCancelled = queue.cancel( None if "all" in lstArgs else lstJobs )
+                print( f"{intCancelled} jobs cancelled." )
+            print()
+        elif strCommand.split()[0] == "sync":
+            bolDryRun = "-n" in lstArgs
+            lstArgs = [ strArg for strArg in lstArgs if strArg != "-n" ]
+            if len( lstArgs ) > 2:
+                print( "Usage: sync [-n] [pattern] [local_dir]\n" )
+                continue
+            lstArgs += [ "*", "." ][len( lstArgs ):]
+            try:
+                dicSummary = sync_mode( port, server, serverips or [ serverip ], lstArgs[1], lstArgs[0],
+                                        blksize=blksize, windowsize=windowsize, metrics=metrics,
+                                        dry_run=bolDryRun )
+            except ( OSError, ValueError ) as e:
+                print( e )
+                print()
+                continue
+            if not bolDryRun:
+                print( f"{dicSummary['ok']} fetched, {dicSummary['failed']} failed, "
+                       f"{dicSummary['skipped']} unchanged." )
+            print()
+        elif strCommand in ( "ascii", "binary" ):
+            mode = tftp.NETASCII_MODE if strCommand == "ascii" else tftp.DEFAULT_MODE
+            print( f"Mode: {mode}.\n" )
         elif strCommand == "help":
             print( """Commands:
-  get remote_file [local_file] - get a file from server and save it as local_file
-  put local_file [remote_file] - send a file to server and store it as remote_file
-  dir                          - obtain a listing of remote files
-  quit                         - exit TFTP client
+  get [-b] remote_file [local_file] - get a file from server and save it as local_file
+  put [-b] local_file [remote_file] - send a file to server and store it as remote_file
+                                      ('-b' runs the transfer in the background)
+  mget pattern...                   - get in the background the remote files matching
+  mput pattern...                   - put in the background the local files matching
+  jobs [job...]                     - show the background transfers and their total rate
+  wait [job...]                     - wait for background transfers (Ctrl-C stops waiting)
+  cancel job... | all               - cancel background transfers
+  dir                               - obtain a listing of remote files
+  sync [-n] [pattern] [dir]         - fetch the remote files new or changed since the last
+                                      sync into dir ('-n' only shows what would be fetched)
+  ascii                             - transfer text files (netascii), with local line ends
+  binary                            - transfer files as they are (octet), the default
+  quit                              - exit TFTP client
 """ )
         elif strCommand == "quit":
-            pass
+            if queue is not None and queue.pending() and not bolWarned:
+                print( f"{len( queue.pending() )} jobs not ended: 'wait' for them, "
+                       f"or 'quit' again to cancel them.\n" )
+                bolWarned = True
+                strCommand = ""
         else:
             print( f"Unknown command: '{strCommand.split()[0]}'.\n" )
+    if queue is not None:
+        queue.close()
+    tftp.endpoints.close()
 #    print( f"tftp -p {port} {server}" )
 
-def receive( port: int, server: str, serverip: str, origin: str, destination: str ):
+def receive( port: int, server: str, serverip: str, origin: str, destination: str,
+             blksize: int | None = None, windowsize: int = tftp.DEFAULT_WINDOWSIZE,
+             metrics: tftp.MetricsExporter | None = None, multicast: bool = False,
+             serverips: list[str] | None = None, mode: str = tftp.DEFAULT_MODE,
+             digest: str | None = None, expected: str | None = None, sidecar: bool = False,
+             buffer: int = tftp.IO_BUFFER_SIZE, fsync: bool = False,
+             rate: float | None = None, compress: str | None = None ):
     """
-    This method prepares the get command.
+    This method prepares the get command. A destination '-' is stdout,
+    the progress then going to stderr. With 'sidecar' the file is checked
+    against the sha256 in the '.sha256' file next to it in the server.
+    'buffer', 'fsync', 'rate' and 'compress' are as in tftp.aget_file().
     """
+    if sidecar:
+        expected = dispatch( tftp.afetch_sidecar, port, server, serverip, serverips,
+                             origin + tftp.SIDECAR_SUFFIX, origin, blksize )
+        digest = "sha256"
+    if destination == "-":
+        result = dispatch( tftp.aget_stream, port, server, serverip, serverips, origin,
+                           origin, sys.stdout.buffer, blksize, windowsize,
+                           progress=reporter( True, metrics, sys.stderr ), mode=mode,
+                           digest=digest, expected=expected, rate=rate, compress=compress )
+        sys.stdout.flush()
+        report_compression( result, sys.stderr )
+        if result.digest:
+            print( f"{result.digest}  -", file=sys.stderr )
+        return
     if origin == destination:
         destination = os.path.split(destination)[1]
-    tftp.get_file( port, server, serverip, origin, destination )
+    if multicast:
+        if mode != tftp.DEFAULT_MODE or digest or expected:
+            raise tftp.TFTPValueError( "Multicast is only done in octet mode, without digests." )
+        dispatch( tftp.aget_multicast, port, server, serverip, serverips, origin,
+                  origin, destination, blksize, progress=reporter( True, metrics ) )
+        return
+    result = dispatch( tftp.aget_file, port, server, serverip, serverips, origin,
+                       origin, destination, blksize, windowsize, progress=reporter( True, metrics ),
+                       mode=mode, digest=digest, expected=expected, buffer=buffer, fsync=fsync,
+                       rate=rate, compress=compress )
+    if result.cached:
+        print( f"{destination} served from the cache." )
+    report_compression( result )
+    if result.digest:
+        print( f"{result.digest}  {destination}" )
 
-def send( port: int, server: str, serverip: str, origin: str, destination: str ):
+def send( port: int, server: str, serverip: str, origin: str, destination: str,
+          blksize: int | None = None, windowsize: int = tftp.DEFAULT_WINDOWSIZE,
+          metrics: tftp.MetricsExporter | None = None, serverips: list[str] | None = None,
+          mode: str = tftp.DEFAULT_MODE, digest: str | None = None,
+          expected: str | None = None, sidecar: bool = False,
+          buffer: int = tftp.IO_BUFFER_SIZE, rate: float | None = None, aimd: bool = False,
+          compress: str | None = None ):
     """
-    This method prepares the put command.
+    This method prepares the put command. An origin '-' is stdin. With
+    'sidecar' the sha256 of the file is stored in the server as well, in
+    a '.sha256' file next to it. 'buffer', 'rate', 'aimd' and 'compress'
+    are as in tftp.aput_file().
     """
-    if os.path.isfile( origin ) == False:
-        print( f"File {origin} not found.\n" )
-        sys.exit(1)
-    if origin == destination:
-        destination = os.path.split( destination )[1]
-    tftp.put_file( port, server, serverip, origin, destination )
+    if sidecar:
+        digest = "sha256"
+    if origin == "-":
+        result = dispatch( tftp.aput_stream, port, server, serverip, serverips, destination,
+                           sys.stdin.buffer, destination, blksize=blksize, windowsize=windowsize,
+                           progress=reporter( True, metrics, sys.stderr ), mode=mode,
+                           digest=digest, expected=expected, rate=rate, aimd=aimd,
+                           compress=compress )
+    else:
+        if os.path.isfile( origin ) == False:
+            print( f"File {origin} not found.\n" )
+            sys.exit(1)
+        if origin == destination:
+            destination = os.path.split( destination )[1]
+        result = dispatch( tftp.aput_file, port, server, serverip, serverips, destination,
+                           origin, destination, blksize, windowsize, progress=reporter( True, metrics ),
+                           mode=mode, digest=digest, expected=expected, buffer=buffer,
+                           rate=rate, aimd=aimd, compress=compress )
+    report_compression( result, sys.stderr if origin == "-" else sys.stdout )
+    if sidecar:
+        dispatch( tftp.aput_sidecar, port, server, serverip, serverips, destination + tftp.SIDECAR_SUFFIX,
+                  destination, result.digest, blksize )
+    if result.digest:
+        print( f"{result.digest}  {origin}", file=sys.stderr if origin == "-" else sys.stdout )
+
+def report_compression( result: tftp.TransferResult, file=sys.stdout ):
+    """
+    This method tells how much the compression of a transfer saved, if
+    the server took it.
+    """
+    if result.compression:
+        print( f"Compressed with {result.compression}: {result.size} bytes in {result.wire} "
+               f"on the wire, ratio {result.ratio:.2f}.", file=file )
+
+def dispatch( transfer, port: int, server: str, serverip: str, serverips: list[str] | None,
+              name: str, *args, **kwargs ) -> tftp.TransferResult:
+    """
+    This method runs the coroutine 'transfer' against serverip or, when
+    there are other addresses of the server or of its mirrors in
+    'serverips', against the first of them to answer (see failover()).
+    """
+    if serverips and len( serverips ) > 1:
+        return tftp.failover( transfer, port, server, serverips, name, *args, **kwargs )
+    return tftp.run( transfer( port, server, serverip, *args, **kwargs ) )
+
+def listing( port: int, server: str, serverip: str, blksize: int | None = None,
+             windowsize: int = tftp.DEFAULT_WINDOWSIZE,
+             metrics: tftp.MetricsExporter | None = None,
+             serverips: list[str] | None = None ) -> list[list[str]]:
+    """
+    This method fetches the listing of the files in the server, the
+    'dir.txt' that Tftpd64 (and server.py) generate, into memory and
+    returns its lines split in name, date and size.
+    """
+    fileListing = io.BytesIO()
+    # The listing is fetched quietly.
+    dispatch( tftp.aget_stream, port, server, serverip, serverips, tftp.DIR_LISTING,
+              tftp.DIR_LISTING, fileListing, blksize, windowsize, progress=metrics )
+    return tftp.parse_listing( fileListing.getvalue() )
+
+def read_sync_state( path: str ) -> dict:
+    """
+    This method reads the state of a synced directory: the server it
+    was synced from and, for each file fetched, the date and size it had
+    in the listing, the size and mtime it was left with and its digest,
+    if one was taken. A missing or unreadable state is an empty one.
+    """
+    try:
+        with open( path, "rt" ) as file:
+            dicState = json.load( file )
+    except ( OSError, ValueError ):
+        return { "server": None, "files": {} }
+    if not isinstance( dicState, dict ) or not isinstance( dicState.get( "files" ), dict ):
+        return { "server": None, "files": {} }
+    return dicState
+
+def write_sync_state( path: str, state: dict ):
+    """
+    This method writes the state of a synced directory, replacing the
+    previous one at once so that an interrupted sync leaves it whole.
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open( temporary, "wt" ) as file:
+            json.dump( state, file, indent=1, sort_keys=True )
+        os.replace( temporary, path )
+    except OSError:
+        if os.path.exists( temporary ):
+            os.remove( temporary )
+        raise
+
+def sync_plan( index: dict[str, tuple[str, str]], state: dict, directory: str,
+               pattern: str = "*" ) -> list[tuple[str, str]]:
+    """
+    This method compares the index of the listing with the state of the
+    directory and returns the files matching 'pattern' to be fetched,
+    with the reason: 'new' if never fetched, 'changed' if its date or
+    size in the server changed, 'missing' or 'modified' if the local
+    copy was removed or is no longer the one fetched: another size, or
+    another mtime and, when its digest was taken, another digest too.
+    Names that are not plain file names are never fetched.
+    """
+    lstPlan = []
+    for strName, ( strDate, strSize ) in index.items():
+        if os.path.basename( strName ) != strName or strName in ( ".", ".." ) \
+           or strName == SYNC_STATE or not fnmatch.fnmatchcase( strName, pattern ):
+            continue
+        dicFile = state["files"].get( strName )
+        if dicFile is None:
+            lstPlan.append( ( strName, "new" ) )
+            continue
+        if ( dicFile.get( "date" ), dicFile.get( "size" ) ) != ( strDate, strSize ):
+            lstPlan.append( ( strName, "changed" ) )
+            continue
+        try:
+            stat = os.stat( os.path.join( directory, strName ) )
+        except FileNotFoundError:
+            lstPlan.append( ( strName, "missing" ) )
+            continue
+        if stat.st_size != dicFile.get( "length" ):
+            lstPlan.append( ( strName, "modified" ) )
+        elif stat.st_mtime_ns != dicFile.get( "mtime" ):
+            # Only touched, or copied back, it is still the copy fetched
+            # if its digest says so.
+            strDigest = dicFile.get( "digest" )
+            try:
+                bolSame = bool( strDigest ) and local_digest( os.path.join( directory, strName ),
+                                                              tftp.digest_of( strDigest ) ) == strDigest
+            except ( OSError, ValueError ):
+                bolSame = False
+            if not bolSame:
+                lstPlan.append( ( strName, "modified" ) )
+    return lstPlan
+
+def local_digest( path: str, name: str ) -> str:
+    """
+    This method returns the digest 'name' (one of tftp.DIGESTS) of a
+    local file, read tftp.IO_CHUNK_SIZE bytes at a time.
+    """
+    hasher = tftp.new_digest( name )
+    with open( path, "rb" ) as file:
+        while binChunk := file.read( tftp.IO_CHUNK_SIZE ):
+            hasher.update( binChunk )
+    return hasher.hexdigest()
+
+def sync_mode( port: int, server: str, serverips: list[str], directory: str = ".",
+               pattern: str = "*", state: str | None = None, dry_run: bool = False,
+               blksize: int | None = None, windowsize: int = tftp.DEFAULT_WINDOWSIZE,
+               jobs: int = BATCH_JOBS, per_server: int = BATCH_PER_SERVER,
+               retries: int = BATCH_RETRIES, digest: str | None = None,
+               metrics: tftp.MetricsExporter | None = None, rate: float | None = None,
+               compress: str | None = None ) -> dict:
+    """
+    This method brings 'directory' up to date with the files of the
+    server matching 'pattern': it fetches the listing, plans the files
+    to fetch against the state file ('.tftpsync.json' in the directory
+    by default) and fetches them in parallel, each under 'rate' and asked
+    'compress'ed, as batch_mode() does. A file is fetched to a '.part' name and renamed over the old copy
+    only when complete, and the state is written after the transfers,
+    with the 'digest' of each file if asked. With 'dry_run' only the
+    plan is printed. It returns the summary of the sync.
+    """
+    strState = state or os.path.join( directory, SYNC_STATE )
+    dicIndex = tftp.index_listing( listing( port, server, serverips[0], blksize, windowsize,
+                                       metrics, serverips ) )
+    dicState = read_sync_state( strState )
+    if dicState.get( "server" ) != server:
+        dicState = { "server": server, "files": {} }
+    lstPlan = sync_plan( dicIndex, dicState, directory, pattern )
+    intSkipped = sum( fnmatch.fnmatchcase( strName, pattern ) for strName in dicIndex ) - len( lstPlan )
+    if dry_run or not lstPlan:
+        if dry_run:
+            for strName, strReason in lstPlan:
+                print( f"{strReason:<10} {strName}" )
+            print( f"{len( lstPlan )} to fetch, {intSkipped} unchanged." )
+        return { "plan": [ { "name": strName, "reason": strReason } for strName, strReason in lstPlan ],
+                 "skipped": intSkipped, "transfers": [], "ok": 0, "failed": 0, "bytes": 0,
+                 "duration": 0.0, "throughput": 0.0 }
+    os.makedirs( directory, exist_ok=True )
+    lstTransfers = [ { "mode": "get", "server": server, "origin": strName,
+                       "destination": os.path.join( directory, strName + SYNC_PARTIAL ),
+                       "digest": digest, "rate": rate, "compress": compress }
+                     for strName, _ in lstPlan ]
+    dicSummary = tftp.run( run_batch( lstTransfers, { server: serverips }, port, blksize, windowsize,
+                                      jobs, per_server, retries, metrics ) )
+    for dicResult in dicSummary["transfers"]:
+        if dicResult["status"] != "ok":
+            continue
+        strName = dicResult["origin"]
+        strPath = os.path.join( directory, strName )
+        os.replace( dicResult["destination"], strPath )
+        dicResult["destination"] = strPath
+        stat = os.stat( strPath )
+        strDate, strSize = dicIndex[strName]
+        dicState["files"][strName] = { "date": strDate, "size": strSize, "length": stat.st_size,
+                                       "mtime": stat.st_mtime_ns, "digest": dicResult["digest"] }
+    write_sync_state( strState, dicState )
+    dicSummary["plan"] = [ { "name": strName, "reason": strReason } for strName, strReason in lstPlan ]
+    dicSummary["skipped"] = intSkipped
+    return dicSummary
+
+def reporter( verbose: bool, metrics: tftp.MetricsExporter | None, stream=None ):
+    """
+    This method builds the progress callback of a transfer: the status
+    line on the console ('stream', stdout by default), the metrics
+    exporter, both or none of them.
+    """
+    lstCallbacks = [ callback for callback in ( verbose and tftp.ConsoleProgress( stream=stream ), metrics )
+                     if callback ]
+    if len( lstCallbacks ) < 2:
+        return lstCallbacks[0] if lstCallbacks else None
+    def report( progress: tftp.TransferProgress ):
+        for callback in lstCallbacks:
+            callback( progress )
+    return report
+
+def read_manifest( manifest: str ) -> list[dict]:
+    """
+    This method reads the transfers of a batch, one per line, either as
+    'MODE SERVER ORIGIN [DESTINATION]' or as a JSON object with those
+    keys in lower case (and optionally 'port'). Empty lines and lines
+    starting with '#' are skipped; '-' reads the manifest from stdin.
+    JSON objects may also ask for a 'digest' of the file and give the
+    'expected' one, keep the transfer under a 'rate' in bytes/s and ask
+    to 'compress' it.
+    """
+    lstTransfers = []
+    file = sys.stdin if manifest == "-" else open( manifest, "rt" )
+    try:
+        for intLine, strLine in enumerate( file, 1 ):
+            strLine = strLine.strip()
+            if not strLine or strLine.startswith( "#" ):
+                continue
+            try:
+                if strLine.startswith( "{" ):
+                    dicEntry = json.loads( strLine )
+                else:
+                    lstFields = strLine.split()
+                    if not 3 <= len( lstFields ) <= 4:
+                        raise ValueError( "expected MODE SERVER ORIGIN [DESTINATION]" )
+                    dicEntry = dict( zip( ( "mode", "server", "origin", "destination" ), lstFields ) )
+                dicEntry["mode"] = dicEntry["mode"].lower()
+                if dicEntry["mode"] not in ( "get", "put" ):
+                    raise ValueError( f"unknown mode '{dicEntry['mode']}'" )
+                for strKey in ( "server", "origin" ):
+                    if not dicEntry.get( strKey ):
+                        raise ValueError( f"missing {strKey}" )
+            except ( ValueError, KeyError, TypeError, AttributeError ) as e:
+                raise ValueError( f"Invalid manifest line {intLine}: {e}" )
+            if not dicEntry.get( "destination" ):
+                dicEntry["destination"] = os.path.split( dicEntry["origin"] )[1]
+            lstTransfers.append( dicEntry )
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    return lstTransfers
+
+def batch_mode( manifest: str, port: int, blksize: int | None, windowsize: int,
+                jobs: int, per_server: int, retries: int,
+                metrics: tftp.MetricsExporter | None = None, rate: float | None = None,
+                compress: str | None = None ) -> dict:
+    """
+    This method runs every transfer of a manifest on a single event loop,
+    at most 'jobs' at a time and 'per_server' at a time on each server,
+    retrying failures with exponential backoff. Each server is resolved
+    once for the whole batch. Transfers without a rate of their own are
+    kept under 'rate', and those without a compression of their own ask
+    for 'compress'. It returns the summary of the batch, with the hits
+    and misses of tftp.cache, when set.
+    """
+    lstTransfers = read_manifest( manifest )
+    dicServerIP = {}
+    for dicEntry in lstTransfers:
+        dicEntry.setdefault( "rate", rate )
+        dicEntry.setdefault( "compress", compress )
+        if dicEntry["server"] not in dicServerIP:
+            dicServerIP[dicEntry["server"]] = tftp.resolver.resolve( dicEntry["server"] )
+    dicSummary = tftp.run( run_batch( lstTransfers, dicServerIP, port, blksize, windowsize,
+                                      jobs, per_server, retries, metrics ) )
+    if tftp.cache is not None:
+        dicSummary["cache"] = { "hits": tftp.cache.hits, "misses": tftp.cache.misses }
+    return dicSummary
+
+async def run_batch( transfers: list[dict], serverips: dict[str, list[str]], port: int,
+                     blksize: int | None, windowsize: int, jobs: int, per_server: int,
+                     retries: int, metrics: tftp.MetricsExporter | None = None ) -> dict:
+    """
+    This coroutine is the worker pool behind batch_mode().
+    """
+    semJobs = asyncio.Semaphore( jobs )
+    # Servers are known by their first address.
+    dicSemServer = { lstIPs[0]: asyncio.Semaphore( per_server ) for lstIPs in serverips.values() if lstIPs }
+    dicBlkSize = { strIP: blksize or tftp.default_blksize( strIP ) for strIP in dicSemServer }
+    floStart = time.monotonic()
+    lstResults = await asyncio.gather( *[
+        run_batch_transfer( dicEntry, serverips[dicEntry["server"]], port, dicBlkSize, windowsize,
+                            semJobs, dicSemServer, retries, metrics )
+        for dicEntry in transfers ] )
+    floDuration = time.monotonic() - floStart
+    intBytes = sum( dicResult["bytes"] for dicResult in lstResults )
+    intOk = sum( dicResult["status"] == "ok" for dicResult in lstResults )
+    return {
+        "transfers": lstResults,
+        "ok": intOk,
+        "failed": len( lstResults ) - intOk,
+        "bytes": intBytes,
+        "duration": round( floDuration, 6 ),
+        "throughput": round( intBytes / floDuration, 1 ) if floDuration else 0.0,
+    }
+
+async def run_batch_transfer( entry: dict, serverips: list[str], port: int,
+                              blksizes: dict[str, int], windowsize: int,
+                              sem_jobs: asyncio.Semaphore,
+                              sem_servers: dict[str, asyncio.Semaphore],
+                              retries: int, metrics: tftp.MetricsExporter | None = None ) -> dict:
+    """
+    This coroutine runs one transfer of a batch, retrying it when it
+    fails for a reason that may go away (see transient()), and returns
+    its record for the summary. Every address of the server is tried
+    before a retry (see afailover()).
+    """
+    dicResult = { "mode": entry["mode"], "server": entry["server"], "origin": entry["origin"],
+                  "destination": entry["destination"], "status": "failed", "bytes": 0,
+                  "duration": 0.0, "throughput": 0.0, "retransmits": 0, "attempts": 0,
+                  "digest": None, "cached": False, "compression": None, "ratio": 1.0,
+                  "error": None }
+    if not serverips:
+        dicResult["error"] = f"Unknown server: '{entry['server']}'."
+        return dicResult
+    if entry["mode"] == "put" and os.path.isfile( entry["origin"] ) == False:
+        dicResult["error"] = f"File '{entry['origin']}' not found."
+        return dicResult
+    intPort = int( entry.get( "port", port ) )
+    serverip = serverips[0]
+    transfer = tftp.aget_file if entry["mode"] == "get" else tftp.aput_file
+    strName = entry["origin"] if entry["mode"] == "get" else entry["destination"]
+    for intAttempt in range( retries + 1 ):
+        if intAttempt:
+            await asyncio.sleep( BATCH_BACKOFF * 2 ** ( intAttempt - 1 ) )
+        dicResult["attempts"] = intAttempt + 1
+        # The server slot is taken first so that a busy server does not
+        # hold global slots that other servers could use.
+        async with sem_servers[serverip], sem_jobs:
+            floStart = time.monotonic()
+            try:
+                result = await tftp.afailover( transfer, intPort, entry["server"], serverips, strName,
+                                               entry["origin"], entry["destination"],
+                                               blksizes[serverip], windowsize, progress=metrics,
+                                               digest=entry.get( "digest" ),
+                                               expected=entry.get( "expected" ),
+                                               rate=entry.get( "rate" ),
+                                               compress=entry.get( "compress" ) )
+            except ( OSError, ValueError ) as e:
+                dicResult["error"] = str( e ).strip()
+                if not transient( e ):
+                    break
+                continue
+            finally:
+                dicResult["duration"] = round( time.monotonic() - floStart, 6 )
+        dicResult.update( status="ok", bytes=result.size, retransmits=result.retransmits,
+                          digest=result.digest, cached=result.cached,
+                          compression=result.compression, ratio=round( result.ratio, 3 ), error=None )
+        if dicResult["duration"]:
+            dicResult["throughput"] = round( result.size / dicResult["duration"], 1 )
+        break
+    return dicResult
+
+def transient( error: Exception ) -> bool:
+    """
+    This method tells whether a failed transfer is worth retrying: not
+    when the server refused it with an ERR packet, e.g. File not found
+    or Access violation, nor when the request itself is invalid. An ERR
+    0 (not defined) is what servers send on timeouts, so it is retried.
+    """
+    if isinstance( error, tftp.TFTPPeerError ):
+        return error.code == tftp.ERR_NOT_DEFINED
+    return not isinstance( error, tftp.TFTPValueError )
+
+class JobQueue:
+    """
+    The background transfers of the interactive mode: they run on an
+    event loop of their own, in a thread, at most 'jobs' at a time,
+    against the server resolved once for the whole session. Their
+    progress is only recorded, to be shown on demand by jobs() and
+    wait(), so that the prompt is not disturbed by status lines.
+    """
+    __slots__ = ( "port", "server", "serverip", "serverips", "blksize", "windowsize", "metrics",
+                  "jobs", "_loop", "_thread", "_semaphore", "_next", "_finished" )
+
+    def __init__( self, port: int, server: str, serverip: str, serverips: list[str] | None,
+                  blksize: int | None, windowsize: int, metrics: tftp.MetricsExporter | None,
+                  jobs: int = BATCH_PER_SERVER ):
+        self.port = port
+        self.server = server
+        self.serverip = serverip
+        self.serverips = serverips or [ serverip ]
+        self.blksize = blksize or tftp.default_blksize( serverip )
+        self.windowsize = windowsize
+        self.metrics = metrics
+        self.jobs = {}              # number => record of the job, in the order queued
+        self._semaphore = asyncio.Semaphore( jobs )
+        self._next = 1
+        self._finished = []         # numbers of the jobs ended since the last notices()
+        self._loop = asyncio.SelectorEventLoop()
+        self._thread = threading.Thread( target=self._loop.run_forever, name="tftp-jobs", daemon=True )
+        self._thread.start()
+
+    def submit( self, mode: str, origin: str, destination: str,
+                transfer_mode: str = tftp.DEFAULT_MODE ) -> int:
+        """
+        Queues a get or a put ('mode') and returns its number.
+        """
+        intJob = self._next
+        self._next += 1
+        dicJob = { "id": intJob, "mode": mode, "origin": origin, "destination": destination,
+                   "status": "queued", "size": 0, "total": None, "rate": 0.0, "result": None,
+                   "error": None, "future": None }
+        self.jobs[intJob] = dicJob
+        dicJob["future"] = asyncio.run_coroutine_threadsafe( self._run( dicJob, transfer_mode ),
+                                                             self._loop )
+        return intJob
+
+    async def _run( self, job: dict, mode: str ):
+        transfer = tftp.aget_file if job["mode"] == "get" else tftp.aput_file
+        strName = job["origin"] if job["mode"] == "get" else job["destination"]
+        def progress( progress: tftp.TransferProgress ):
+            job.update( size=progress.size, total=progress.total, rate=progress.rate )
+            if self.metrics:
+                self.metrics( progress )
+        try:
+            async with self._semaphore:
+                job["status"] = "running"
+                result = await tftp.afailover( transfer, self.port, self.server, self.serverips, strName,
+                                               job["origin"], job["destination"], self.blksize,
+                                               self.windowsize, progress=progress, mode=mode )
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            raise
+        except ( OSError, ValueError ) as e:
+            job.update( status="failed", error=str( e ).strip() )
+        else:
+            job.update( status="done", result=result, size=result.size )
+        finally:
+            job["rate"] = 0.0
+            self._finished.append( job["id"] )
+
+    def pending( self ) -> list[dict]:
+        return [ dicJob for dicJob in self.jobs.values() if dicJob["status"] in ( "queued", "running" ) ]
+
+    def throughput( self ) -> float:
+        """
+        The aggregate rate of the running jobs, in bytes/s.
+        """
+        return sum( dicJob["rate"] for dicJob in self.jobs.values() if dicJob["status"] == "running" )
+
+    def status( self ) -> str:
+        dicCount = {}
+        for dicJob in self.jobs.values():
+            dicCount[dicJob["status"]] = dicCount.get( dicJob["status"], 0 ) + 1
+        strCounts = ", ".join( f"{intCount} {strStatus}" for strStatus, intCount in dicCount.items() )
+        if "running" not in dicCount:
+            return f"{strCounts or 'No jobs'}."
+        return f"{strCounts}: {tftp.format_rate( self.throughput() )}."
+
+    def describe( self, job: dict ) -> str:
+        strLine = f"[{job['id']}] {job['status']:<9} {job['mode']} {job['origin']} -> {job['destination']}"
+        if job["status"] == "running":
+            strDone = f" ({job['size'] * 100 // job['total']}%)" if job["total"] else ""
+            strLine += f"  {job['size']} bytes{strDone}, {tftp.format_rate( job['rate'] )}"
+        elif job["status"] == "done":
+            result = job["result"]
+            strLine += ( f"  {result.size} bytes, {result.retransmits} retransmissions, "
+                         f"{tftp.format_rate( result.size / result.elapsed if result.elapsed else 0.0 )}" )
+            if result.cached:
+                strLine += ", from the cache"
+        elif job["status"] == "failed":
+            strLine += f"  {job['error']}"
+        return strLine
+
+    def notices( self ) -> list[str]:
+        """
+        The lines of the jobs ended since the last call, as the shell
+        tells them before its prompt.
+        """
+        lstLines = []
+        while self._finished:
+            lstLines.append( self.describe( self.jobs[self._finished.pop( 0 )] ) )
+        return lstLines
+
+    def cancel( self, numbers: list[int] | None = None ) -> int:
+        """
+        Cancels the jobs numbered, or all of them, that have not ended and
+        returns how many were. A file being received is removed.
+        """
+        intCancelled = 0
+        for intJob in self.jobs if numbers is None else numbers:
+            dicJob = self.jobs.get( intJob )
+            if dicJob is not None and dicJob["status"] in ( "queued", "running" ) and dicJob["future"].cancel():
+                intCancelled += 1
+        return intCancelled
+
+    def wait( self, numbers: list[int] | None = None, stream=None ) -> bool:
+        """
+        Waits for the jobs numbered, or all of them, showing their count
+        and aggregate rate on a status line redrawn every CONSOLE_INTERVAL
+        segs. Ctrl-C stops waiting, not the jobs: then it returns False.
+        """
+        stream = stream or sys.stdout
+        setFutures = { self.jobs[intJob]["future"] for intJob in self.jobs if numbers is None or intJob in numbers }
+        intWidth = 0
+        try:
+            while True:
+                _, setFutures = concurrent.futures.wait( setFutures, tftp.CONSOLE_INTERVAL )
+                strLine = self.status()
+                print( "\r" + strLine.ljust( intWidth ), end="", file=stream, flush=True )
+                intWidth = len( strLine )
+                if not setFutures:
+                    return True
+        except KeyboardInterrupt:
+            return False
+        finally:
+            print( file=stream, flush=True )
+
+    async def _cancel_all( self ):
+        lstTasks = [ task for task in asyncio.all_tasks() if task is not asyncio.current_task() ]
+        for task in lstTasks:
+            task.cancel()
+        await asyncio.gather( *lstTasks, return_exceptions=True )
+
+    def close( self ):
+        """
+        Cancels the jobs left and stops the event loop.
+        """
+        # The cancelled transfers still tell the server and close their
+        # files: the loop runs until they are done.
+        asyncio.run_coroutine_threadsafe( self._cancel_all(), self._loop ).result()
+        self._loop.call_soon_threadsafe( self._loop.stop )
+        self._thread.join()
+        self._loop.close()
 
 if __name__ == '__main__':
 
@@ -120,38 +834,171 @@ if __name__ == '__main__':
         prog="client.py",
         description="Cliente TFTP Piranha.",
         epilog="Copyright (C) 2024 Erick Mattos <erick.mattos@gmail.com>" )
-    parse.add_argument( "MODE", choices=["get", "put"], nargs="?", type=str.lower, help="Modo de operação." )
-    parse.add_argument( "-p", "--port", default=69, help="Porta do servidor." )
-    parse.add_argument( "SERVER", help="Servidor a contactar." )
-    parse.add_argument( "ORIGIN", nargs="?", help="Arquivo de origem." )
-    parse.add_argument( "DESTINATION", nargs="?", help="Arquivo de destino" )
+    parse.add_argument( "MODE", choices=["get", "put", "batch", "sync"], nargs="?", type=str.lower, help="Modo de operação." )
+    parse.add_argument( "-p", "--port", default=69, type=int, help="Porta do servidor." )
+    parse.add_argument( "-b", "--blksize", type=int,
+                        help=f"Tamanho dos blocos de dados ({tftp.MIN_BLKSIZE}..{tftp.MAX_BLKSIZE}). "
+                              "Por omissão, ajustado ao MTU do caminho até ao servidor." )
+    parse.add_argument( "-w", "--windowsize", default=tftp.DEFAULT_WINDOWSIZE, type=int,
+                        help=f"Número de blocos enviados antes de cada ACK (1..{tftp.MAX_WINDOWSIZE})." )
+    parse.add_argument( "-j", "--jobs", default=BATCH_JOBS, type=int,
+                        help="Modos batch e interativo: transferências em simultâneo." )
+    parse.add_argument( "--per-server", default=BATCH_PER_SERVER, type=int,
+                        help="Modos batch e interativo: transferências em simultâneo com cada servidor." )
+    parse.add_argument( "--retries", default=BATCH_RETRIES, type=int,
+                        help="Modo batch: novas tentativas de uma transferência falhada." )
+    parse.add_argument( "--summary", help="Modos batch e sync: ficheiro do resumo em JSON (por omissão, stdout)." )
+    parse.add_argument( "-n", "--dry-run", action="store_true",
+                        help="Modo sync: mostrar apenas os arquivos que seriam obtidos." )
+    parse.add_argument( "--state", help="Modo sync: ficheiro de estado (por omissão, '.tftpsync.json' no destino)." )
+    parse.add_argument( "-a", "--ascii", action="store_true",
+                        help="Transferir em modo netascii (texto), com as terminações de linha locais." )
+    parse.add_argument( "--digest", choices=tftp.DIGESTS,
+                        help="Calcular o resumo criptográfico do arquivo durante a transferência." )
+    parse.add_argument( "--expect", help="Resumo esperado do arquivo (o tipo deduz-se do tamanho)." )
+    parse.add_argument( "--sidecar", action="store_true",
+                        help=f"Verificar no get, ou gravar no put, o sha256 do arquivo '{tftp.SIDECAR_SUFFIX}' do servidor." )
+    parse.add_argument( "--io-buffer", default=tftp.IO_BUFFER_SIZE, type=int,
+                        help="Bytes a guardar, no máximo, entre a rede e o disco (0 para escrever e ler sem thread)." )
+    parse.add_argument( "--fsync", action="store_true",
+                        help="Sincronizar o arquivo recebido com o disco antes de terminar." )
+    parse.add_argument( "--rate", type=float,
+                        help="Limite de cada transferência, em bytes/s." )
+    parse.add_argument( "--total-rate", type=float,
+                        help="Limite do conjunto das transferências, em bytes/s." )
+    parse.add_argument( "--aimd", action="store_true",
+                        help="Put: ajustar o ritmo da janela às perdas (AIMD)." )
+    parse.add_argument( "--compress", choices=tftp.COMPRESSIONS,
+                        help="Comprimir os blocos, se o servidor aceitar (só no modo octet)." )
+    parse.add_argument( "-m", "--multicast", action="store_true",
+                        help="Modo get: receber por multicast (RFC 2090), com outros clientes." )
+    parse.add_argument( "--mirror", action="append", default=[],
+                        help="Servidor alternativo, tentado quando o principal não responde (repetível)." )
+    parse.add_argument( "-N", "--no-reverse", action="store_true",
+                        help="Não procurar o nome do servidor a partir do endereço." )
+    parse.add_argument( "--dns-cache", help="Ficheiro onde guardar as resoluções de nomes entre execuções." )
+    parse.add_argument( "--dns-ttl", default=tftp.RESOLVER_TTL, type=float,
+                        help="Segundos durante os quais uma resolução de nome é válida." )
+    parse.add_argument( "--metrics", help="Ficheiro onde registar as métricas de cada transferência." )
+    parse.add_argument( "--metrics-format", choices=tftp.MetricsExporter.FORMATS,
+                        help="Formato das métricas: JSON lines ou Prometheus (por omissão, pela extensão '.prom')." )
+    parse.add_argument( "--cache", help="Diretório da cache local dos arquivos obtidos." )
+    parse.add_argument( "--cache-size", default=tftp.CACHE_SIZE, type=int,
+                        help="Tamanho máximo da cache, em bytes." )
+    parse.add_argument( "--cache-ttl", default=tftp.CACHE_TTL, type=float,
+                        help="Segundos de validade na cache de um arquivo fora da listagem do servidor." )
+    parse.add_argument( "--cache-link", action="store_true",
+                        help="Servir da cache por hard link (os arquivos obtidos não devem ser alterados)." )
+    parse.add_argument( "--trace", help="Ficheiro onde registar cada pacote enviado e recebido (ver analyze.py)." )
+    parse.add_argument( "--trace-format", choices=tftp.PacketTrace.FORMATS,
+                        help="Formato do traço: binário ou JSON lines (por omissão, pela extensão '.jsonl')." )
+    parse.add_argument( "SERVER", help="Servidor a contactar (no modo batch, o manifesto; '-' para stdin)." )
+    parse.add_argument( "ORIGIN", nargs="?", help="Arquivo de origem ('-' para stdin no put)." )
+    parse.add_argument( "DESTINATION", nargs="?", help="Arquivo de destino ('-' para stdout no get)." )
     args = parse.parse_args()
+    try:
+        if args.blksize is not None:
+            tftp.check_blksize( args.blksize )
+        tftp.check_windowsize( args.windowsize )
+        metrics = args.metrics and tftp.MetricsExporter( args.metrics, args.metrics_format )
+        if args.rate is not None and args.rate <= 0:
+            raise tftp.TFTPValueError( f"Invalid rate: {args.rate}" )
+        tftp.check_compress( args.compress, tftp.NETASCII_MODE if args.ascii else tftp.DEFAULT_MODE )
+        if args.total_rate is not None:
+            tftp.shared_bucket = tftp.TokenBucket( args.total_rate )
+        if args.cache:
+            tftp.cache = tftp.ContentCache( args.cache, args.cache_size, args.cache_ttl, args.cache_link )
+        if args.trace:
+            tftp.tracer = tftp.PacketTrace( args.trace, args.trace_format )
+            atexit.register( tftp.tracer.close )
+    except ( tftp.TFTPValueError, OSError ) as e:
+        print( e )
+        sys.exit(1)
+
+    tftp.resolver = tftp.Resolver( args.dns_ttl, args.dns_cache, not args.no_reverse )
+    strMode = tftp.NETASCII_MODE if args.ascii else tftp.DEFAULT_MODE
+
+    if args.MODE == "batch":
+        if min( args.jobs, args.per_server ) < 1 or args.retries < 0:
+            print( "Invalid batch limits." )
+            sys.exit(1)
+        try:
+            dicSummary = batch_mode( args.SERVER, args.port, args.blksize, args.windowsize,
+                                     args.jobs, args.per_server, args.retries, metrics, args.rate,
+                                     args.compress )
+        except ( OSError, ValueError ) as e:
+            print( e )
+            sys.exit(1)
+        if args.summary:
+            with open( args.summary, "wt" ) as file:
+                json.dump( dicSummary, file, indent=2 )
+        else:
+            print( json.dumps( dicSummary, indent=2 ) )
+        sys.exit( 1 if dicSummary["failed"] else 0 )
 
-    strServerIP = tftp.getIP( args.SERVER )
-    if strServerIP is None:
+    lstServerIPs = tftp.resolver.resolve( args.SERVER )
+    if not lstServerIPs:
         print( f"Unknown server: '{args.SERVER}'." )
         sys.exit(1)
-    strServerIP = strServerIP.strip("'")
+    strServerIP = lstServerIPs[0]
+    for strMirror in args.mirror:
+        lstMirrorIPs = tftp.resolver.resolve( strMirror )
+        if not lstMirrorIPs:
+            print( f"Unknown mirror: '{strMirror}'." )
+            sys.exit(1)
+        lstServerIPs += [ strIP for strIP in lstMirrorIPs if strIP not in lstServerIPs ]
     if args.SERVER == strServerIP:
         args.SERVER = tftp.getHost(strServerIP)
         if args.SERVER is None:
-            args.SERVER = 'Unnamed'
+            args.SERVER = strServerIP if args.no_reverse else 'Unnamed'
     args.SERVER = args.SERVER.strip("'")
+    if args.MODE == "sync":
+        if min( args.jobs, args.per_server ) < 1 or args.retries < 0:
+            print( "Invalid batch limits." )
+            sys.exit(1)
+        try:
+            dicSummary = sync_mode( args.port, args.SERVER, lstServerIPs, args.DESTINATION or ".",
+                                    args.ORIGIN or "*", args.state, args.dry_run, args.blksize,
+                                    args.windowsize, args.jobs, args.per_server, args.retries,
+                                    args.digest, metrics, args.rate, args.compress )
+        except ( OSError, ValueError ) as e:
+            print( e )
+            sys.exit(1)
+        if args.summary:
+            with open( args.summary, "wt" ) as file:
+                json.dump( dicSummary, file, indent=2 )
+        elif not args.dry_run:
+            print( json.dumps( dicSummary, indent=2 ) )
+        sys.exit( 1 if dicSummary["failed"] else 0 )
+
     if args.DESTINATION is None:
         args.DESTINATION = args.ORIGIN
+    if args.MODE == "put" and args.DESTINATION == "-":
+        print( "You have to name the file in the server when putting from stdin." )
+        sys.exit(1)
 
     if args.MODE is None:
         print( f"Exchanging files with server '{args.SERVER}' ({strServerIP}).\n" )
-        interactive_mode(args.port, args.SERVER, strServerIP)
+        if min( args.jobs, args.per_server ) < 1:
+            print( "Invalid batch limits." )
+            sys.exit(1)
+        interactive_mode(args.port, args.SERVER, strServerIP, args.blksize, args.windowsize, metrics,
+                         lstServerIPs, strMode, min( args.jobs, args.per_server ))
     elif args.MODE == "get":
         if args.ORIGIN: 
-            receive(args.port, args.SERVER, strServerIP, args.ORIGIN, args.DESTINATION)
+            receive(args.port, args.SERVER, strServerIP, args.ORIGIN, args.DESTINATION,
+                    args.blksize, args.windowsize, metrics, args.multicast, lstServerIPs, strMode,
+                    args.digest, args.expect, args.sidecar, args.io_buffer, args.fsync, args.rate,
+                    args.compress)
         else:
             print( "You have to designate the file to get from the server." )
             sys.exit(1)
     elif args.MODE == "put":
         if args.ORIGIN:
-            send(args.port, args.SERVER, strServerIP, args.ORIGIN, args.DESTINATION)
+            send(args.port, args.SERVER, strServerIP, args.ORIGIN, args.DESTINATION,
+                 args.blksize, args.windowsize, metrics, lstServerIPs, strMode,
+                 args.digest, args.expect, args.sidecar, args.io_buffer, args.rate, args.aimd,
+                 args.compress)
         else:
             print( "You have to designate the file to put into the server." )
             sys.exit(1)
@@ -0,0 +1,881 @@
+#!/usr/bin/env python3
+# server.py (Piranha's TFTP server) 0.1
+#
+# Copyright (C) 2024 Erick Mattos <erick.mattos@gmail.com>
+#
+# This is the TFTP server code of Piranha software.
+#
+# Piranha is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Piranha is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# On Debian systems, the complete text of the GNU General
+# Public License can be found in `/usr/share/common-licenses/GPL-3'.
+
+import abc
+import argparse
+import errno
+import heapq
+import mmap
+import multiprocessing
+import os
+import selectors
+import socket
+import struct
+import sys
+import time
+import tftp
+
+DALLY_TIMEOUTS  = 3           # timeouts waited for a lost final ACK
+MAX_READS       = 64          # datagrams read from a socket in a row
+SELECT_INTERVAL = 0.5         # segs, at most, between checks for shutdown
+
+_HEADER = struct.Struct( "!HH" )
+
+###############################################################
+##                                                           ##
+##                         SESSIONS                          ##
+##                                                           ##
+###############################################################
+
+class Session( abc.ABC ):
+    """
+    A transfer in progress: the socket of its own transfer ID, the peer
+    and the options negotiated with it, and its retransmission timer.
+    Each kind of transfer starts and goes on in a subclass of its own.
+    """
+    __slots__ = ( "server", "sock", "peer", "name", "blksize", "windowsize", "options",
+                  "timer", "deadline", "progress", "sent_at", "retransmits", "closed" )
+
+    def __init__( self, server: "Server", peer: tftp.INET4Address, name: str,
+                  blksize: int, windowsize: int, options: dict[str, int] ):
+        self.server = server
+        self.peer = peer
+        self.name = name
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.options = options
+        self.timer = tftp.RetransmissionTimer()
+        self.deadline = None
+        self.progress = time.monotonic()
+        self.sent_at = None
+        self.retransmits = 0
+        self.closed = False
+        self.sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        self.sock.setblocking( False )
+        self.sock.bind( ( server.host, 0 ) )
+        if windowsize > 1:
+            intSize = 2 * windowsize * ( blksize + 4 )
+            if self.sock.getsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF ) < intSize:
+                self.sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, intSize )
+
+    def send( self, *buffers, to: tftp.INET4Address | None = None ):
+        addr = to or self.peer
+        try:
+            if len( buffers ) > 1 and hasattr( self.sock, "sendmsg" ):
+                # Scatter/gather: the header and the data go out together
+                # without being joined in a new buffer first.
+                self.sock.sendmsg( buffers, [], 0, addr )
+            else:
+                self.sock.sendto( b"".join( buffers ), addr )
+        except ( BlockingIOError, InterruptedError ):
+            # As good as lost on the way: the timer takes care of it.
+            pass
+
+    def accepts( self, addr: tftp.INET4Address ) -> bool:
+        """
+        Tells whether a datagram from 'addr' belongs to the transfer
+        (the TID check of RFC 1350).
+        """
+        return addr == self.peer
+
+    def arm( self ):
+        self.deadline = time.monotonic() + self.timer.timeout
+        self.server.schedule( self )
+
+    def sample( self, now: float ):
+        if self.sent_at is not None:
+            self.timer.sample( now - self.sent_at )
+            self.sent_at = None
+        else:
+            self.timer.restore()
+        self.progress = now
+
+    def fail( self, error_code: int, error_msg: str | None = None ):
+        self.send( tftp.pack_err( error_code, error_msg ) )
+        self.close( False )
+
+    def expired( self, now: float ) -> bool:
+        """
+        Called when the timer goes off: it tells whether the session
+        should go on, i.e. retransmit, or it has been idle for too long.
+        """
+        if now - self.progress >= tftp.INACTIVITY_TIMEOUT:
+            self.fail( tftp.ERR_NOT_DEFINED, "Timeout" )
+            return False
+        self.timer.backoff()
+        self.sent_at = None
+        self.retransmits += 1
+        return True
+
+    def close( self, completed: bool ):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.unregister( self, completed )
+        self.sock.close()
+
+    @abc.abstractmethod
+    def start( self ):
+        """
+        Sends the first packet of the transfer and arms the timer.
+        """
+
+    @abc.abstractmethod
+    def on_datagram( self, packet: memoryview, addr: tftp.INET4Address, now: float ):
+        """
+        Takes a datagram of the peer, at least 4 bytes long.
+        """
+
+    @abc.abstractmethod
+    def on_timeout( self, now: float ):
+        """
+        Called when the timer goes off.
+        """
+
+class ReadSession( Session ):
+    """
+    A RRQ being served: the file, mapped in memory and shared with every
+    other session reading it, goes out windowsize blocks at a time, as a
+    tftp.Sender sends them, once the client acknowledges our OACK. With
+    a 'compress' option it goes through a tftp.CompressingReader, and in
+    'netascii' through a tftp.NetasciiReader, block by block.
+    """
+    __slots__ = ( "data", "mapping", "size", "sender", "offset" )
+
+    def __init__( self, server: "Server", peer: tftp.INET4Address, name: str,
+                  blksize: int, windowsize: int, options: dict[str, int], data: memoryview,
+                  mapping: list | None = None, netascii: bool = False ):
+        super().__init__( server, peer, name, blksize, windowsize, options )
+        self.data = data
+        self.mapping = mapping  # the entry of Server.open() behind 'data', if any
+        self.size = len( data )
+        self.offset = 0
+        source = self.block
+        if "compress" in options:
+            reader = tftp.CompressingReader( self.readinto, options["compress"] )
+            source = tftp.RingSource( reader.readinto, blksize, windowsize )
+        elif netascii:
+            source = tftp.RingSource( tftp.NetasciiReader( self.readinto ).readinto, blksize, windowsize )
+        self.sender = tftp.Sender( source, blksize, windowsize, self.progress )
+        self.timer = self.sender.timer
+
+    def readinto( self, view: memoryview ) -> int:
+        data = self.data[self.offset:self.offset + len( view )]
+        view[:len( data )] = data
+        self.offset += len( data )
+        return len( data )
+
+    def block( self, number: int ) -> tuple[tuple[bytes, memoryview], int]:
+        # The header and a slice of the mapping, sent together without
+        # being joined in a new buffer first.
+        intOffset = ( number - 1 ) * self.blksize
+        data = self.data[intOffset:intOffset + self.blksize]
+        return ( _HEADER.pack( tftp.DAT, number & tftp.MAX_BLOCK_NUMBER ), data ), len( data )
+
+    def start( self ):
+        now = time.monotonic()
+        if self.options:
+            self.send( tftp.pack_oack( self.options ) )
+            self.sent_at = now
+        else:
+            self.sender.start( now )
+            self.flush()
+        self.arm()
+
+    def flush( self ):
+        for packet in self.sender.outbox:
+            if isinstance( packet, tuple ):
+                self.send( *packet )
+            else:
+                self.send( packet )
+        self.sender.outbox.clear()
+
+    def on_datagram( self, packet: memoryview, addr: tftp.INET4Address, now: float ):
+        intOpcode, intNumber = _HEADER.unpack_from( packet )
+        if intOpcode == tftp.ERR:
+            self.close( False )
+            return
+        if intOpcode != tftp.ACK:
+            return
+        if self.sender.sent == 0:
+            # ACK 0 acknowledges our OACK: the data can start.
+            if intNumber == 0:
+                self.sample( now )
+                self.sender.start( now )
+                self.flush()
+                self.arm()
+            return
+        bolProgress = self.sender.on_ack( intNumber, now )
+        self.flush()
+        if self.sender.done:
+            self.close( True )
+        elif bolProgress:
+            self.arm()
+
+    def on_timeout( self, now: float ):
+        if self.sender.sent == 0 and self.options:
+            if self.expired( now ):
+                self.send( tftp.pack_oack( self.options ) )
+                self.arm()
+            return
+        try:
+            self.sender.on_timeout( now )
+        except TimeoutError:
+            self.fail( tftp.ERR_NOT_DEFINED, "Timeout" )
+            return
+        self.flush()
+        self.arm()
+
+    def close( self, completed: bool ):
+        if not self.closed:
+            # No slice of the mapping may outlive it.
+            self.sender.window.clear()
+            self.data.release()
+            self.retransmits += self.sender.retransmits
+        super().close( completed )
+
+class MulticastSession( ReadSession ):
+    """
+    A RRQ served over multicast (RFC 2090): the blocks go to a group
+    joined by every client reading the same file, while the master
+    client, one at a time, acknowledges them one by one. A client is let
+    go once it acknowledges the last block, and the next one in line
+    becomes the master.
+    """
+    __slots__ = ( "group", "members", "confirmed", "attempts", "last_block", "acked", "sent" )
+
+    def __init__( self, server: "Server", peer: tftp.INET4Address, name: str,
+                  blksize: int, options: dict[str, int], data: memoryview,
+                  group: tftp.INET4Address, mapping: list | None = None ):
+        super().__init__( server, peer, name, blksize, 1, {}, data, mapping )
+        self.group = group
+        self.members = { peer: options }    # in the order they joined
+        self.confirmed = False              # the master acknowledged its OACK
+        self.attempts = 0
+        self.last_block = self.size // blksize + 1
+        self.acked = 0
+        self.sent = 0
+        self.sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 )
+        if server.host != "0.0.0.0":
+            self.sock.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                  socket.inet_aton( server.host ) )
+
+    def accepts( self, addr: tftp.INET4Address ) -> bool:
+        return addr in self.members
+
+    def oack( self, addr: tftp.INET4Address ) -> bytes:
+        strMaster = "1" if addr == self.peer else "0"
+        return tftp.pack_oack( self.members[addr] |
+                               { "multicast": f"{self.group[0]},{self.group[1]},{strMaster}" } )
+
+    def start( self ):
+        self.send( self.oack( self.peer ) )
+        self.sent_at = time.monotonic()
+        self.arm()
+
+    def join( self, addr: tftp.INET4Address, options: dict[str, int] ):
+        if addr not in self.members:
+            self.members[addr] = options
+        # Again on a RRQ sent again.
+        self.send( self.oack( addr ), to=addr )
+
+    def leave( self, addr: tftp.INET4Address, now: float, completed: bool ):
+        if self.members.pop( addr, None ) is None:
+            return
+        if not self.members:
+            self.close( completed )
+            return
+        if addr == self.peer:
+            self.peer = next( iter( self.members ) )
+            self.confirmed = False
+            self.attempts = 0
+            self.send( self.oack( self.peer ) )
+            self.sent_at = now
+            self.arm()
+
+    def send_window( self ):
+        intBlock = self.acked + 1
+        intOffset = ( intBlock - 1 ) * self.blksize
+        self.send( _HEADER.pack( tftp.DAT, intBlock ),
+                   self.data[intOffset:intOffset + self.blksize], to=self.group )
+        self.sent = max( self.sent, intBlock )
+
+    def on_datagram( self, packet: memoryview, addr: tftp.INET4Address, now: float ):
+        intOpcode, intNumber = _HEADER.unpack_from( packet )
+        if intOpcode == tftp.ERR:
+            self.leave( addr, now, False )
+            return
+        if intOpcode != tftp.ACK:
+            return
+        if intNumber == self.last_block:
+            self.leave( addr, now, True )
+            return
+        # Only files that do not roll the block number over are served
+        # this way, so the numbers are absolute. The ACK of a new master
+        # points to the first block it misses, anywhere before.
+        if addr != self.peer or intNumber > self.sent or ( self.confirmed and intNumber < self.acked ):
+            return
+        self.sample( now )
+        self.confirmed = True
+        self.attempts = 0
+        self.acked = intNumber
+        self.send_window()
+        self.sent_at = now
+        self.arm()
+
+    def on_timeout( self, now: float ):
+        self.timer.backoff()
+        self.sent_at = None
+        self.retransmits += 1
+        self.attempts += 1
+        if self.attempts > tftp.MAX_ATTEMPTS:
+            # The master is gone: on to the next one.
+            self.send( tftp.pack_err( tftp.ERR_NOT_DEFINED, "Timeout" ) )
+            self.leave( self.peer, now, False )
+            return
+        if self.confirmed:
+            self.send_window()
+        else:
+            self.send( self.oack( self.peer ) )
+        self.arm()
+
+class WriteSession( Session ):
+    """
+    A WRQ being served: blocks, as a tftp.Receiver takes them in, are
+    written to a temporary file next to the destination, which replaces
+    it once the transfer is complete. With a 'compress' option they go
+    through a tftp.Decompressor first.
+    """
+    __slots__ = ( "file", "path", "partial", "tsize", "finished", "decoder", "decompressor",
+                  "receiver" )
+
+    def __init__( self, server: "Server", peer: tftp.INET4Address, name: str,
+                  blksize: int, windowsize: int, options: dict[str, int], path: str,
+                  tsize: int | None, netascii: bool = False ):
+        super().__init__( server, peer, name, blksize, windowsize, options )
+        self.path = path
+        self.decoder = tftp.NetasciiDecoder() if netascii else None
+        self.decompressor = tftp.Decompressor( options["compress"] ) if "compress" in options else None
+        strHead, strTail = os.path.split( path )
+        self.partial = os.path.join( strHead, f".{strTail}.{os.getpid()}.{self.sock.getsockname()[1]}.part" )
+        try:
+            self.file = open( self.partial, "wb" )
+        except OSError as e:
+            self.sock.close()
+            if e.errno in ( errno.ENOSPC, errno.EDQUOT ):
+                raise
+            # A directory missing, read only or not ours: not writable.
+            raise PermissionError( e.errno, e.strerror, path ) from e
+        self.tsize = tsize
+        self.finished = False
+        self.receiver = tftp.Receiver( blksize, windowsize,
+                                       tftp.pack_oack( options ) if options else tftp.pack_ack( 0 ),
+                                       self.progress )
+        self.timer = self.receiver.timer
+
+    def start( self ):
+        if self.tsize:
+            try:
+                tftp.preallocate( self.file, self.tsize )
+            except OSError:
+                self.fail( tftp.DISK_FULL_OR_ALLOC_EXC )
+                return
+        self.send( self.receiver.last )
+        self.receiver.sent_at = time.monotonic()
+        self.arm()
+
+    def flush( self ):
+        for packet in self.receiver.outbox:
+            self.send( packet )
+        self.receiver.outbox.clear()
+
+    def on_datagram( self, packet: memoryview, addr: tftp.INET4Address, now: float ):
+        intOpcode, _ = _HEADER.unpack_from( packet )
+        if intOpcode == tftp.ERR:
+            self.close( False )
+            return
+        if intOpcode != tftp.DAT:
+            return
+        try:
+            data = self.receiver.on_data( packet, now )
+        except tftp.TFTPGeneralError as e:
+            self.fail( tftp.ILLEGAL_TFTP_OP, str( e ) )
+            return
+        if data is not None:
+            # Written before it is acknowledged.
+            try:
+                if self.decompressor is not None:
+                    for binChunk in self.decompressor.decompress( data ):
+                        self.file.write( binChunk )
+                else:
+                    self.file.write( data if self.decoder is None else self.decoder.decode( data ) )
+            except tftp.TFTPGeneralError as e:
+                self.fail( tftp.ERR_NOT_DEFINED, str( e ) )
+                return
+            except OSError:
+                self.fail( tftp.DISK_FULL_OR_ALLOC_EXC )
+                return
+        if data is not None and self.receiver.done:
+            self.finish()
+            return
+        self.flush()
+        if data is not None:
+            self.arm()
+
+    def finish( self ):
+        """
+        Checks the file received and puts it in place before the final
+        ACK goes out, so that the client is told it is done only when it
+        is, or gets an ERR instead.
+        """
+        intSize = self.receiver.size
+        try:
+            if self.decoder is not None:
+                self.file.write( self.decoder.flush() )
+            if self.decompressor is not None:
+                self.decompressor.flush()
+                intSize = self.decompressor.size
+            if self.tsize is not None and intSize != self.tsize:
+                raise tftp.TFTPGeneralError( f"Size mismatch: {intSize} bytes instead of {self.tsize}" )
+            self.file.truncate()
+            self.file.close()
+            os.replace( self.partial, self.path )
+        except tftp.TFTPGeneralError as e:
+            self.receiver.outbox.clear()
+            self.fail( tftp.ERR_NOT_DEFINED, str( e ) )
+            return
+        except OSError:
+            self.receiver.outbox.clear()
+            self.fail( tftp.DISK_FULL_OR_ALLOC_EXC )
+            return
+        self.flush()
+        # Dally a while, in case our final ACK gets lost.
+        self.finished = True
+        self.deadline = time.monotonic() + DALLY_TIMEOUTS * self.timer.timeout
+        self.server.schedule( self )
+
+    def on_timeout( self, now: float ):
+        if self.finished:
+            self.close( True )
+            return
+        try:
+            self.receiver.on_timeout( now )
+        except TimeoutError:
+            self.fail( tftp.ERR_NOT_DEFINED, "Timeout" )
+            return
+        self.flush()
+        self.arm()
+
+    def close( self, completed: bool ):
+        if not self.closed:
+            self.retransmits += self.receiver.retransmits
+            if not self.finished:
+                self.file.close()
+                if os.path.isfile( self.partial ):
+                    os.remove( self.partial )
+        super().close( completed )
+
+###############################################################
+##                                                           ##
+##                          SERVER                           ##
+##                                                           ##
+###############################################################
+
+class Server:
+    """
+    A TFTP server of the files under 'root', running every transfer on
+    a single selectors event loop. Several of them, one per process, can
+    share the same port with 'reuse_port' (SO_REUSEPORT).
+    """
+
+    def __init__( self, root: str, host: str = "0.0.0.0", port: int = 69,
+                  max_blksize: int = tftp.MAX_BLKSIZE, max_windowsize: int = tftp.MAX_WINDOWSIZE,
+                  reuse_port: bool = False, verbose: bool = False,
+                  multicast: tftp.INET4Address | None = None ):
+        self.root = os.path.realpath( root )
+        self.host = host
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.verbose = verbose
+        self.multicast = multicast      # first group and port of the multicast sessions
+        self.selector = selectors.DefaultSelector()
+        self.sessions = 0
+        self.running = False
+        self._timers = []       # heap of ( deadline, sequence, session )
+        self._sequence = 0
+        self._maps = {}         # name => [ mmap, users, stat key ] of its current contents
+        self._multicasts = {}   # path => MulticastSession open to new clients
+        self._buffer = memoryview( bytearray( tftp.MAX_BLKSIZE + 4 ) )
+        self.sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        if reuse_port:
+            self.sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+        self.sock.bind( ( host, port ) )
+        self.sock.setblocking( False )
+        self.address = self.sock.getsockname()
+        self.selector.register( self.sock, selectors.EVENT_READ, None )
+
+    def serve_forever( self ):
+        self.running = True
+        try:
+            while self.running:
+                floNow = time.monotonic()
+                floWait = SELECT_INTERVAL
+                if self._timers:
+                    floWait = min( floWait, max( 0.0, self._timers[0][0] - floNow ) )
+                for key, _ in self.selector.select( floWait ):
+                    if key.data is None:
+                        self.on_request()
+                    else:
+                        self.on_readable( key.data )
+                self.run_timers( time.monotonic() )
+        finally:
+            self.close()
+
+    def shutdown( self ):
+        self.running = False
+
+    def close( self ):
+        for key in list( self.selector.get_map().values() ):
+            if key.data is not None:
+                key.data.close( False )
+        self.selector.close()
+        self.sock.close()
+
+    def schedule( self, session: Session ):
+        self._sequence += 1
+        heapq.heappush( self._timers, ( session.deadline, self._sequence, session ) )
+
+    def run_timers( self, now: float ):
+        while self._timers and self._timers[0][0] <= now:
+            floDeadline, _, session = heapq.heappop( self._timers )
+            # Entries left behind when a session was armed again are
+            # just dropped here.
+            if not session.closed and session.deadline == floDeadline:
+                session.on_timeout( now )
+
+    def unregister( self, session: Session, completed: bool ):
+        self.selector.unregister( session.sock )
+        self.sessions -= 1
+        if isinstance( session, ReadSession ):
+            self.release( session.mapping )
+        if self._multicasts.get( session.name ) is session:
+            del self._multicasts[session.name]
+        if self.verbose:
+            strStatus = "done" if completed else "failed"
+            print( f"{session.peer[0]}:{session.peer[1]} {session.name}: {strStatus}, "
+                   f"{session.retransmits} retransmissions.", flush=True )
+
+    def on_readable( self, session: Session ):
+        floNow = time.monotonic()
+        for _ in range( MAX_READS ):
+            try:
+                intSize, addr = session.sock.recvfrom_into( self._buffer )
+            except ( BlockingIOError, InterruptedError, ConnectionRefusedError ):
+                return
+            if not session.accepts( addr ):
+                session.sock.sendto( tftp.pack_err( tftp.UNKOWN_TRANSF_ID ), addr )
+                continue
+            if intSize >= 4:
+                session.on_datagram( self._buffer[:intSize], addr, floNow )
+            if session.closed:
+                return
+
+    def on_request( self ):
+        for _ in range( MAX_READS ):
+            try:
+                packet, addr = self.sock.recvfrom( tftp.DEFAULT_BUFFER_SIZE )
+            except ( BlockingIOError, InterruptedError, ConnectionRefusedError ):
+                return
+            if len( packet ) < 2:
+                self.sock.sendto( tftp.pack_err( tftp.ILLEGAL_TFTP_OP, "Packet too short" ), addr )
+                continue
+            try:
+                self.start_session( packet, addr )
+            except tftp.TFTPValueError as e:
+                self.sock.sendto( tftp.pack_err( tftp.ILLEGAL_TFTP_OP, str( e ) ), addr )
+            except ( ValueError, struct.error ):
+                # Whatever else a malformed request trips on.
+                self.sock.sendto( tftp.pack_err( tftp.ILLEGAL_TFTP_OP, "Malformed request" ), addr )
+            except FileNotFoundError:
+                self.sock.sendto( tftp.pack_err( tftp.ERR_FILE_NOT_FOUND ), addr )
+            except PermissionError:
+                self.sock.sendto( tftp.pack_err( tftp.ERR_ACCESS_VIOLATION ), addr )
+            except OSError as e:
+                if e.errno in ( errno.ENOSPC, errno.EDQUOT ):
+                    self.sock.sendto( tftp.pack_err( tftp.DISK_FULL_OR_ALLOC_EXC ), addr )
+                else:
+                    self.sock.sendto( tftp.pack_err( tftp.ERR_NOT_DEFINED, e.strerror ), addr )
+
+    def start_session( self, packet: bytes, addr: tftp.INET4Address ):
+        intOpcode = tftp.unpack_opcode( packet )
+        if intOpcode == tftp.RRQ:
+            strName, strMode = tftp.unpack_rrq( packet )
+        elif intOpcode == tftp.WRQ:
+            strName, strMode = tftp.unpack_wrq( packet )
+        else:
+            raise tftp.TFTPValueError( f"Invalid opcode {intOpcode}. Expecting a request." )
+        bolNetascii = tftp.check_mode( strMode ) == tftp.NETASCII_MODE
+        dicRequested = tftp.unpack_request_options( packet )
+        if self.verbose:
+            strVerb = "get" if intOpcode == tftp.RRQ else "put"
+            print( f"{addr[0]}:{addr[1]} {strVerb} {strName}", flush=True )
+        bolMulticast = ( intOpcode == tftp.RRQ and "multicast" in dicRequested and
+                         self.multicast is not None and strName != tftp.DIR_LISTING and not bolNetascii )
+        if bolMulticast and self.join_multicast( addr, strName, dicRequested ):
+            return
+        if intOpcode == tftp.RRQ:
+            data, lstMap = self.open( strName )
+            try:
+                intSize = len( data )
+                if bolNetascii and "tsize" in dicRequested:
+                    # The size on the wire, counted without keeping the
+                    # translation: the blocks are translated as sent.
+                    intSize = tftp.netascii_size( data )
+                intBlkSize, intWindowSize, dicOptions = self.negotiate( dicRequested, intSize )
+                if bolNetascii:
+                    dicOptions.pop( "compress", None )
+                if bolMulticast and len( data ) // intBlkSize < tftp.MAX_BLOCK_NUMBER:
+                    dicOptions.pop( "windowsize", None )
+                    dicOptions.pop( "compress", None )
+                    session = MulticastSession( self, addr, strName, intBlkSize, dicOptions, data,
+                                                self.multicast_group(), lstMap )
+                    self._multicasts[strName] = session
+                else:
+                    session = ReadSession( self, addr, strName, intBlkSize, intWindowSize, dicOptions,
+                                           data, lstMap, bolNetascii )
+            except:
+                data.release()
+                self.release( lstMap )
+                raise
+        else:
+            strPath = self.resolve( strName )
+            intBlkSize, intWindowSize, dicOptions = self.negotiate( dicRequested, None )
+            if bolNetascii:
+                dicOptions.pop( "compress", None )
+            session = WriteSession( self, addr, strName, intBlkSize, intWindowSize, dicOptions,
+                                    strPath, tftp.negotiated_tsize( dicOptions ), bolNetascii )
+        self.sessions += 1
+        self.selector.register( session.sock, selectors.EVENT_READ, session )
+        session.start()
+
+    def join_multicast( self, addr: tftp.INET4Address, name: str, requested: dict[str, str] ) -> bool:
+        """
+        This method adds a client to the multicast session already sending
+        the file, if any and if the client takes its block size.
+        """
+        session = self._multicasts.get( name )
+        if session is None:
+            return False
+        intBlkSize, _, dicOptions = self.negotiate( requested, session.size )
+        if intBlkSize < session.blksize:
+            return False
+        if "blksize" in dicOptions:
+            dicOptions["blksize"] = session.blksize
+        dicOptions.pop( "windowsize", None )
+        dicOptions.pop( "compress", None )
+        session.join( addr, dicOptions )
+        return True
+
+    def multicast_group( self ) -> tftp.INET4Address:
+        """
+        This method returns the group of a new multicast session: the one
+        configured, on the first port not taken by another session.
+        """
+        setPorts = { session.group[1] for session in self._multicasts.values() }
+        intPort = self.multicast[1]
+        while intPort in setPorts:
+            intPort += 1
+        return ( self.multicast[0], intPort )
+
+    def negotiate( self, requested: dict[str, str], size: int | None ) -> tuple[int, int, dict[str, int]]:
+        """
+        This method answers the options of a request (RFC 2347): the block
+        and window sizes are capped by ours, tsize is the size of the file
+        on a RRQ and echoed on a WRQ, and compress, ours, is taken when we
+        know the compression asked for. Other options are left out.
+        """
+        dicOptions = {}
+        intBlkSize = tftp.MAX_DATA_LEN
+        intWindowSize = tftp.DEFAULT_WINDOWSIZE
+        try:
+            if "blksize" in requested:
+                intBlkSize = min( int( requested["blksize"] ), self.max_blksize )
+                tftp.check_blksize( intBlkSize )
+                dicOptions["blksize"] = intBlkSize
+            if "windowsize" in requested:
+                intWindowSize = min( int( requested["windowsize"] ), self.max_windowsize )
+                tftp.check_windowsize( intWindowSize )
+                dicOptions["windowsize"] = intWindowSize
+            if "tsize" in requested:
+                dicOptions["tsize"] = int( requested["tsize"] ) if size is None else size
+            if requested.get( "compress" ) in tftp.COMPRESSIONS:
+                dicOptions["compress"] = requested["compress"]
+        except ValueError:
+            raise tftp.TFTPValueError( f"Invalid options: {requested}" )
+        return intBlkSize, intWindowSize, dicOptions
+
+    def resolve( self, name: str ) -> str:
+        """
+        This method maps a requested name to a path under the root,
+        refusing anything outside of it.
+        """
+        strPath = os.path.realpath( os.path.join( self.root, name.lstrip( "/\\" ) ) )
+        if os.path.commonpath( [ strPath, self.root ] ) != self.root or strPath == self.root:
+            raise PermissionError( name )
+        return strPath
+
+    def open( self, name: str ) -> tuple[memoryview, list | None]:
+        """
+        This method returns the contents of a file to be read as a view
+        of its memory map, shared by every session reading the same file,
+        or of the listing when it is the dir.txt, along with the entry of
+        the map, to be given to release() once the view is released. A
+        file replaced is mapped anew, the sessions reading the old one
+        keeping theirs.
+        """
+        if name == tftp.DIR_LISTING:
+            return memoryview( self.listing() ), None
+        strPath = self.resolve( name )
+        stat = os.stat( strPath )
+        tupKey = ( stat.st_ino, stat.st_mtime_ns, stat.st_size )
+        lstMap = self._maps.get( name )
+        if lstMap is None or lstMap[2] != tupKey:
+            if stat.st_size == 0:
+                # Empty files cannot be mapped.
+                return memoryview( b"" ), None
+            with open( strPath, "rb" ) as file:
+                lstMap = [ mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ ), 0, tupKey ]
+            self._maps[name] = lstMap
+        lstMap[1] += 1
+        return memoryview( lstMap[0] ), lstMap
+
+    def release( self, mapping: list | None ):
+        if mapping is None:
+            return
+        mapping[1] -= 1
+        if mapping[1] <= 0:
+            for strName, lstMap in list( self._maps.items() ):
+                if lstMap is mapping:
+                    del self._maps[strName]
+            mapping[0].close()
+
+    def listing( self ) -> bytes:
+        """
+        This method lists the files under the root in three columns:
+        name, modification time and size.
+        """
+        lstLines = []
+        with os.scandir( self.root ) as entries:
+            for entry in sorted( entries, key=lambda entry: entry.name ):
+                if not entry.is_file() or entry.name.startswith( "." ):
+                    continue
+                stat = entry.stat()
+                strDate = time.strftime( "%Y-%m-%dT%H:%M:%S", time.localtime( stat.st_mtime ) )
+                lstLines.append( f"{entry.name}\t{strDate}\t{stat.st_size}\n" )
+        return "".join( lstLines ).encode()
+
+###############################################################
+##                                                           ##
+##                          WORKERS                          ##
+##                                                           ##
+###############################################################
+
+def serve( root: str, host: str, port: int, workers: int, max_blksize: int,
+           max_windowsize: int, verbose: bool, multicast: tftp.INET4Address | None = None ):
+    """
+    This method serves 'root' from 'workers' processes, all of them
+    bound to the same port: the kernel spreads the requests among them.
+    """
+    if workers == 1:
+        Server( root, host, port, max_blksize, max_windowsize, False, verbose,
+                multicast ).serve_forever()
+        return
+    lstWorkers = [ multiprocessing.Process( target=serve_worker, daemon=True,
+                                            args=( root, host, port, max_blksize, max_windowsize,
+                                                   verbose, multicast ) )
+                   for _ in range( workers ) ]
+    for worker in lstWorkers:
+        worker.start()
+    try:
+        for worker in lstWorkers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in lstWorkers:
+            worker.terminate()
+
+def serve_worker( root: str, host: str, port: int, max_blksize: int, max_windowsize: int,
+                  verbose: bool, multicast: tftp.INET4Address | None = None ):
+    try:
+        Server( root, host, port, max_blksize, max_windowsize, True, verbose,
+                multicast ).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+
+    parse = argparse.ArgumentParser(
+        prog="server.py",
+        description="Servidor TFTP Piranha.",
+        epilog="Copyright (C) 2024 Erick Mattos <erick.mattos@gmail.com>" )
+    parse.add_argument( "-p", "--port", default=69, type=int, help="Porta do servidor." )
+    parse.add_argument( "-H", "--host", default="0.0.0.0", help="Endereço a escutar." )
+    parse.add_argument( "-n", "--workers", default=1, type=int,
+                        help="Processos a servir o mesmo porto (0: um por CPU)." )
+    parse.add_argument( "-b", "--max-blksize", default=tftp.MAX_BLKSIZE, type=int,
+                        help="Tamanho máximo dos blocos de dados." )
+    parse.add_argument( "-w", "--max-windowsize", default=tftp.MAX_WINDOWSIZE, type=int,
+                        help="Número máximo de blocos enviados antes de cada ACK." )
+    parse.add_argument( "-m", "--multicast", metavar="GRUPO:PORTA",
+                        help="Servir por multicast (RFC 2090) os clientes que o pedirem." )
+    parse.add_argument( "-v", "--verbose", action="store_true", help="Mostrar as transferências." )
+    parse.add_argument( "ROOT", help="Diretório a servir." )
+    args = parse.parse_args()
+
+    if not os.path.isdir( args.ROOT ):
+        print( f"Directory '{args.ROOT}' not found." )
+        sys.exit(1)
+    try:
+        tftp.check_blksize( args.max_blksize )
+        tftp.check_windowsize( args.max_windowsize )
+    except tftp.TFTPValueError as e:
+        print( e )
+        sys.exit(1)
+    tupMulticast = None
+    if args.multicast:
+        strGroup, _, strPort = args.multicast.rpartition( ":" )
+        try:
+            tupMulticast = ( strGroup, int( strPort ) )
+            if not socket.inet_aton( strGroup )[0] & 0xF0 == 0xE0:
+                raise ValueError
+        except ( ValueError, OSError ):
+            print( f"Invalid multicast group: {args.multicast}" )
+            sys.exit(1)
+    intWorkers = args.workers or os.cpu_count() or 1
+    if intWorkers > 1 and not hasattr( socket, "SO_REUSEPORT" ):
+        print( "Several workers need SO_REUSEPORT, not available here." )
+        sys.exit(1)
+    try:
+        serve( args.ROOT, args.host, args.port, intWorkers, args.max_blksize,
+               args.max_windowsize, args.verbose, tupMulticast )
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print( e )
+        sys.exit(1)
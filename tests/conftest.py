@@ -0,0 +1,34 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The modules live at the top of the repository, with no package around.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """
+    Starts a server.Server on loopback, on a port of its own, serving a
+    fresh root: serve(**kwargs) returns it, with the arguments given to
+    it or to a subclass of it in 'cls'.
+    """
+    servers = []
+
+    def start(cls=server.Server, **kwargs):
+        root = tmp_path / f"root{len(servers)}"
+        root.mkdir()
+        tftpd = cls(str(root), "127.0.0.1", 0, **kwargs)
+        thread = threading.Thread(target=tftpd.serve_forever, daemon=True)
+        thread.start()
+        servers.append((tftpd, thread))
+        return tftpd
+
+    yield start
+    for tftpd, thread in servers:
+        tftpd.shutdown()
+        thread.join()
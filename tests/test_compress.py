@@ -0,0 +1,142 @@
+"""
+The 'compress' option, end to end against a server.Server on loopback:
+files must come out whole both ways, with either compression or, when
+the server leaves the option out, with none, and a compressed stream
+cut short must never make a file.
+"""
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+
+import pytest
+
+import server
+import tftp
+
+
+def make_file(path, size, seed=0):
+    # Half text, that compresses, half noise, that does not.
+    rand = random.Random(seed)
+    data = b''.join(b'line %d of the file\n' % i for i in range(size // 40))
+    data = (data + rand.randbytes(size))[:size]
+    path.write_bytes(data)
+    return data
+
+class PlainServer(server.Server):
+    """A server that does not know the option: its OACK leaves it out."""
+
+    def negotiate(self, requested, size):
+        requested = {key: value for key, value in requested.items() if key != 'compress'}
+        return super().negotiate(requested, size)
+
+
+@pytest.mark.parametrize('compress', tftp.COMPRESSIONS)
+@pytest.mark.parametrize('windowsize', [1, 8])
+def test_get(serve, tmp_path, compress, windowsize):
+    tftpd = serve()
+    data = make_file(tmp_path / 'root0' / 'file.bin', 300000)
+    result = tftp.get_file(tftpd.address[1], '127.0.0.1', '127.0.0.1', 'file.bin',
+                           str(tmp_path / 'copy.bin'), 1024, windowsize, verbose=False,
+                           compress=compress)
+    assert (tmp_path / 'copy.bin').read_bytes() == data
+    assert result.compression == compress
+    assert result.size == len(data)
+    assert result.wire < result.size
+
+@pytest.mark.parametrize('compress', tftp.COMPRESSIONS)
+@pytest.mark.parametrize('windowsize', [1, 8])
+def test_put(serve, tmp_path, compress, windowsize):
+    tftpd = serve()
+    data = make_file(tmp_path / 'file.bin', 300000)
+    result = tftp.put_file(tftpd.address[1], '127.0.0.1', '127.0.0.1', str(tmp_path / 'file.bin'),
+                           'copy.bin', 1024, windowsize, verbose=False, compress=compress)
+    assert (tmp_path / 'root0' / 'copy.bin').read_bytes() == data
+    assert result.compression == compress
+    assert result.wire < result.size
+
+def test_get_fallback(serve, tmp_path):
+    tftpd = serve(PlainServer)
+    data = make_file(tmp_path / 'root0' / 'file.bin', 100000)
+    result = tftp.get_file(tftpd.address[1], '127.0.0.1', '127.0.0.1', 'file.bin',
+                           str(tmp_path / 'copy.bin'), 1024, 4, verbose=False, compress='zlib')
+    assert (tmp_path / 'copy.bin').read_bytes() == data
+    assert result.compression is None
+    assert result.wire == result.size == len(data)
+
+def test_put_fallback(serve, tmp_path):
+    tftpd = serve(PlainServer)
+    data = make_file(tmp_path / 'file.bin', 100000)
+    result = tftp.put_file(tftpd.address[1], '127.0.0.1', '127.0.0.1', str(tmp_path / 'file.bin'),
+                           'copy.bin', 1024, 4, verbose=False, compress='lzma')
+    assert (tmp_path / 'root0' / 'copy.bin').read_bytes() == data
+    assert result.compression is None
+    assert result.wire == result.size == len(data)
+
+def test_put_truncated(serve, tmp_path):
+    # A client sends a zlib stream without its end: the server must
+    # answer with an error, not an ACK, and leave no file behind.
+    tftpd = serve()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    try:
+        sock.sendto(tftp.pack_wrq('cut.bin', options={'compress': 'zlib'}), tftpd.address)
+        packet, addr = sock.recvfrom(1024)
+        assert tftp.unpack_opcode(packet) == tftp.OACK
+        assert tftp.unpack_oack(packet) == {'compress': 'zlib'}
+        stream = zlib.compress(b'some data that never ends ' * 10)
+        sock.sendto(tftp.pack_dat(1, stream[:-4]), addr)
+        packet, addr = sock.recvfrom(1024)
+        assert tftp.unpack_opcode(packet) == tftp.ERR
+    finally:
+        sock.close()
+    # The partial file goes right after the ERR.
+    deadline = time.monotonic() + 5
+    while os.listdir(tmp_path / 'root0') and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not os.listdir(tmp_path / 'root0')
+
+def test_get_truncated(tmp_path):
+    # A server sends a zlib stream without its end: the download fails.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    answers = []
+
+    def answer():
+        _, addr = sock.recvfrom(1024)
+        sock.sendto(tftp.pack_oack({'compress': 'zlib'}), addr)
+        sock.recvfrom(1024)
+        stream = zlib.compress(b'some data that never ends ' * 10)
+        sock.sendto(tftp.pack_dat(1, stream[:-4]), addr)
+        answers.append(sock.recvfrom(1024)[0])
+
+    thread = threading.Thread(target=answer, daemon=True)
+    thread.start()
+    try:
+        with pytest.raises(tftp.TFTPGeneralError):
+            tftp.get_file(sock.getsockname()[1], '127.0.0.1', '127.0.0.1', 'cut.bin',
+                          str(tmp_path / 'cut.bin'), verbose=False, compress='zlib')
+    finally:
+        thread.join()
+        sock.close()
+
+def test_decompressor_truncated():
+    for name in tftp.COMPRESSIONS:
+        engine = tftp.new_compressor(name)
+        stream = engine.compress(bytes(100000)) + engine.flush()
+        decompressor = tftp.Decompressor(name)
+        assert sum(len(chunk) for chunk in decompressor.decompress(stream[:len(stream) // 2])) < 100000
+        with pytest.raises(tftp.TFTPGeneralError):
+            decompressor.flush()
+        # Data past the end, in the same block as the end or after it.
+        decompressor = tftp.Decompressor(name)
+        with pytest.raises(tftp.TFTPGeneralError):
+            list(decompressor.decompress(stream + b'more'))
+        decompressor = tftp.Decompressor(name)
+        assert sum(len(chunk) for chunk in decompressor.decompress(stream)) == 100000
+        decompressor.flush()
+        with pytest.raises(tftp.TFTPGeneralError):
+            list(decompressor.decompress(b'more'))
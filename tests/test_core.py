@@ -0,0 +1,140 @@
+"""
+The transfer state machines, Sender against Receiver, driven by a
+MemoryTransport: whatever the network does, the bytes delivered must be
+the ones sent, in order, and both ends must be done.
+"""
+import io
+import random
+
+import pytest
+
+import tftp
+
+
+def make_data(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+def transfer(data, blksize=512, windowsize=1, transport=None):
+    sender = tftp.Sender(tftp.RingSource(io.BytesIO(data).readinto, blksize, windowsize),
+                         blksize, windowsize, now=0.0)
+    receiver = tftp.Receiver(blksize, windowsize, now=0.0)
+    received = bytearray()
+    transport = transport if transport is not None else tftp.MemoryTransport(rtt=0.01)
+    elapsed = transport.run(sender, receiver, received.extend)
+    assert sender.done and receiver.done
+    assert bytes(received) == data
+    assert receiver.size == sender.size == len(data)
+    return sender, receiver, elapsed
+
+class DropOnce(tftp.MemoryTransport):
+    """Loses the first DAT of block 'block', and nothing else."""
+    __slots__ = ('block', 'dropped')
+
+    def __init__(self, block, rtt=0.01):
+        super().__init__(rtt)
+        self.block = block
+        self.dropped = False
+
+    def deliver(self, outbox):
+        arrived = []
+        for packet in outbox:
+            opcode, number = tftp._HEADER.unpack_from(packet)
+            if opcode == tftp.DAT and number == self.block and not self.dropped:
+                self.dropped = True
+                continue
+            arrived.append(packet)
+        return arrived
+
+
+@pytest.mark.parametrize('windowsize', [1, 4, 16])
+@pytest.mark.parametrize('size', [0, 1, 511, 512, 513, 4096, 100000])
+def test_clean(size, windowsize):
+    sender, receiver, _ = transfer(make_data(size), windowsize=windowsize)
+    assert sender.retransmits == 0
+    assert receiver.received == size // 512 + 1
+
+@pytest.mark.parametrize('windowsize', [1, 4, 16])
+@pytest.mark.parametrize('seed', range(5))
+def test_loss(windowsize, seed):
+    transfer(make_data(200000, seed), windowsize=windowsize,
+             transport=tftp.MemoryTransport(rtt=0.01, loss=0.2, seed=seed))
+
+@pytest.mark.parametrize('windowsize', [1, 4, 16])
+def test_duplicates(windowsize):
+    sender, receiver, _ = transfer(make_data(100000), windowsize=windowsize,
+                                   transport=tftp.MemoryTransport(rtt=0.01, seed=1, duplicate=0.3))
+    assert sender.duplicates + receiver.duplicates > 0
+    if windowsize == 1:
+        # No Sorcerer's Apprentice: a duplicate ACK sends nothing again.
+        assert sender.retransmits == 0
+
+@pytest.mark.parametrize('windowsize', [2, 4, 16])
+def test_reorder(windowsize):
+    transfer(make_data(100000), windowsize=windowsize,
+             transport=tftp.MemoryTransport(rtt=0.01, seed=2, reorder=0.3))
+
+def test_everything_at_once():
+    transfer(make_data(100000), windowsize=8,
+             transport=tftp.MemoryTransport(rtt=0.01, loss=0.1, seed=3, duplicate=0.1, reorder=0.1))
+
+@pytest.mark.parametrize('windowsize', [1, 8])
+def test_rollover(windowsize):
+    # Past 65535 blocks the block numbers wrap around to 0.
+    data = make_data(8 * (tftp.MAX_BLOCK_NUMBER + 1000))
+    sender, receiver, _ = transfer(data, blksize=8, windowsize=windowsize,
+                                   transport=tftp.MemoryTransport(loss=0.01, seed=4))
+    assert receiver.received > tftp.MAX_BLOCK_NUMBER
+
+def test_window_go_back():
+    # Block 2 of the first window gets lost: the receiver acknowledges
+    # block 1 and the sender goes back to 2 at once, with no timeout.
+    transport = DropOnce(2)
+    sender, receiver, elapsed = transfer(make_data(512 * 40), windowsize=4, transport=transport)
+    assert transport.dropped
+    assert sender.retransmits > 0
+    assert elapsed < tftp.INITIAL_TIMEOUT
+
+def test_last_ack_lost():
+    # Only a timeout tells the sender that the final ACK got lost; the
+    # receiver, done, acknowledges the last block again.
+    class DropLastAck(tftp.MemoryTransport):
+        __slots__ = ('dropped',)
+
+        def deliver(self, outbox):
+            if not self.dropped and outbox and tftp._HEADER.unpack_from(outbox[-1]) == (tftp.ACK, 3):
+                self.dropped = True
+                return outbox[:-1]
+            return outbox
+
+    transport = DropLastAck(rtt=0.01)
+    transport.dropped = False
+    transfer(make_data(1200), transport=transport)
+    assert transport.dropped
+
+@pytest.mark.parametrize('seed', range(3))
+def test_timeout_comes_back_after_loss(seed):
+    # Karn's algorithm keeps resent windows from being sampled: the
+    # timeout, backed off along a lossy stretch, must come back down
+    # from the estimates once blocks flow again, or every later loss
+    # costs MAX_TIMEOUT (the transfer below took 25 to 45 s that way).
+    _, _, elapsed = transfer(make_data(200000), windowsize=16,
+                             transport=tftp.MemoryTransport(rtt=0.01, loss=0.2, seed=seed))
+    assert elapsed < 15
+
+def test_timer_restore():
+    timer = tftp.RetransmissionTimer()
+    timer.restore()
+    assert timer.timeout == tftp.INITIAL_TIMEOUT
+    timer.sample(0.1)
+    expected = timer.timeout
+    for _ in range(10):
+        timer.backoff()
+    assert timer.timeout == tftp.MAX_TIMEOUT
+    timer.restore()
+    assert timer.timeout == expected
+
+def test_gives_up():
+    sender = tftp.Sender(tftp.RingSource(io.BytesIO(bytes(1000)).readinto, 512, 1), now=0.0)
+    receiver = tftp.Receiver(now=0.0)
+    with pytest.raises(TimeoutError):
+        tftp.MemoryTransport(loss=1.0, seed=6).run(sender, receiver)
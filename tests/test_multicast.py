@@ -0,0 +1,61 @@
+"""
+Multicast downloads (RFC 2090) against a server.Server on loopback: a
+master client and one that joins the session late, once blocks are
+already going to the group, must both end up with the whole file.
+"""
+import random
+import threading
+
+import server
+import tftp
+
+
+class JoinServer(server.Server):
+    """Counts the clients that joined a multicast session already open."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.joined = 0
+
+    def join_multicast(self, addr, name, requested):
+        joined = super().join_multicast(addr, name, requested)
+        self.joined += joined
+        return joined
+
+
+def test_late_joiner(serve, tmp_path):
+    group = ('239.255.%d.%d' % (random.randrange(256), random.randrange(1, 255)),
+             random.randrange(20000, 60000))
+    tftpd = serve(JoinServer, multicast=group)
+    data = random.Random(7).randbytes(8 * 1024 * 1024)
+    (tmp_path / 'root0' / 'image.bin').write_bytes(data)
+    port = tftpd.address[1]
+    results = {}
+    errors = []
+
+    def get(name):
+        try:
+            results[name] = tftp.get_multicast(port, '127.0.0.1', '127.0.0.1', 'image.bin',
+                                               str(tmp_path / name), 512, verbose=False,
+                                               progress=progress if name == 'master.bin' else None)
+        except Exception as e:
+            errors.append(e)
+
+    late = threading.Thread(target=get, args=('late.bin',))
+
+    def progress(report):
+        # The session is open and sending: time for another client.
+        if not late.is_alive() and late.ident is None and 0 < report.size < len(data) // 2:
+            late.start()
+
+    master = threading.Thread(target=get, args=('master.bin',))
+    master.start()
+    master.join(60)
+    if late.ident is not None:
+        late.join(60)
+    assert not errors
+    assert late.ident is not None, 'the master finished before anyone could join'
+    assert tftpd.joined == 1
+    for name in ('master.bin', 'late.bin'):
+        assert results[name].size == len(data)
+        assert (tmp_path / name).read_bytes() == data
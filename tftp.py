@@ -18,10 +18,24 @@
 # On Debian systems, the complete text of the GNU General
 # Public License can be found in `/usr/share/common-licenses/GPL-3'.
 
+import asyncio
+import collections
+import errno
+import hashlib
+import io
+import json
+import lzma
 import os
+import random
+import shutil
 import socket
 import string
 import struct
+import sys
+import threading
+import time
+import zlib
+from collections.abc import Awaitable, Callable, Iterator
 
 if os.name == 'nt':
     import msvcrt
@@ -30,6 +44,8 @@ if os.name == 'nt':
     class _CursorInfo(ctypes.Structure):
         _fields_ = [("size", ctypes.c_int),
                     ("visible", ctypes.c_byte)]
+else:
+    import fcntl
 
 ###############################################################
 ##                                                           ##
@@ -39,12 +55,49 @@ if os.name == 'nt':
 
 MAX_ATTEMPTS        = 5               # bytes    
 MAX_DATA_LEN        = 512             # bytes    
-MAX_BLOCK_NUMBER    = 2**16 -1        # 0..65535
+MIN_BLKSIZE         = 8               # bytes (RFC 2348)
+MAX_BLKSIZE         = 65464           # bytes (RFC 2348)
+DEFAULT_MTU         = 1500            # bytes, Ethernet
+IP_UDP_TFTP_HEADERS = 20 + 8 + 4      # bytes, IPv4 + UDP + DAT headers
+IPV6_EXTRA_HEADER   = 20              # bytes, of the IPv6 header over IPv4's
+MAX_BLOCK_NUMBER    = 2**16 -1        # 0..65535, then rolls over to 0
 INACTIVITY_TIMEOUT  = 25.0            # segs
+INITIAL_TIMEOUT     = 1.0             # segs, until a round trip is measured
+MIN_TIMEOUT         = 0.05            # segs
+MAX_TIMEOUT         = INACTIVITY_TIMEOUT / MAX_ATTEMPTS
+DEFAULT_WINDOWSIZE  = 1               # blocks, lock-step as in RFC 1350
+MAX_WINDOWSIZE      = 65535           # blocks (RFC 7440)
 DEFAULT_MODE        = 'octet'
+NETASCII_MODE       = 'netascii'      # text, lines ending in CR LF on the wire
+NETASCII_CHUNK      = 2**16           # bytes of text translated at a time
 DEFAULT_BUFFER_SIZE = 8192            # bytes
+PROGRESS_INTERVAL   = 0.1             # segs between progress reports, at least
+CONSOLE_INTERVAL    = 0.25            # segs between redraws of the status line
+STREAM_BUFFER_SIZE  = 2**20           # bytes held for a slow consumer of a stream
+IO_BUFFER_SIZE      = 2**23           # bytes held, at most, between a transfer and the disk
+IO_CHUNK_SIZE       = 2**20           # bytes written or read from the disk at a time
+BURST_TIME          = 0.1             # segs of its rate a token bucket holds
+MIN_BURST           = 2**16           # bytes a token bucket holds, at least
+INITIAL_CWND        = 2.0             # blocks per round trip at the start of an upload
+RESOLVER_TTL        = 300.0           # segs a name or address resolved is kept
+PROBE_TIMEOUT       = 1.0             # segs waited for the servers probed to answer
+PROBE_ATTEMPTS      = 2               # probes sent to each server
+POOLED_ENDPOINTS    = 16              # sockets kept open between transfers by an EndpointPool
+DIGESTS             = ('sha256', 'blake2b', 'crc32')
+COMPRESSIONS        = ('zlib', 'lzma')  # of the 'compress' option, an extension of ours
+COMPRESS_CHUNK      = 2**16           # bytes compressed, or given decompressed, at a time
+ZLIB_LEVEL          = 6
+LZMA_PRESET         = 2               # light on memory: a server runs one per transfer
+SIDECAR_SUFFIX      = '.sha256'       # of the file with the digest of another, as sha256sum writes
+DIR_LISTING         = 'dir.txt'       # listing of the server: name, date and size
+CACHE_SIZE          = 2**32           # bytes kept in a content cache, at most
+CACHE_TTL           = 3600.0          # segs a file not in the listing is cached
+LISTING_TTL         = 5.0             # segs the listing of a server is trusted by a cache
+FICLONE             = 0x40049409      # ioctl sharing the data of a file (reflink), Linux
 INET4Address        = tuple[str, int] # TCP/UDP address => IPv4 and port
 
+_LOCAL_NEWLINE = os.linesep.encode()
+
 
 # TFTP message opcodes
 RRQ = 1 # Read Request
@@ -58,6 +111,20 @@ ERR = 5 # Error packet: what the server responds if a read/write
         # numeric error code, followed by and ASCII error message that
         # might contain additional, operating system specific 
         # information.
+OACK = 6 # Option Acknowledgment (RFC 2347): the server answers a
+         # RRQ/WRQ carrying options with the subset of them it accepts.
+
+# Precompiled layouts of the fixed part of the packets: the opcode and
+# the block number (DAT, ACK) or error code (ERR) that follows it.
+_OPCODE = struct.Struct('!H')
+_HEADER = struct.Struct('!HH')
+
+# A packet in a binary trace: time, transfer, direction, opcode, block
+# number (or error code), length and port of the peer.
+TRACE_RECORD = struct.Struct('<dIBBHIH')
+TRACE_OUT  = 0 # a packet sent
+TRACE_IN   = 1 # a packet received
+TRACE_META = 2 # the start of a transfer, described in JSON
 
 ERR_NOT_DEFINED        = 0
 ERR_FILE_NOT_FOUND     = 1 
@@ -67,6 +134,7 @@ ILLEGAL_TFTP_OP        = 4
 UNKOWN_TRANSF_ID       = 5
 FILE_ALREADY_EXISTS    = 6
 NO_SUCH_USER           = 7
+OPTION_NEGOTIATION_ERR = 8
 
 ERROR_MESSAGES = {
     ERR_NOT_DEFINED: 'Not defined, see error message(if any).',
@@ -76,7 +144,8 @@ ERROR_MESSAGES = {
     ILLEGAL_TFTP_OP: 'Illegal TFTP operation',
     UNKOWN_TRANSF_ID: 'Unkown Transfer ID',
     FILE_ALREADY_EXISTS: 'File already exists',
-    NO_SUCH_USER: 'No such user'
+    NO_SUCH_USER: 'No such user',
+    OPTION_NEGOTIATION_ERR: 'Option negotiation refused'
 }
 
 ###############################################################
@@ -85,42 +154,143 @@ ERROR_MESSAGES = {
 ##                                                           ##
 ###############################################################
 
+class Resolver:
+    """
+    Name resolution through getaddrinfo, keeping every address of a name
+    (its A and AAAA records, in the order of preference of the system),
+    with the answers cached for 'ttl' seconds: in this process and, given
+    a 'path', in a JSON file for the next runs as well. Reverse lookups
+    can be turned off with 'reverse', as they are often the slow ones.
+    """
+
+    def __init__(self, ttl: float = RESOLVER_TTL, path: str | None = None, reverse: bool = True):
+        self.ttl = ttl
+        self.path = path
+        self.reverse = reverse
+        self.hits = 0
+        self.misses = 0
+        self._names = {}    # name => [ expiry, [ addresses ] ]
+        self._hosts = {}    # address => [ expiry, name or None ]
+        if path is not None:
+            self.load()
+
+    def resolve(self, name: str) -> list[str]:
+        """
+        This method returns the addresses of 'name', the first one to be
+        tried first, or an empty list when it cannot be resolved.
+        """
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, name)
+                # An address already, not worth caching.
+                return [name]
+            except (OSError, UnicodeError):
+                pass
+        addresses = self._cached(self._names, name)
+        if addresses is not None:
+            return addresses
+        try:
+            addresses = []
+            for family, _, _, _, sockaddr in socket.getaddrinfo(name, None, type=socket.SOCK_DGRAM):
+                if family in (socket.AF_INET, socket.AF_INET6) and sockaddr[0] not in addresses:
+                    addresses.append(sockaddr[0])
+        except (OSError, UnicodeError):
+            # keep quiet! Failures are not cached.
+            return []
+        self._store(self._names, name, addresses)
+        return addresses
+
+    def host(self, ip: str) -> str | None:
+        """
+        This method returns the name of an address, or None when it has
+        none or reverse lookups are off.
+        """
+        if not self.reverse:
+            return None
+        name = self._cached(self._hosts, ip)
+        if name is not None:
+            return name or None
+        try:
+            name = socket.gethostbyaddr(ip)[0]
+        except (OSError, UnicodeError):
+            name = ''
+        self._store(self._hosts, ip, name)
+        return name or None
+
+    def _cached(self, table: dict, key: str):
+        entry = table.get(key)
+        if entry is not None and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def _store(self, table: dict, key: str, value):
+        # Wall clock time, as the expiry outlives the process on disk.
+        table[key] = [time.time() + self.ttl, value]
+        if self.path is not None:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, 'rt') as file:
+                data = json.load(file)
+            now = time.time()
+            self._names = {name: entry for name, entry in data.get('names', {}).items() if entry[0] > now}
+            self._hosts = {ip: entry for ip, entry in data.get('hosts', {}).items() if entry[0] > now}
+        except (OSError, ValueError, TypeError, AttributeError, IndexError):
+            # No cache yet, or a broken one: start over.
+            self._names = {}
+            self._hosts = {}
+
+    def save(self):
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(temporary, 'wt') as file:
+                json.dump({'names': self._names, 'hosts': self._hosts}, file)
+            os.replace(temporary, self.path)
+        except OSError:
+            # A cache that cannot be written is just not kept.
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+# Shared by getIP() and getHost().
+resolver = Resolver()
+
 def getIP(d):
     """
     This method takes a FQDN and translates it to the 
     first IP found.
     """
-    try:
-        data = socket.gethostbyname(d)
-        ip = repr(data)
-        return ip
-    except Exception:
-        # keep quiet!
+    addresses = resolver.resolve(d)
+    if not addresses:
         return None
+    return repr(addresses[0])
 
 def getHost(ip):
     """
     This method takes an IP and returns the Domain Name
     associated to it.
     """
-    try:
-        data = socket.gethostbyaddr(ip)
-        host = repr(data[0])
-        return host
-    except Exception:
-        # keep quiet!
+    host = resolver.host(ip)
+    if host is None:
         return None
+    return repr(host)
 
-def hide_cursor():
+def hide_cursor(stream=None):
+    stream = stream or sys.stdout
     if os.name == "nt":
         ci = _CursorInfo()
         handle = ctypes.windll.kernel32.GetStdHandle(-11)
         ctypes.windll.kernel32.GetConsoleCursorInfo(handle, ctypes.byref(ci))
         ci.visible = False
         ctypes.windll.kernel32.SetConsoleCursorInfo(handle, ctypes.byref(ci))
-    elif os.name == "posix":
-        sys.stdout.write("\033[?25l")
-        sys.stdout.flush()
+    elif os.name == "posix" and stream.isatty():
+        stream.write("\033[?25l")
+        stream.flush()
 
 def is_ascii_printable(txt: str) -> bool:
     return set(txt).issubset(string.printable)
@@ -131,16 +301,943 @@ def logit(code: int, message: str, clean: bool):
               end="\r", flush=True)
     print( message, end="\r", flush=True)
 
-def show_cursor():
+def show_cursor(stream=None):
+    stream = stream or sys.stdout
     if os.name == "nt":
         ci = _CursorInfo()
         handle = ctypes.windll.kernel32.GetStdHandle(-11)
         ctypes.windll.kernel32.GetConsoleCursorInfo(handle, ctypes.byref(ci))
         ci.visible = True
         ctypes.windll.kernel32.SetConsoleCursorInfo(handle, ctypes.byref(ci))
-    elif os.name == "posix":
-        sys.stdout.write("\033[?25h")
-        sys.stdout.flush()
+    elif os.name == "posix" and stream.isatty():
+        stream.write("\033[?25h")
+        stream.flush()
+
+###############################################################
+##                                                           ##
+##                TRANSFER TIMERS AND RESULTS                ##
+##                                                           ##
+###############################################################
+
+class RetransmissionTimer:
+    """
+    The retransmission timeout of a transfer, worked out from the round
+    trips measured along it as TCP does (RFC 6298): smoothed RTT and RTT
+    variation, doubled on every timeout and kept within MIN_TIMEOUT and
+    MAX_TIMEOUT. Round trips of retransmitted packets must not be sampled
+    (Karn's algorithm), so the backed off timeout is taken back by
+    restore(), from the estimates so far, once the transfer makes
+    progress again (RFC 6298, 5.7): else a lossy path, where windows
+    are resent often, would keep it at MAX_TIMEOUT.
+    """
+    __slots__ = ('rtt', 'srtt', 'rttvar', 'timeout')
+
+    def __init__(self, timeout: float = INITIAL_TIMEOUT):
+        self.rtt = None
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = timeout
+
+    def sample(self, rtt: float):
+        self.rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, MIN_TIMEOUT), MAX_TIMEOUT)
+
+    def backoff(self):
+        self.timeout = min(self.timeout * 2, MAX_TIMEOUT)
+
+    def restore(self):
+        if self.srtt is None:
+            self.timeout = min(self.timeout, INITIAL_TIMEOUT)
+        else:
+            self.timeout = min(max(self.srtt + 4 * self.rttvar, MIN_TIMEOUT), MAX_TIMEOUT)
+
+class TokenBucket:
+    """
+    A token bucket of 'rate' bytes/s, holding up to 'burst' bytes
+    (BURST_TIME worth of its rate, and MIN_BURST at least, by default).
+    Instead of waiting for the tokens, charge() takes them on credit and
+    tells how long to wait until they are paid back, so transfers sharing
+    a bucket go in the order they ask and none of them starves.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float | None = None):
+        if rate <= 0:
+            raise TFTPValueError(f'Invalid rate: {rate}')
+        self.rate = rate
+        self.burst = burst or max(rate * BURST_TIME, MIN_BURST)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def charge(self, size: int, now: float) -> float:
+        self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.burst) - size
+        self.stamp = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class WindowControl:
+    """
+    The AIMD control of an upload: 'cwnd' blocks per round trip, doubled
+    every round trip up to 'ssthresh' (slow start), then grown by a block
+    per round trip while nothing is lost; halved on a duplicate ACK and
+    set back to a block on a timeout. A TFTP receiver only acknowledges
+    whole windows (RFC 7440), so the window negotiated, 'limit', is always
+    sent whole and 'cwnd' paces it instead, a block every srtt/cwnd while
+    it is below the window.
+    """
+    __slots__ = ('cwnd', 'ssthresh', 'limit', 'due')
+
+    def __init__(self, limit: int):
+        self.cwnd = min(INITIAL_CWND, limit)
+        self.ssthresh = float(limit)
+        self.limit = limit
+        self.due = 0.0
+
+    def acked(self, blocks: int):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += blocks
+        else:
+            self.cwnd += blocks / self.cwnd
+        self.cwnd = min(self.cwnd, self.limit)
+
+    def lost(self):
+        self.ssthresh = max(self.cwnd / 2, 1.0)
+        self.cwnd = self.ssthresh
+
+    def timedout(self):
+        self.ssthresh = max(self.cwnd / 2, 1.0)
+        self.cwnd = 1.0
+
+    def charge(self, srtt: float | None, now: float) -> float:
+        if self.cwnd >= self.limit or not srtt:
+            return 0.0
+        delay = max(self.due - now, 0.0)
+        self.due = max(self.due, now) + srtt / self.cwnd
+        return delay
+
+class Pacer:
+    """
+    The pace of a transfer: a TokenBucket of its own of 'rate' bytes/s,
+    if given, the 'bucket' shared by every transfer of the process, if
+    set, and the WindowControl of an upload, if any. wait() holds a packet
+    back as long as the slowest of them asks.
+    """
+    __slots__ = ('buckets', 'control')
+
+    def __init__(self, rate: float | None = None, control: WindowControl | None = None):
+        self.buckets = [bucket for bucket in (rate and TokenBucket(rate), shared_bucket) if bucket]
+        self.control = control
+
+    def __bool__(self) -> bool:
+        return bool(self.buckets) or self.control is not None
+
+    async def wait(self, size: int, srtt: float | None = None):
+        now = time.monotonic()
+        delay = max((bucket.charge(size, now) for bucket in self.buckets), default=0.0)
+        if self.control is not None:
+            delay = max(delay, self.control.charge(srtt, now))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# Shared by every transfer when set, e.g. to the capacity of the uplink.
+shared_bucket: TokenBucket | None = None
+
+class TransferResult:
+    """
+    What a finished transfer reports: bytes and blocks moved, packets
+    sent again, duplicate packets received and ignored, the smoothed
+    round trip (None if never measured), the time it took, the digest
+    of the data, if asked for, and whether it came from a ContentCache
+    instead of the network. With a 'compression' of the block stream,
+    'wire' bytes went over the network for the 'size' of the file.
+    """
+    __slots__ = ('size', 'blocks', 'retransmits', 'duplicates', 'srtt', 'elapsed', 'digest', 'cached',
+                 'compression', 'wire')
+
+    def __init__(self, size: int, blocks: int, retransmits: int, duplicates: int,
+                 srtt: float | None, elapsed: float, digest: str | None = None,
+                 cached: bool = False, compression: str | None = None, wire: int | None = None):
+        self.size = size
+        self.blocks = blocks
+        self.retransmits = retransmits
+        self.duplicates = duplicates
+        self.srtt = srtt
+        self.elapsed = elapsed
+        self.digest = digest
+        self.cached = cached
+        self.compression = compression
+        self.wire = size if wire is None else wire
+
+    @property
+    def ratio(self) -> float:
+        return self.size / self.wire if self.wire else 1.0
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'TransferResult({fields})'
+
+###############################################################
+##                                                           ##
+##                  TRANSFER STATE MACHINES                  ##
+##                                                           ##
+###############################################################
+
+# What on_datagram() of a Download or an Upload tells its driver.
+EVENT_NONE = 0      # nothing but the packets left in 'outbox'
+EVENT_DATA = 1      # a block of data, in 'data'
+EVENT_OPTIONS = 2   # the options were negotiated (RFC 2347)
+EVENT_RESTART = 3   # the request goes again to the server's port
+EVENT_DONE = 4      # the transfer is complete
+
+class Receiver:
+    """
+    The receiving end of a transfer, with no I/O of its own: DAT packets
+    and timeouts go in, through on_data() and on_timeout(), the data of
+    every block comes out of on_data() and the packets to send are left
+    in 'outbox', for the driver to send, in order, and clear before the
+    next event. The data returned is a view of the packet given, valid as
+    long as it is.
+    Blocks are counted past MAX_BLOCK_NUMBER, only the last block of a
+    window is acknowledged (RFC 7440) and a block out of order is
+    acknowledged once, so that the sender goes back, and again a timeout
+    later in case that ACK got lost. Once 'done', every DAT is answered
+    with the last ACK, while the sender has not got it.
+    """
+    __slots__ = ('blksize', 'windowsize', 'timer', 'outbox', 'last', 'received', 'size',
+                 'last_len', 'window', 'out_of_order', 'acked_at', 'sent_at', 'progress',
+                 'retransmits', 'duplicates', 'done', '_ack')
+
+    def __init__(self, blksize: int = MAX_DATA_LEN, windowsize: int = 1,
+                 last: bytes | None = None, now: float | None = None):
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.timer = RetransmissionTimer()
+        self.outbox = []
+        self.last = last if last is not None else pack_ack(0)   # sent again on a timeout
+        self.received = 0
+        self.size = 0
+        self.last_len = 0
+        self.window = 0
+        self.out_of_order = False
+        self.acked_at = 0.0
+        self.sent_at = None
+        self.progress = time.monotonic() if now is None else now
+        self.retransmits = 0
+        self.duplicates = 0
+        self.done = False
+        self._ack = bytearray(4)
+
+    def on_data(self, packet: memoryview, now: float) -> memoryview | None:
+        number = _HEADER.unpack_from(packet)[1]
+        # How far ahead of the last block received it is, whatever the
+        # rollovers so far.
+        ahead = (number - self.received) & MAX_BLOCK_NUMBER
+        if self.done:
+            self.outbox.append(self.last)
+            return None
+        if ahead == 1:
+            if self.sent_at is not None:
+                self.timer.sample(now - self.sent_at)
+                self.sent_at = None
+            else:
+                self.timer.restore()
+            self.progress = now
+            data = packet[4:]
+            length = len(data)
+            received = self.received = self.received + 1
+            self.last_len = length
+            self.size += length
+            self.out_of_order = False
+            ack = self.last = self._ack
+            _HEADER.pack_into(ack, 0, ACK, received & MAX_BLOCK_NUMBER)
+            window = self.window + 1
+            if length < self.blksize:
+                self.outbox.append(ack)
+                self.done = True
+            elif window >= self.windowsize:
+                self.outbox.append(ack)
+                self.sent_at = now
+                window = 0
+            self.window = window
+            return data
+        if self.windowsize < ahead <= MAX_BLOCK_NUMBER // 2:
+            raise TFTPGeneralError(f"Bad transfer: block {number} instead of "
+                                   f"{(self.received + 1) & MAX_BLOCK_NUMBER}.")
+        if not self.out_of_order:
+            # A block of the window got lost (or our last ACK did):
+            # acknowledge the last block received in order, once, so
+            # that the sender goes back to the one that follows it.
+            self.sent_at = None
+            self.out_of_order = True
+        elif now - self.acked_at < self.timer.timeout:
+            self.duplicates += 1
+            return None
+        # Else still blocks we have, a timeout later: that ACK got lost
+        # too. Without this, the retransmissions of the sender would
+        # keep us from timing out.
+        self.outbox.append(self.last)
+        self.retransmits += 1
+        self.acked_at = now
+        self.window = 0
+        return None
+
+    def on_timeout(self, now: float):
+        if now - self.progress >= INACTIVITY_TIMEOUT:
+            raise TimeoutError(f"Block {self.received + 1} lost. Maximum retry attempts reached.")
+        self.timer.backoff()
+        self.sent_at = None
+        self.retransmits += 1
+        self.window = 0
+        self.outbox.append(self.last)
+
+class Sender:
+    """
+    The sending end of a transfer, with no I/O of its own: ACKs and
+    timeouts go in, through on_ack() and on_timeout(), and the DAT
+    packets to send are left in 'outbox', as in Receiver. 'source' gives
+    the DAT packet of every new block, asked in order, and the length of
+    its data: a buffer or, to be sent by scatter/gather, a tuple of them,
+    which must stay valid until the block is acknowledged.
+    Up to windowsize blocks are kept in flight; an ACK for a block inside
+    the window makes it go back and send again every block that follows
+    (RFC 7440). A duplicate ACK never makes it send the same DAT again,
+    which would start the Sorcerer's Apprentice syndrome (RFC 1123):
+    only a lost window does, after a timeout or, once, when the receiver
+    points a gap. A WindowControl in 'control', if any, is told of the
+    blocks acknowledged and lost.
+    """
+    __slots__ = ('source', 'blksize', 'windowsize', 'timer', 'outbox', 'window', 'acked',
+                 'sent', 'size', 'last_len', 'last', 'gone_back', 'sent_at', 'progress',
+                 'retransmits', 'duplicates', 'done', 'control')
+
+    def __init__(self, source: Callable[[int], tuple], blksize: int = MAX_DATA_LEN,
+                 windowsize: int = 1, now: float | None = None):
+        self.source = source
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.timer = RetransmissionTimer()
+        self.outbox = []
+        self.window = {}    # block number => DAT packet not yet acknowledged
+        self.acked = 0      # last block acknowledged
+        self.sent = 0       # last block taken from the source
+        self.size = 0
+        self.last_len = 0
+        self.last = False   # the last block was taken
+        self.gone_back = False
+        self.sent_at = None
+        self.progress = time.monotonic() if now is None else now
+        self.retransmits = 0
+        self.duplicates = 0
+        self.done = False
+        self.control = None
+
+    def start(self, now: float):
+        self.progress = now
+        self.send_window(now)
+
+    def send_window(self, now: float):
+        # Blocks past the one acknowledged that are still in the window
+        # are sent again: the receiver is going back.
+        window = self.window
+        resent = len(window)
+        if not self.last and resent < self.windowsize:
+            source = self.source
+            block = self.sent
+            length = self.blksize
+            for block in range(block + 1, block + 1 + self.windowsize - resent):
+                window[block], length = source(block)
+                self.size += length
+                if length < self.blksize:
+                    break
+            self.sent = block
+            self.last_len = length
+            self.last = length < self.blksize
+        self.outbox.extend(window.values())
+        self.retransmits += resent
+        self.sent_at = None if resent else now
+
+    def on_ack(self, number: int, now: float) -> bool:
+        """
+        This method takes the ACK of block 'number' as on the wire and
+        tells whether it acknowledged anything new.
+        """
+        ahead = (number - self.acked) & MAX_BLOCK_NUMBER
+        if ahead > self.sent - self.acked:
+            # An ACK older than the window: ignore it.
+            self.duplicates += 1
+            return False
+        if ahead == 0 and self.sent > self.acked:
+            # A duplicate ACK. With a window, the first one tells that
+            # its first block got lost: go back.
+            self.duplicates += 1
+            if self.windowsize > 1 and not self.gone_back:
+                if self.control is not None:
+                    self.control.lost()
+                self.outbox.extend(self.window.values())
+                self.retransmits += len(self.window)
+                self.sent_at = None
+                self.gone_back = True
+            return False
+        if self.sent_at is not None:
+            self.timer.sample(now - self.sent_at)
+        else:
+            self.timer.restore()
+        self.progress = now
+        if self.control is not None:
+            self.control.acked(ahead)
+        for block in range(self.acked + 1, self.acked + ahead + 1):
+            del self.window[block]
+        self.acked += ahead
+        if self.last and self.acked == self.sent:
+            self.done = True
+            return True
+        self.gone_back = False
+        self.send_window(now)
+        return True
+
+    def on_timeout(self, now: float):
+        if now - self.progress >= INACTIVITY_TIMEOUT:
+            raise TimeoutError(f"Block {self.acked + 1} lost. Maximum retry attempts reached.")
+        self.timer.backoff()
+        self.sent_at = None
+        if self.control is not None:
+            self.control.timedout()
+        self.outbox.extend(self.window.values())
+        self.retransmits += len(self.window)
+        self.gone_back = False
+
+class RingSource:
+    """
+    The source of a Sender reading a file through 'readinto', filling a
+    block, short only at the end of the file: block N takes slot N of a
+    ring of windowsize DAT packets, where block N - windowsize,
+    acknowledged by then, used to be.
+    """
+    __slots__ = ('readinto', 'blksize', 'windowsize', 'slots', 'payloads')
+
+    def __init__(self, readinto: Callable[[memoryview], int], blksize: int, windowsize: int):
+        ring = memoryview(bytearray(windowsize * (blksize + 4)))
+        self.readinto = readinto
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.slots = [ring[offset:offset + blksize + 4]
+                      for offset in range(0, len(ring), blksize + 4)]
+        self.payloads = [slot[4:] for slot in self.slots]
+
+    def __call__(self, block: int) -> tuple[memoryview, int]:
+        index = block % self.windowsize
+        slot = self.slots[index]
+        _HEADER.pack_into(slot, 0, DAT, block & MAX_BLOCK_NUMBER)
+        length = self.readinto(self.payloads[index])
+        return (slot if length == self.blksize else slot[:length + 4]), length
+
+class Download(Receiver):
+    """
+    The client end of a RRQ, a Receiver that also goes through the
+    request, the options accepted in the OACK of the server (RFC 2347)
+    and the fall back to a plain RFC 1350 transfer when it refuses them.
+    The RRQ is in 'outbox' from the start. on_datagram() tells the
+    driver what came in (one of the EVENT_ values): EVENT_OPTIONS comes
+    before the ACK of the OACK is sent, e.g. to preallocate 'tsize'
+    bytes, and with EVENT_RESTART the driver must forget the transfer ID
+    of the server. 'peer' names the server in the errors. The block
+    stream is asked 'compress'ed, and is if 'compression' is set once
+    negotiated.
+    """
+    __slots__ = ('origin', 'mode', 'options', 'requested', 'tsize', 'compression', 'answered',
+                 'attempts', 'data', 'peer')
+
+    def __init__(self, origin: str, mode: str, blksize: int, windowsize: int,
+                 now: float | None = None, peer: str = '', compress: str | None = None):
+        super().__init__(MAX_DATA_LEN, 1, None, now)
+        self.origin = origin
+        self.mode = mode
+        self.options = request_options(blksize, windowsize, 0, compress)
+        self.requested = (blksize, windowsize, compress)
+        self.tsize = None
+        self.compression = None
+        self.answered = False
+        self.attempts = 1
+        self.data = None
+        self.peer = peer
+        self.last = pack_rrq(origin, mode, self.options)
+        self.outbox.append(self.last)
+        self.sent_at = self.progress
+
+    def on_datagram(self, packet: memoryview, now: float) -> int:
+        if len(packet) < 4:
+            return EVENT_NONE
+        opcode = _HEADER.unpack_from(packet)[0]
+        if opcode == DAT:
+            self.data = self.on_data(packet, now)
+            if self.data is None:
+                return EVENT_NONE
+            self.answered = True
+            return EVENT_DONE if self.done else EVENT_DATA
+        if opcode == OACK and self.received == 0:
+            if self.answered:
+                # Our ACK of the OACK got lost.
+                self.duplicates += 1
+                self.outbox.append(self.last)
+                return EVENT_NONE
+            try:
+                accepted = unpack_oack(bytes(packet))
+                self.blksize = negotiated_blksize(accepted, self.requested[0])
+                self.windowsize = negotiated_windowsize(accepted, self.requested[1])
+                self.tsize = negotiated_tsize(accepted)
+                self.compression = negotiated_compress(accepted, self.requested[2])
+            except TFTPValueError as e:
+                self.outbox.append(pack_err(OPTION_NEGOTIATION_ERR, str(e)))
+                raise
+            if self.sent_at is not None:
+                self.timer.sample(now - self.sent_at)
+            self.progress = self.sent_at = now
+            self.answered = True
+            self.last = pack_ack(0)
+            self.outbox.append(self.last)
+            return EVENT_OPTIONS
+        if opcode == ERR:
+            error_code, error_msg = unpack_err(bytes(packet))
+            if error_code == OPTION_NEGOTIATION_ERR and self.options and self.received == 0:
+                # The server refused the options: ask again for a plain
+                # RFC 1350 transfer.
+                self.options = {}
+                self.answered = False
+                self.last = pack_rrq(self.origin, self.mode)
+                self.outbox.append(self.last)
+                self.sent_at = now
+                return EVENT_RESTART
+            raise TFTPPeerError(error_code, error_msg)
+        return EVENT_NONE
+
+    def on_timeout(self, now: float):
+        if self.answered:
+            super().on_timeout(now)
+            return
+        self.timer.backoff()
+        self.sent_at = None
+        if self.attempts >= MAX_ATTEMPTS:
+            raise TFTPUnreachableError(f"Could not establish connection to {self.peer}.")
+        self.attempts += 1
+        self.retransmits += 1
+        self.outbox.append(self.last)
+
+class Upload(Sender):
+    """
+    The client end of a WRQ, a Sender that also goes through the request
+    and the options, as Download does: the data, read through
+    'readinto', only starts with the first ACK (or OACK) and 'size', if
+    known, is announced to the server. With 'aimd' a WindowControl
+    follows a window above 1 block. With 'compress' accepted, the file
+    goes through 'compressor', a CompressingReader. on_datagram() tells
+    EVENT_RESTART and EVENT_DONE, else EVENT_NONE.
+    """
+    __slots__ = ('destination', 'mode', 'options', 'requested', 'readinto', 'aimd',
+                 'compression', 'compressor', 'request', 'answered', 'attempts', 'peer')
+
+    def __init__(self, destination: str, mode: str, readinto: Callable[[memoryview], int],
+                 size: int | None, blksize: int, windowsize: int, now: float | None = None,
+                 peer: str = '', aimd: bool = False, compress: str | None = None):
+        super().__init__(None, MAX_DATA_LEN, 1, now)
+        self.destination = destination
+        self.mode = mode
+        self.readinto = readinto
+        self.aimd = aimd
+        self.options = request_options(blksize, windowsize, size, compress)
+        self.requested = (blksize, windowsize, compress)
+        self.compression = None
+        self.compressor = None
+        self.answered = False
+        self.attempts = 1
+        self.peer = peer
+        self.request = pack_wrq(destination, mode, self.options)
+        self.outbox.append(self.request)
+        self.sent_at = self.progress
+
+    def on_datagram(self, packet: memoryview, now: float) -> int:
+        if len(packet) < 4:
+            return EVENT_NONE
+        opcode, number = _HEADER.unpack_from(packet)
+        if opcode == OACK and self.acked == 0:
+            if self.sent == 0:
+                try:
+                    accepted = unpack_oack(bytes(packet))
+                    self.blksize = negotiated_blksize(accepted, self.requested[0])
+                    self.windowsize = negotiated_windowsize(accepted, self.requested[1])
+                    self.compression = negotiated_compress(accepted, self.requested[2])
+                except TFTPValueError as e:
+                    self.outbox.append(pack_err(OPTION_NEGOTIATION_ERR, str(e)))
+                    raise
+            # An OACK stands for the ACK of block 0.
+            number = 0
+        elif opcode == ERR:
+            error_code, error_msg = unpack_err(bytes(packet))
+            if error_code == OPTION_NEGOTIATION_ERR and self.options and not self.answered:
+                # The server refused the options: ask again for a plain
+                # RFC 1350 transfer.
+                self.options = {}
+                self.request = pack_wrq(self.destination, self.mode)
+                self.outbox.append(self.request)
+                self.sent_at = now
+                return EVENT_RESTART
+            raise TFTPPeerError(error_code, error_msg)
+        elif opcode != ACK:
+            return EVENT_NONE
+        if self.source is None and number == 0:
+            readinto = self.readinto
+            if self.compression is not None:
+                self.compressor = CompressingReader(readinto, self.compression)
+                readinto = self.compressor.readinto
+            self.source = RingSource(readinto, self.blksize, self.windowsize)
+            if self.aimd and self.windowsize > 1:
+                self.control = WindowControl(self.windowsize)
+        if self.on_ack(number, now):
+            self.answered = True
+            self.attempts = 1
+        return EVENT_DONE if self.done else EVENT_NONE
+
+    def on_timeout(self, now: float):
+        if self.answered:
+            super().on_timeout(now)
+            return
+        self.timer.backoff()
+        self.sent_at = None
+        if self.attempts >= MAX_ATTEMPTS:
+            raise TFTPUnreachableError(f"Could not establish connection to {self.peer}.")
+        self.attempts += 1
+        self.retransmits += 1
+        self.outbox.append(self.request)
+
+class MemoryTransport:
+    """
+    Runs a Sender against a Receiver in memory, with no sockets and a
+    clock of its own: every packet crosses in 'rtt' / 2 segs unless lost,
+    with probability 'loss', and may arrive twice, with probability
+    'duplicate', or after the one sent next, with probability 'reorder'.
+    When nothing is on the way any more the sender times out. run()
+    hands the data received to 'sink', if given, and returns the time it
+    took on that clock. It drives the state machines as fast as they go,
+    e.g. to measure or check them.
+    """
+    __slots__ = ('rtt', 'loss', 'duplicate', 'reorder', 'random', 'now')
+
+    def __init__(self, rtt: float = 0.0, loss: float = 0.0, seed: int | None = None,
+                 duplicate: float = 0.0, reorder: float = 0.0):
+        self.rtt = rtt
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.now = 0.0
+
+    def deliver(self, outbox: list) -> list:
+        """
+        This method takes the packets sent in one go and returns those
+        that arrive, in the order they do.
+        """
+        if not (self.loss or self.duplicate or self.reorder):
+            return outbox
+        rand = self.random.random
+        arrived = []
+        for packet in outbox:
+            if rand() < self.loss:
+                continue
+            arrived.append(packet)
+            if rand() < self.duplicate:
+                arrived.append(packet)
+        for i in range(len(arrived) - 1):
+            if rand() < self.reorder:
+                arrived[i], arrived[i + 1] = arrived[i + 1], arrived[i]
+        return arrived
+
+    def run(self, sender: Sender, receiver: Receiver,
+            sink: Callable[[memoryview], object] | None = None) -> float:
+        start = self.now
+        sender.progress = receiver.progress = self.now
+        sender.start(self.now)
+        while not sender.done:
+            if not sender.outbox and not receiver.outbox:
+                self.now += sender.timer.timeout
+                sender.on_timeout(self.now)
+                continue
+            self.now += self.rtt / 2
+            for packet in self.deliver(sender.outbox):
+                data = receiver.on_data(packet, self.now)
+                if data is not None and sink is not None:
+                    sink(data)
+            sender.outbox.clear()
+            self.now += self.rtt / 2
+            for packet in self.deliver(receiver.outbox):
+                sender.on_ack(_HEADER.unpack_from(packet)[1], self.now)
+            receiver.outbox.clear()
+        return self.now - start
+
+###############################################################
+##                                                           ##
+##                   PROGRESS AND METRICS                    ##
+##                                                           ##
+###############################################################
+
+class TransferProgress:
+    """
+    The progress of a transfer, handed to the 'progress' callback of the
+    transfers at most every PROGRESS_INTERVAL segs and once more when it
+    is done: bytes and blocks so far, out of 'total' bytes when known,
+    time elapsed, rates in bytes/s since the last report and on average,
+    retransmissions and round trips, the last sampled and the smoothed
+    one. 'error' tells why a transfer that is done failed.
+    The same object is updated along the transfer, so a callback keeping
+    it must copy what it wants, e.g. record().
+    """
+    __slots__ = ('mode', 'server', 'name', 'size', 'total', 'blocks', 'elapsed', 'rate',
+                 'average', 'retransmits', 'rtt', 'srtt', 'done', 'error', 'due',
+                 '_callback', '_start', '_time', '_size')
+
+    def __init__(self, callback: Callable[['TransferProgress'], None], mode: str,
+                 server: str, name: str, total: int | None = None):
+        self.mode = mode
+        self.server = server
+        self.name = name
+        self.size = 0
+        self.total = total
+        self.blocks = 0
+        self.elapsed = 0.0
+        self.rate = 0.0
+        self.average = 0.0
+        self.retransmits = 0
+        self.rtt = None
+        self.srtt = None
+        self.done = False
+        self.error = None
+        self._callback = callback
+        self._start = self._time = self.due = time.monotonic()
+        self._size = 0
+
+    def update(self, now: float, size: int, blocks: int, retransmits: int,
+               timer: RetransmissionTimer):
+        if now > self._time:
+            self.rate = (size - self._size) / (now - self._time)
+        self.elapsed = now - self._start
+        self.average = size / self.elapsed if self.elapsed > 0 else 0.0
+        self.size = size
+        self.blocks = blocks
+        self.retransmits = retransmits
+        self.rtt = timer.rtt
+        self.srtt = timer.srtt
+        self._time = now
+        self._size = size
+        self.due = now + PROGRESS_INTERVAL
+        self._callback(self)
+
+    def finish(self, size: int, blocks: int, retransmits: int, timer: RetransmissionTimer,
+               error: BaseException | None = None):
+        self.done = True
+        if error is not None:
+            self.error = str(error).strip() or type(error).__name__
+        self.update(time.monotonic(), size, blocks, retransmits, timer)
+
+    def record(self) -> dict:
+        return {
+            'mode': self.mode, 'server': self.server, 'name': self.name,
+            'status': 'ok' if self.error is None else 'failed', 'bytes': self.size,
+            'total': self.total, 'blocks': self.blocks, 'elapsed': self.elapsed,
+            'throughput': self.average, 'retransmits': self.retransmits, 'srtt': self.srtt,
+            'error': self.error,
+        }
+
+class ConsoleProgress:
+    """
+    The default renderer of the progress of a transfer: a status line
+    redrawn at most every 'interval' segs, whatever the rate of blocks,
+    and the final line of a transfer completed, on 'stream' (stdout by
+    default; stderr when stdout carries the file).
+    """
+
+    def __init__(self, interval: float = CONSOLE_INTERVAL, stream=None):
+        self.interval = interval
+        self.stream = stream
+        self._due = 0.0
+        self._width = 0
+
+    def __call__(self, progress: TransferProgress):
+        if progress.done:
+            if self._width:
+                show_cursor(self.stream)
+            if progress.error is None:
+                verb = 'Received' if progress.mode == 'get' else 'Sent'
+                line = (f"{verb} file '{progress.name}' {progress.size} bytes, "
+                        f"{progress.retransmits} retransmissions, {format_rate(progress.average)}.")
+                print('\r' + line.ljust(self._width) + '\n', file=self.stream, flush=True)
+            elif self._width:
+                print(file=self.stream, flush=True)
+            return
+        now = time.monotonic()
+        if now < self._due:
+            return
+        if not self._width:
+            hide_cursor(self.stream)
+        self._due = now + self.interval
+        verb = 'Receiving' if progress.mode == 'get' else 'Sending'
+        done = f' ({progress.size * 100 // progress.total}%)' if progress.total else ''
+        line = (f'{verb}...{progress.size} bytes{done}, {format_rate(progress.rate)}, '
+                f'{progress.retransmits} retransmissions.')
+        print('\r' + line.ljust(self._width), end='', file=self.stream, flush=True)
+        self._width = len(line)
+
+class MetricsExporter:
+    """
+    A 'progress' callback writing a record of every transfer done to
+    'path', either appended as a line of JSON ('jsonl') or as counters
+    in the Prometheus text format ('prometheus'), the whole file being
+    replaced each time, as the textfile collector expects. Counters go
+    on from those already in the file. The format is taken from the
+    extension of the file when not given: '.prom' for Prometheus.
+    """
+    FORMATS = ('jsonl', 'prometheus')
+
+    def __init__(self, path: str, format: str | None = None):
+        if format is None:
+            format = 'prometheus' if path.endswith('.prom') else 'jsonl'
+        if format not in self.FORMATS:
+            raise TFTPValueError(f'Invalid metrics format {format}')
+        self.path = path
+        self.format = format
+        self._series = {}       # 'name{labels}' => value
+        if format == 'prometheus' and os.path.isfile(path):
+            with open(path, 'rt') as file:
+                for line in file:
+                    if line.startswith('piranha_tftp_'):
+                        series, value = line.rsplit(' ', 1)
+                        self._series[series] = float(value)
+
+    def __call__(self, progress: TransferProgress):
+        if not progress.done:
+            return
+        record = progress.record()
+        if self.format == 'jsonl':
+            with open(self.path, 'at') as file:
+                file.write(json.dumps(record) + '\n')
+            return
+        labels = f'{{mode="{record["mode"]}",status="{record["status"]}"}}'
+        for name, value in (('transfers_total', 1), ('bytes_total', record['bytes']),
+                            ('retransmits_total', record['retransmits']),
+                            ('transfer_seconds_total', record['elapsed'])):
+            series = f'piranha_tftp_{name}{labels}'
+            self._series[series] = self._series.get(series, 0) + value
+        labels = f'{{mode="{record["mode"]}"}}'
+        self._series[f'piranha_tftp_last_throughput_bytes_per_second{labels}'] = record['throughput']
+        if record['srtt'] is not None:
+            self._series[f'piranha_tftp_last_srtt_seconds{labels}'] = record['srtt']
+        lines = []
+        written = set()
+        for series in sorted(self._series):
+            name = series.split('{')[0]
+            if name not in written:
+                written.add(name)
+                kind = 'counter' if name.endswith('_total') else 'gauge'
+                lines.append(f'# TYPE {name} {kind}')
+            value = float(self._series[series])
+            lines.append(f'{series} {int(value) if value.is_integer() else value!r}')
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'wt') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temporary, self.path)
+
+class PacketTrace:
+    """
+    A record of every packet sent and received by the transfers, for
+    analyze.py to make sense of: when (time.monotonic()), which transfer,
+    in or out, opcode, block number (error code for ERR, 0 for requests
+    and OACKs), length and port of the peer. It is written to 'path'
+    either as TRACE_RECORD structs, 22 bytes a packet ('binary'), or as
+    lines of JSON ('jsonl'), the format being taken from the extension
+    of the file when not given: '.jsonl' for JSON lines. Every transfer
+    starts with a TRACE_META record whose 'length' bytes of JSON, that
+    follow it in binary, describe the transfer. Records are buffered
+    until close().
+    """
+    FORMATS = ('binary', 'jsonl')
+
+    def __init__(self, path: str, format: str | None = None):
+        if format is None:
+            format = 'jsonl' if path.endswith('.jsonl') else 'binary'
+        if format not in self.FORMATS:
+            raise TFTPValueError(f'Invalid trace format {format}')
+        self.path = path
+        self.format = format
+        self._file = open(path, 'wb', buffering=IO_CHUNK_SIZE)
+        self._transfers = 0
+
+    def transfer(self, mode: str, name: str, serverip: str) -> Callable[[int, bytes, INET4Address], None]:
+        """
+        Starts the record of a transfer and returns the function that
+        records each of its packets, given direction, packet and peer.
+        """
+        self._transfers += 1
+        ident = self._transfers
+        now = time.monotonic()
+        meta = {'id': ident, 'mode': mode, 'name': name, 'peer': serverip,
+                'time': time.time(), 'clock': now}
+        write = self._file.write
+        if self.format == 'jsonl':
+            write(json.dumps({'t': now, 'id': ident, 'dir': TRACE_META, 'meta': meta}).encode() + b'\n')
+            def record(direction: int, packet: bytes, addr: INET4Address):
+                opcode, block = _HEADER.unpack_from(packet) if len(packet) >= 4 else (0, 0)
+                write(json.dumps({'t': time.monotonic(), 'id': ident, 'dir': direction, 'op': opcode,
+                                  'block': 0 if opcode in (RRQ, WRQ, OACK) else block,
+                                  'len': len(packet), 'port': addr[1]}).encode() + b'\n')
+        else:
+            binMeta = json.dumps(meta).encode()
+            write(TRACE_RECORD.pack(now, ident, TRACE_META, 0, 0, len(binMeta), 0) + binMeta)
+            pack = TRACE_RECORD.pack
+            def record(direction: int, packet: bytes, addr: INET4Address):
+                opcode, block = _HEADER.unpack_from(packet) if len(packet) >= 4 else (0, 0)
+                if opcode in (RRQ, WRQ, OACK):
+                    block = 0
+                write(pack(time.monotonic(), ident, direction, opcode & 0xFF, block,
+                           len(packet), addr[1]))
+        return record
+
+    def close(self):
+        self._file.close()
+
+def read_trace(path: str) -> Iterator[dict]:
+    """
+    This method reads back a trace written by PacketTrace, in either
+    format, yielding dicts as in the JSON lines: those of TRACE_META
+    records carry the description of the transfer in 'meta'.
+    """
+    with open(path, 'rb') as file:
+        if file.peek(1)[:1] == b'{':
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        while True:
+            binRecord = file.read(TRACE_RECORD.size)
+            if len(binRecord) < TRACE_RECORD.size:
+                return
+            now, ident, direction, opcode, block, length, port = TRACE_RECORD.unpack(binRecord)
+            if direction == TRACE_META:
+                yield {'t': now, 'id': ident, 'dir': direction, 'meta': json.loads(file.read(length))}
+            else:
+                yield {'t': now, 'id': ident, 'dir': direction, 'op': opcode, 'block': block,
+                       'len': length, 'port': port}
+
+# Every transfer records its packets in it when set.
+tracer: PacketTrace | None = None
+
+def format_rate(rate: float) -> str:
+    for unit in ('B/s', 'KB/s', 'MB/s'):
+        if rate < 1024:
+            return f'{rate:.1f} {unit}'
+        rate /= 1024
+    return f'{rate:.1f} GB/s'
 
 ###############################################################
 ##                                                           ##
@@ -176,139 +1273,1686 @@ def show_cursor():
 #def put_file(server_addr: INET4Address, filename: str):
 #    print(f"Enviar ficheiro para {server_addr} ")
     
-def get_file( port: int, server: str, serverip: str, origin: str, destination: str ):
+async def aget_file( port: int, server: str, serverip: str, origin: str, destination: str,
+                     blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+                     verbose: bool = False,
+                     progress: Callable[[TransferProgress], None] | None = None,
+                     mode: str = DEFAULT_MODE, digest: str | None = None,
+                     expected: str | None = None, buffer: int = IO_BUFFER_SIZE,
+                     fsync: bool = False, rate: float | None = None,
+                     compress: str | None = None ) -> TransferResult:
     """
-    This method is responsible for downloading the selected file from server.
+    This coroutine is responsible for downloading the selected file from
+    server. Many of them can run at once on a single event loop, each with
+    its own endpoint and retransmission timer; cancelling one removes the
+    partial destination.
+    With a windowsize above 1 the server sends that many blocks in a row
+    and we acknowledge only the last one of each window (RFC 7440).
+    Blocks are counted past MAX_BLOCK_NUMBER, the number on the wire
+    rolling over to 0, and the destination is preallocated as soon as
+    the server announces the file size (RFC 2349).
+    'progress' is called with a TransferProgress now and then along the
+    transfer and when it is done; 'verbose' draws it on the console.
+    In netascii 'mode' the line ends are translated to the local ones.
+    With a 'digest' (one of DIGESTS) the data is hashed as it is written,
+    the result carrying it, and checked against 'expected' when given:
+    a destination that does not match is removed as well.
+    The file is written behind the transfer by a thread, up to 'buffer'
+    bytes late (0 writes it in line), and synced to the disk at the end
+    when 'fsync'.
+    The transfer is kept under 'rate' bytes/s, when given, and under the
+    rate of shared_bucket, when set (see Pacer).
+    Octet downloads go through 'cache', the ContentCache of the module,
+    when set.
+    With 'compress', one of COMPRESSIONS, the blocks carry the file
+    compressed if the server accepts it, and plain otherwise (octet
+    mode only).
+    """
+    def download() -> Awaitable[TransferResult]:
+        return _aget_file( port, server, serverip, origin, destination, blksize, windowsize,
+                           verbose, progress, mode, digest, expected, buffer, fsync, rate,
+                           compress )
+    if cache is None or mode != DEFAULT_MODE:
+        return await download()
+    return await cache.aget( port, server, serverip, origin, destination, blksize, download,
+                             digest, expected )
+
+async def _aget_file( port: int, server: str, serverip: str, origin: str, destination: str,
+                      blksize: int | None, windowsize: int, verbose: bool,
+                      progress: Callable[[TransferProgress], None] | None,
+                      mode: str, digest: str | None, expected: str | None, buffer: int,
+                      fsync: bool, rate: float | None, compress: str | None ) -> TransferResult:
+    """
+    The download behind aget_file(), past the cache.
+    """
+    try:
+        with open( destination, "wb" ) as file:
+            if not buffer:
+                result = await _aget( port, server, serverip, origin, file, blksize, windowsize,
+                                      verbose, progress, True, mode, digest, expected, rate,
+                                      compress )
+                if fsync:
+                    file.flush()
+                    os.fsync( file.fileno() )
+                return result
+            writer = _WriteBehind( file, buffer, fsync )
+            try:
+                result = await _aget( port, server, serverip, origin, writer, blksize, windowsize,
+                                      verbose, progress, True, mode, digest, expected, rate,
+                                      compress )
+            except BaseException:
+                await writer.aclose( True )
+                raise
+            await writer.aclose()
+            return result
+    except BaseException:
+        # Including cancellation of the coroutine.
+        if os.path.isfile( destination ) == True:
+            os.remove( destination )
+        raise
+
+async def aget_stream( port: int, server: str, serverip: str, origin: str, file,
+                       blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+                       verbose: bool = False,
+                       progress: Callable[[TransferProgress], None] | None = None,
+                       mode: str = DEFAULT_MODE, digest: str | None = None,
+                       expected: str | None = None, rate: float | None = None,
+                       compress: str | None = None ) -> TransferResult:
+    """
+    This coroutine downloads the selected file from server into 'file',
+    any writable binary object, as aget_file() does into a named file.
+    When 'file' has a drain() coroutine, e.g. an asyncio.StreamWriter,
+    it is awaited after every block, so that a slow reader holds our
+    ACKs back instead of piling the file up in memory.
+    """
+    return await _aget( port, server, serverip, origin, file, blksize, windowsize,
+                        verbose, progress, False, mode, digest, expected, rate, compress )
+
+async def _aget( port: int, server: str, serverip: str, origin: str, file,
+                 blksize: int | None, windowsize: int, verbose: bool,
+                 progress: Callable[[TransferProgress], None] | None,
+                 allocate: bool, mode: str = DEFAULT_MODE,
+                 digest: str | None = None, expected: str | None = None,
+                 rate: float | None = None, compress: str | None = None ) -> TransferResult:
+    """
+    The download behind aget_file() and aget_stream(), into 'file',
+    preallocated and truncated when 'allocate'.
     """
+    if blksize is None:
+        blksize = default_blksize( serverip )
+    check_blksize( blksize )
+    check_windowsize( windowsize )
+    mode = check_mode( mode )
+    check_compress( compress, mode )
+    decoder = NetasciiDecoder() if mode == NETASCII_MODE else None
+    intText = 0         # bytes written once translated from netascii
+    decompressor = None
+    if expected is not None and digest is None:
+        digest = digest_of( expected )
+    hasher = new_digest( digest ) if digest else None
     plug = ( serverip, port )
-    sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
-#    sock.settimeout( INACTIVITY_TIMEOUT )
-    sock.settimeout( int( INACTIVITY_TIMEOUT / MAX_ATTEMPTS ) )
-    msg = pack_rrq( origin )
-    intAttempt = 1
-    intBlock = 0
+    bolConnected = False
+    drain = getattr( file, "drain", None )
+    pacer = Pacer( rate )
+    if verbose and progress is None:
+        progress = ConsoleProgress()
+    report = TransferProgress( progress, "get", serverip, origin ) if progress else None
+    sock = _open_endpoint( max( DEFAULT_BUFFER_SIZE, blksize + 4 ), address_family( serverip ) )
+    if tracer is not None:
+        sock.trace = tracer.transfer( "get", origin, serverip )
+    floStart = time.monotonic()
+    machine = Download( origin, mode, blksize, windowsize, floStart, f"{serverip}:{port}", compress )
+    outbox = machine.outbox
+    try:
+        while True:
+            for msg in outbox:
+                sock.sendto( msg, plug )
+            outbox.clear()
+            try:
+                packet, addr = await sock.recvfrom( machine.timer.timeout )
+            except TimeoutError:
+                machine.on_timeout( time.monotonic() )
+                continue
+            if bolConnected and addr != plug:
+                sock.sendto( pack_err( UNKOWN_TRANSF_ID ), addr )
+                continue
+            plug = addr
+            bolConnected = True
+            floNow = time.monotonic()
+            try:
+                intEvent = machine.on_datagram( packet, floNow )
+            except TFTPValueError:
+                # The options the server accepted are not ours: tell it.
+                for msg in outbox:
+                    sock.sendto( msg, plug )
+                raise
+            if intEvent == EVENT_DATA or intEvent == EVENT_DONE:
+                if decompressor is not None:
+                    for binChunk in decompressor.decompress( machine.data ):
+                        if hasher is not None:
+                            hasher.update( binChunk )
+                        file.write( binChunk )
+                        if drain is not None:
+                            await drain()
+                else:
+                    # A view of the receive buffer: written to the file
+                    # without being copied.
+                    if decoder is None:
+                        binText = machine.data
+                    else:
+                        binText = decoder.decode( machine.data )
+                        intText += len( binText )
+                    if hasher is not None:
+                        hasher.update( binText )
+                    file.write( binText )
+                    if drain is not None:
+                        await drain()
+                if report is not None and floNow >= report.due:
+                    if decompressor is not None:
+                        intWritten = decompressor.size
+                    else:
+                        intWritten = machine.size if decoder is None else intText
+                    report.update( floNow, intWritten, machine.received, machine.retransmits,
+                                   machine.timer )
+                if intEvent == EVENT_DONE:
+                    for msg in outbox:
+                        sock.sendto( msg, plug )
+                    break
+                if outbox and pacer:
+                    # The server sends the next window only when
+                    # acknowledged: holding the ACK back paces it.
+                    await pacer.wait( machine.windowsize * machine.blksize )
+                    machine.sent_at = time.monotonic()
+            elif intEvent == EVENT_OPTIONS:
+                if machine.compression is not None:
+                    decompressor = Decompressor( machine.compression )
+                if report is not None:
+                    report.total = machine.tsize
+                if machine.tsize and allocate:
+                    try:
+                        preallocate( file, machine.tsize )
+                    except OSError:
+                        sock.sendto( pack_err( DISK_FULL_OR_ALLOC_EXC ), plug )
+                        raise
+                # Room for a whole window of blocks in the kernel.
+                sock.reserve( machine.windowsize * ( machine.blksize + 4 ) )
+            elif intEvent == EVENT_RESTART:
+                plug = ( serverip, port )
+                bolConnected = False
+        if decoder is not None:
+            data = decoder.flush()
+            if hasher is not None:
+                hasher.update( data )
+            file.write( data )
+            intText += len( data )
+        intSize = machine.size if decoder is None else intText
+        if decompressor is not None:
+            decompressor.flush()
+            intSize = decompressor.size
+        if allocate:
+            # Drop whatever was preallocated beyond the data received.
+            file.truncate()
+        # The blocks count what crossed the wire, tsize the file, but in
+        # netascii, where it is the size on the wire too.
+        if ( not check_size( machine.size, machine.received, machine.blksize, machine.last_len )
+             or machine.tsize is not None and
+             ( intSize if decoder is None else machine.size ) != machine.tsize ):
+            err_msg = f"Size mismatch: bad transfer. Try again"
+            raise TFTPGeneralError(err_msg)
+        strDigest = check_digest( hasher, expected )
+    except BaseException as e:
+        # Including cancellation of the coroutine: the server is told,
+        # not to keep sending to a port that may serve another transfer.
+        if bolConnected and isinstance( e, asyncio.CancelledError ):
+            sock.sendto( pack_err( ERR_NOT_DEFINED, "Transfer cancelled" ), plug )
+        if report is not None:
+            report.finish( machine.size, machine.received, machine.retransmits, machine.timer, e )
+        raise
+    finally:
+        sock.close()
+    result = TransferResult( intSize, machine.received, machine.retransmits,
+                             machine.duplicates, machine.timer.srtt,
+                             time.monotonic() - floStart, strDigest,
+                             compression=machine.compression, wire=machine.size )
+    if report is not None:
+        report.finish( intSize, machine.received, machine.retransmits, machine.timer )
+    return result
+#    print( f"tftp get -p {port} {serverip} {origin} {destination}" )
+
+async def aget_multicast( port: int, server: str, serverip: str, origin: str, destination: str,
+                          blksize: int | None = None, verbose: bool = False,
+                          progress: Callable[[TransferProgress], None] | None = None ) -> TransferResult:
+    """
+    This coroutine downloads the selected file from server along with
+    every other client asking for it at the same time, the server sending
+    the blocks to a multicast group (RFC 2090). Blocks are taken in
+    whatever order they come, kept track of in a bitmap; only the master
+    client, chosen by the server one at a time, acknowledges them,
+    pointing at the first block it still misses. A client that has every
+    block acknowledges the last one, so that the server lets it go.
+    A server that does not acknowledge the option gets a plain download,
+    acknowledged block by block.
+    """
+    if blksize is None:
+        blksize = default_blksize( serverip )
+    check_blksize( blksize )
+    plug = ( serverip, port )
+    dicOptions = request_options( blksize, DEFAULT_WINDOWSIZE, 0 ) | { "multicast": "" }
+    msg = pack_rrq( origin, options=dicOptions )
+    timer = RetransmissionTimer()
+    bitReceived = bytearray( 1 )    # bit N set once block N is received
+    intBlkSize = MAX_DATA_LEN
+    intNext = 1         # first block still missing
+    intLast = None      # last block of the file, once known
+    intLastLen = 0
+    intBlocks = 0
     intFileSize = 0
+    intPosition = 0     # in the file, to seek only out of order
+    intTSize = None
+    intAttempt = 1
+    intRetransmits = 0
+    intDuplicates = 0
     intStatusCode = 3
-    hide_cursor()
+    bolConnected = False
+    bolMaster = False
+    bolAbsolute = False # block numbers that do not roll over
+    if verbose and progress is None:
+        progress = ConsoleProgress()
+    report = TransferProgress( progress, "get", serverip, origin ) if progress else None
+    sock = _open_endpoint( max( DEFAULT_BUFFER_SIZE, blksize + 4 ) )
+    if tracer is not None:
+        sock.trace = tracer.transfer( "multicast", origin, serverip )
     try:
-        with open( destination, "wb") as file:
-            while True:
+        with open( destination, "wb" ) as file:
+            sock.sendto( msg, plug )
+            floStart = floProgress = floSent = time.monotonic()
+            while intLast is None or intNext <= intLast:
                 try:
-                    sock.sendto( msg, plug )
-                    packet, plug = sock.recvfrom( DEFAULT_BUFFER_SIZE )
-                    if unpack_opcode( packet ) == DAT:
-                        intBlockDat, data = unpack_dat( packet )
-                        if intBlockDat == intBlock + 1:
-                            intFileSize += len( data )
-                            if origin != "dir.txt":
-                                logit( 4, f"Receiving...{intFileSize} bytes.", intStatusCode == 4 )
-                                intStatusCode = 4
-                            intAttempt = 1
-                            intBlock += 1
-                            msg = pack_ack( intBlock )
-                            file.write( data )
-                            if len( data ) < MAX_DATA_LEN:
-                                break
+                    packet, addr = await sock.recvfrom( timer.timeout )
+                    if sock.from_group:
+                        # Other servers may send to the same group: only
+                        # the port of ours tells (its address may be of
+                        # another interface).
+                        if addr[1] != plug[1]:
+                            continue
+                    else:
+                        if bolConnected and addr != plug:
+                            sock.sendto( pack_err( UNKOWN_TRANSF_ID ), addr )
+                            continue
+                        plug = addr
+                        bolConnected = True
+                    if len( packet ) < 4:
+                        continue
+                    intOpcode, intBlockDat = _HEADER.unpack_from( packet )
+                    if intOpcode == DAT:
+                        if intStatusCode == 3:
+                            # No OACK: a plain RFC 1350 server.
+                            bolMaster = True
+                            intStatusCode = 4
+                        if bolAbsolute:
+                            # Only files that do not roll the number over
+                            # are sent to a group, whichever block a late
+                            # joiner starts at.
+                            intAbsolute = intBlockDat
                         else:
-                            err_msg = f"Bad transfer: block {intBlockDat} instead of {intBlock + 1}."
-                            raise TFTPGeneralError(err_msg)
-                    elif unpack_opcode( packet ) == ERR:
-                        error_code, error_msg = unpack_err( packet )
-                        err_msg = f"\n\nError {error_code}: {error_msg}"
-                        raise TFTPGeneralError(err_msg)
+                            # Numbers on the wire roll over: take the block
+                            # nearest to the first one missing, as a server
+                            # in lock-step sends.
+                            intAhead = ( intBlockDat - intNext ) & MAX_BLOCK_NUMBER
+                            if intAhead > MAX_BLOCK_NUMBER // 2:
+                                intAhead -= MAX_BLOCK_NUMBER + 1
+                            intAbsolute = intNext + intAhead
+                        if len( bitReceived ) <= intAbsolute >> 3:
+                            # Blocks may come far ahead of the first one
+                            # missing, to a client joining late.
+                            bitReceived.extend( bytes( ( intAbsolute >> 3 ) + 1 - len( bitReceived ) ) )
+                        if intAbsolute < 1 or ( intLast is not None and intAbsolute > intLast ) or \
+                                bitReceived[intAbsolute >> 3] & ( 1 << ( intAbsolute & 7 ) ):
+                            intDuplicates += 1
+                            if bolMaster and not sock.from_group:
+                                # Sent again to us: our ACK got lost.
+                                sock.sendto( pack_ack( ( intNext - 1 ) & MAX_BLOCK_NUMBER ), plug )
+                            continue
+                        data = packet[4:]
+                        intOffset = ( intAbsolute - 1 ) * intBlkSize
+                        if intOffset != intPosition:
+                            file.seek( intOffset )
+                        file.write( data )
+                        intPosition = intOffset + len( data )
+                        bitReceived[intAbsolute >> 3] |= 1 << ( intAbsolute & 7 )
+                        intBlocks += 1
+                        intFileSize += len( data )
+                        if len( data ) < intBlkSize or intAbsolute == intLast:
+                            intLast = intAbsolute
+                            intLastLen = len( data )
+                        while bitReceived[intNext >> 3] & ( 1 << ( intNext & 7 ) ):
+                            intNext += 1
+                            if len( bitReceived ) <= intNext >> 3:
+                                break
+                        floProgress = time.monotonic()
+                        intAttempt = 1
+                        if report is not None and floProgress >= report.due:
+                            report.update( floProgress, intFileSize, intBlocks, intRetransmits, timer )
+                        if bolMaster:
+                            if floSent is not None:
+                                timer.sample( floProgress - floSent )
+                            else:
+                                timer.restore()
+                            sock.sendto( pack_ack( ( intNext - 1 ) & MAX_BLOCK_NUMBER ), plug )
+                            floSent = floProgress
+                    elif intOpcode == OACK:
+                        try:
+                            dicAccepted = unpack_oack( bytes( packet ) )
+                            tupMulticast = negotiated_multicast( dicAccepted )
+                            bolAbsolute = tupMulticast is not None
+                            if intStatusCode == 3:
+                                intBlkSize = negotiated_blksize( dicAccepted, blksize )
+                                intTSize = negotiated_tsize( dicAccepted )
+                        except TFTPValueError as e:
+                            sock.sendto( pack_err( OPTION_NEGOTIATION_ERR, str( e ) ), plug )
+                            raise
+                        if intStatusCode == 3:
+                            if intTSize is not None:
+                                intLast = intTSize // intBlkSize + 1
+                                bitReceived = bytearray( intLast // 8 + 1 )
+                                if report is not None:
+                                    report.total = intTSize
+                                try:
+                                    preallocate( file, intTSize )
+                                except OSError:
+                                    sock.sendto( pack_err( DISK_FULL_OR_ALLOC_EXC ), plug )
+                                    raise
+                            if tupMulticast is not None and tupMulticast[0] and tupMulticast[1]:
+                                sock.join( tupMulticast[0], tupMulticast[1], _local_address( serverip ) )
+                            # Room for bursts of blocks sent to the group.
+                            sock.reserve( 64 * ( intBlkSize + 4 ) )
+                            intStatusCode = 4
+                        # Without the option, we are the only client.
+                        bolMaster = tupMulticast is None or tupMulticast[2]
+                        floProgress = time.monotonic()
+                        if bolMaster:
+                            sock.sendto( pack_ack( ( intNext - 1 ) & MAX_BLOCK_NUMBER ), plug )
+                            floSent = floProgress
+                    elif intOpcode == ERR:
+                        error_code, error_msg = unpack_err( bytes( packet ) )
+                        if error_code == OPTION_NEGOTIATION_ERR and dicOptions and intStatusCode == 3:
+                            # The server refused the options: ask again
+                            # for a plain RFC 1350 transfer.
+                            dicOptions = {}
+                            msg = pack_rrq( origin )
+                            plug = ( serverip, port )
+                            bolConnected = False
+                            sock.sendto( msg, plug )
+                            floSent = time.monotonic()
+                            continue
+                        raise TFTPPeerError( error_code, error_msg )
                 except TimeoutError:
+                    timer.backoff()
+                    floSent = None
                     if intStatusCode == 3:
-                        err_msg = f"Could not establish connection to {plug[0]}:{plug[1]}."
-                        raise TimeoutError( err_msg )
-                    else:
                         if intAttempt >= MAX_ATTEMPTS:
-                            err_msg = f"Block {intBlock} lost. Maximum retry attempts reached."
-                            raise TimeoutError( err_msg )
-                        logit( 5, f"Block {intBlock} lost. Retransmitting...{intAttempt}",
-                              intStatusCode == 5 )
-                        intStatusCode = 5
-                        intAttempt += 1
-    except:
+                            err_msg = f"Could not establish connection to {plug[0]}:{plug[1]}."
+                            raise TFTPUnreachableError( err_msg )
+                        sock.sendto( msg, plug )
+                        intRetransmits += 1
+                    elif time.monotonic() - floProgress >= INACTIVITY_TIMEOUT:
+                        err_msg = f"Block {intNext} lost. Maximum retry attempts reached."
+                        raise TimeoutError( err_msg )
+                    elif bolMaster:
+                        sock.sendto( pack_ack( ( intNext - 1 ) & MAX_BLOCK_NUMBER ), plug )
+                        intRetransmits += 1
+                    intAttempt += 1
+            if not bolMaster:
+                # Let the server know we are done.
+                sock.sendto( pack_ack( intLast & MAX_BLOCK_NUMBER ), plug )
+            file.truncate( intFileSize )
+        if not check_size( intFileSize, intLast, intBlkSize, intLastLen, intTSize ):
+            err_msg = "Size mismatch: bad transfer. Try again"
+            raise TFTPGeneralError(err_msg)
+    except BaseException as e:
+        # Including cancellation of the coroutine.
         if os.path.isfile( destination ) == True:
             os.remove( destination )
+        if report is not None:
+            report.finish( intFileSize, intBlocks, intRetransmits, timer, e )
         raise
-    sock.close()
-    if intFileSize == ( intBlock - 1 ) * MAX_DATA_LEN + len(data):
-        if origin != "dir.txt":
-            print( f"\rReceived file '{origin}' {intFileSize} bytes.\n", flush=True )
-    else:
-        err_msg = f"Size mismatch: bad transfer. Try again"
-        raise TFTPGeneralError(err_msg)
-    show_cursor()
-#    print( f"tftp get -p {port} {serverip} {origin} {destination}" )
+    finally:
+        sock.close()
+    result = TransferResult( intFileSize, intBlocks, intRetransmits, intDuplicates,
+                             timer.srtt, time.monotonic() - floStart )
+    if report is not None:
+        report.finish( intFileSize, intBlocks, intRetransmits, timer )
+    return result
 
-def put_file( port: int, server: str, serverip: str, origin: str, destination: str ):
+async def aput_file( port: int, server: str, serverip: str, origin: str, destination: str,
+                     blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+                     verbose: bool = False,
+                     progress: Callable[[TransferProgress], None] | None = None,
+                     mode: str = DEFAULT_MODE, digest: str | None = None,
+                     expected: str | None = None, buffer: int = IO_BUFFER_SIZE,
+                     rate: float | None = None, aimd: bool = False,
+                     compress: str | None = None ) -> TransferResult:
     """
-    This method is responsible for uploading the selected file to server.
+    This coroutine is responsible for uploading the selected file to
+    server. Many of them can run at once on a single event loop, each with
+    its own endpoint and retransmission timer.
+    With a windowsize above 1 up to that many blocks are kept in flight;
+    an ACK for a block inside the window makes us go back and send again
+    every block that follows it (RFC 7440). Blocks are counted past
+    MAX_BLOCK_NUMBER, the number on the wire rolling over to 0, and the
+    file size is announced to the server (RFC 2349). 'progress' and
+    'verbose' work as in aget_file().
+    A duplicate ACK never makes us send the same DAT again, which would
+    start the Sorcerer's Apprentice syndrome (RFC 1123): only a lost
+    window does, after a timeout or, once, when the server points a gap.
+    In netascii 'mode' the file is translated on the way, so its size on
+    the wire is only known at the end and is not announced. 'digest' and
+    'expected' work as in aget_file(), on the file as read.
+    The file is read ahead of the transfer by a thread, up to 'buffer'
+    bytes (0 reads it in line). 'rate' works as in aget_file() and, with
+    'aimd', the blocks of a window are paced by a WindowControl.
+    'compress' works as in aget_file(), the server being told the size
+    of the file as it is.
     """
+    with open( origin, "rb" ) as file:
+        intSize = os.fstat( file.fileno() ).st_size
+        if not buffer:
+            return await _aput( port, server, serverip, origin, file.readinto, destination,
+                                intSize, blksize, windowsize, verbose, progress, mode,
+                                digest, expected, rate, aimd, compress )
+        reader = _ReadAhead( file, buffer )
+        try:
+            return await _aput( port, server, serverip, origin, reader.readinto, destination,
+                                intSize, blksize, windowsize, verbose, progress, mode,
+                                digest, expected, rate, aimd, compress )
+        finally:
+            reader.close()
+
+async def aput_stream( port: int, server: str, serverip: str, source, destination: str,
+                       size: int | None = None, blksize: int | None = None,
+                       windowsize: int = DEFAULT_WINDOWSIZE, verbose: bool = False,
+                       progress: Callable[[TransferProgress], None] | None = None,
+                       mode: str = DEFAULT_MODE, digest: str | None = None,
+                       expected: str | None = None, rate: float | None = None,
+                       aimd: bool = False, compress: str | None = None ) -> TransferResult:
+    """
+    This coroutine uploads to server what is read from 'source', either
+    a readable binary object, e.g. sys.stdin.buffer, or an iterable of
+    bytes, as aput_file() does from a named file. The size is announced
+    to the server only when known and given in 'size'.
+    Reading 'source' blocks the event loop: a pipe that is slow to fill
+    holds back the other transfers running on it.
+    """
+    return await _aput( port, server, serverip, destination, _stream_reader( source ), destination,
+                        size, blksize, windowsize, verbose, progress, mode, digest, expected,
+                        rate, aimd, compress )
+
+async def _aput( port: int, server: str, serverip: str, origin: str,
+                 readinto: Callable[[memoryview], int], destination: str, size: int | None,
+                 blksize: int | None, windowsize: int, verbose: bool,
+                 progress: Callable[[TransferProgress], None] | None,
+                 mode: str = DEFAULT_MODE, digest: str | None = None,
+                 expected: str | None = None, rate: float | None = None,
+                 aimd: bool = False, compress: str | None = None ) -> TransferResult:
+    """
+    The upload behind aput_file() and aput_stream(): 'readinto' fills a
+    block, short only at the end of the file, and 'size', if known, is
+    announced to the server. 'origin' names the file in the reports.
+    """
+    if blksize is None:
+        blksize = default_blksize( serverip )
+    check_blksize( blksize )
+    check_windowsize( windowsize )
+    mode = check_mode( mode )
+    check_compress( compress, mode )
+    if expected is not None and digest is None:
+        digest = digest_of( expected )
+    hasher = new_digest( digest ) if digest else None
+    if hasher is not None:
+        readinto = _hashing_reader( readinto, hasher )
+    if mode == NETASCII_MODE:
+        # What goes on the wire is counted as it is translated.
+        readinto = NetasciiReader( readinto ).readinto
+        size = None
     plug = ( serverip, port )
-    sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
-#    sock.settimeout( INACTIVITY_TIMEOUT )
-    sock.settimeout( int( INACTIVITY_TIMEOUT / MAX_ATTEMPTS ) )
-    intFileSize = os.path.getsize( origin )
-    msg = pack_wrq( destination )
-    intAttempt = 1
-    intBlock = 0
-    intStatusCode = 0
-    hide_cursor()
-    with open( origin, "rb") as file:
+    bolConnected = False
+    pacer = Pacer( rate )
+    if verbose and progress is None:
+        progress = ConsoleProgress()
+    report = TransferProgress( progress, "put", serverip, origin, size ) if progress else None
+    sock = _open_endpoint( DEFAULT_BUFFER_SIZE, address_family( serverip ) )
+    if tracer is not None:
+        sock.trace = tracer.transfer( "put", origin, serverip )
+    floStart = time.monotonic()
+    machine = Upload( destination, mode, readinto, size, blksize, windowsize, floStart,
+                      f"{serverip}:{port}", aimd, compress )
+    outbox = machine.outbox
+    try:
         while True:
+            if outbox:
+                pacer.control = machine.control
+                for msg in outbox:
+                    if pacer:
+                        await pacer.wait( len( msg ), machine.timer.srtt )
+                    sock.sendto( msg, plug )
+                outbox.clear()
+                if pacer and machine.sent_at is not None:
+                    machine.sent_at = time.monotonic()
             try:
-                sock.sendto( msg, plug )
-                packet, plug = sock.recvfrom( DEFAULT_BUFFER_SIZE )
-                if unpack_opcode( packet ) == ACK:
-                    intBlockAck = unpack_ack( packet )
-                    if intBlockAck == intBlock:
-                        floDone = file.tell() / intFileSize
-                        logit( 1, f"Sending...{int( floDone * 100 )}%", intStatusCode == 1 )
-                        intStatusCode = 1
-                        intAttempt = 1
-                        intBlock += 1
-                        binData = file.read(MAX_DATA_LEN)
-                        if not binData:
-                            if len( msg ) == MAX_DATA_LEN + 4:
-                                msg = pack_dat( intBlock, b"" )
-                            else:
-                                break
-                        else:
-                            msg = pack_dat( intBlock, binData )
-                    elif intBlockAck == intBlock - 1:
-                        continue
+                packet, addr = await sock.recvfrom( machine.timer.timeout )
+            except TimeoutError:
+                machine.on_timeout( time.monotonic() )
+                continue
+            if bolConnected and addr != plug:
+                sock.sendto( pack_err( UNKOWN_TRANSF_ID ), addr )
+                continue
+            plug = addr
+            bolConnected = True
+            floNow = time.monotonic()
+            try:
+                intEvent = machine.on_datagram( packet, floNow )
+            except TFTPValueError:
+                # The options the server accepted are not ours: tell it.
+                for msg in outbox:
+                    sock.sendto( msg, plug )
+                raise
+            if intEvent == EVENT_DONE:
+                break
+            if intEvent == EVENT_RESTART:
+                plug = ( serverip, port )
+                bolConnected = False
+            elif report is not None and machine.compressor is not None:
+                # Only the bytes on the wire are acknowledged: how much
+                # of the file they hold is not known.
+                report.total = None
+                if floNow >= report.due:
+                    report.update( floNow, machine.acked * machine.blksize, machine.acked,
+                                   machine.retransmits, machine.timer )
+            elif report is not None and floNow >= report.due:
+                report.update( floNow, min( machine.acked * machine.blksize, machine.size ),
+                               machine.acked, machine.retransmits, machine.timer )
+        intSize = machine.size if machine.compressor is None else machine.compressor.size
+        # The blocks count what crossed the wire, tsize the file.
+        if ( not check_size( machine.size, machine.sent, machine.blksize, machine.last_len )
+             or size is not None and intSize != size ):
+            err_msg = "Size mismatch: bad transfer. Try again"
+            raise TFTPGeneralError(err_msg)
+        strDigest = check_digest( hasher, expected )
+    except BaseException as e:
+        if bolConnected and isinstance( e, asyncio.CancelledError ):
+            sock.sendto( pack_err( ERR_NOT_DEFINED, "Transfer cancelled" ), plug )
+        if report is not None:
+            report.finish( min( machine.acked * machine.blksize, machine.size ), machine.acked,
+                           machine.retransmits, machine.timer, e )
+        raise
+    finally:
+        sock.close()
+    result = TransferResult( intSize, machine.sent, machine.retransmits, machine.duplicates,
+                             machine.timer.srtt, time.monotonic() - floStart, strDigest,
+                             compression=machine.compression, wire=machine.size )
+    if report is not None:
+        report.finish( intSize, machine.sent, machine.retransmits, machine.timer )
+    return result
+#    print( f"tftp put -p {port} {serverip} {origin} {destination}" )
+
+async def afetch_sidecar( port: int, server: str, serverip: str, origin: str,
+                          blksize: int | None = None ) -> str:
+    """
+    This coroutine fetches the digest of 'origin' from the sidecar file
+    next to it in the server, 'origin' + SIDECAR_SUFFIX, as written by
+    sha256sum: the digest, then the name.
+    """
+    fileSidecar = io.BytesIO()
+    await aget_stream( port, server, serverip, origin + SIDECAR_SUFFIX, fileSidecar, blksize )
+    lstFields = fileSidecar.getvalue().split()
+    strDigest = lstFields[0].decode( errors="replace" ).lower() if lstFields else ""
+    if len( strDigest ) != _DIGEST_LENGTHS["sha256"] or not all( c in string.hexdigits for c in strDigest ):
+        raise TFTPGeneralError( f"Invalid digest in {origin + SIDECAR_SUFFIX}." )
+    return strDigest
+
+async def aput_sidecar( port: int, server: str, serverip: str, destination: str, digest: str,
+                        blksize: int | None = None ) -> TransferResult:
+    """
+    This coroutine stores the sha256 'digest' of 'destination' in the
+    sidecar file next to it in the server, as sha256sum would.
+    """
+    binSidecar = f"{digest}  {os.path.basename( destination )}\n".encode()
+    return await aput_stream( port, server, serverip, io.BytesIO( binSidecar ),
+                              destination + SIDECAR_SUFFIX, len( binSidecar ), blksize )
+
+def get_file( port: int, server: str, serverip: str, origin: str, destination: str,
+              blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+              verbose: bool = True,
+              progress: Callable[[TransferProgress], None] | None = None,
+              mode: str = DEFAULT_MODE, digest: str | None = None,
+              expected: str | None = None, buffer: int = IO_BUFFER_SIZE,
+              fsync: bool = False, rate: float | None = None,
+              compress: str | None = None ) -> TransferResult:
+    """
+    This method is responsible for downloading the selected file from server.
+    It runs aget_file() to completion on an event loop of its own.
+    """
+    return run( aget_file( port, server, serverip, origin, destination, blksize, windowsize,
+                           verbose, progress, mode, digest, expected, buffer, fsync, rate,
+                           compress ) )
+
+def put_file( port: int, server: str, serverip: str, origin: str, destination: str,
+              blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+              verbose: bool = True,
+              progress: Callable[[TransferProgress], None] | None = None,
+              mode: str = DEFAULT_MODE, digest: str | None = None,
+              expected: str | None = None, buffer: int = IO_BUFFER_SIZE,
+              rate: float | None = None, aimd: bool = False,
+              compress: str | None = None ) -> TransferResult:
+    """
+    This method is responsible for uploading the selected file to server.
+    It runs aput_file() to completion on an event loop of its own.
+    """
+    return run( aput_file( port, server, serverip, origin, destination, blksize, windowsize,
+                           verbose, progress, mode, digest, expected, buffer, rate, aimd,
+                           compress ) )
+
+def get_multicast( port: int, server: str, serverip: str, origin: str, destination: str,
+                   blksize: int | None = None, verbose: bool = True,
+                   progress: Callable[[TransferProgress], None] | None = None ) -> TransferResult:
+    """
+    This method downloads the selected file from server over multicast
+    (RFC 2090). It runs aget_multicast() on an event loop of its own.
+    """
+    return run( aget_multicast( port, server, serverip, origin, destination,
+                                blksize, verbose, progress ) )
+
+def get_stream( port: int, server: str, serverip: str, origin: str, file,
+                blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+                verbose: bool = False,
+                progress: Callable[[TransferProgress], None] | None = None,
+                mode: str = DEFAULT_MODE, digest: str | None = None,
+                expected: str | None = None, rate: float | None = None,
+                compress: str | None = None ) -> TransferResult:
+    """
+    This method downloads the selected file from server into 'file', any
+    writable binary object, e.g. sys.stdout.buffer or a BytesIO.
+    """
+    return run( aget_stream( port, server, serverip, origin, file, blksize, windowsize,
+                             verbose, progress, mode, digest, expected, rate, compress ) )
+
+def put_stream( port: int, server: str, serverip: str, source, destination: str,
+                size: int | None = None, blksize: int | None = None,
+                windowsize: int = DEFAULT_WINDOWSIZE, verbose: bool = False,
+                progress: Callable[[TransferProgress], None] | None = None,
+                mode: str = DEFAULT_MODE, digest: str | None = None,
+                expected: str | None = None, rate: float | None = None,
+                aimd: bool = False, compress: str | None = None ) -> TransferResult:
+    """
+    This method uploads to server what is read from 'source', a readable
+    binary object or an iterable of bytes.
+    """
+    return run( aput_stream( port, server, serverip, source, destination, size, blksize,
+                             windowsize, verbose, progress, mode, digest, expected, rate, aimd,
+                             compress ) )
+
+def iter_file( port: int, server: str, serverip: str, origin: str,
+               blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+               progress: Callable[[TransferProgress], None] | None = None,
+               limit: int = STREAM_BUFFER_SIZE ):
+    """
+    This generator downloads the selected file from server, yielding it
+    in chunks as it arrives. The transfer only moves on while the next
+    chunk is asked for; leaving the loop early aborts it.
+    """
+    with asyncio.Runner(loop_factory=asyncio.SelectorEventLoop) as runner:
+        chunks = aiter_file( port, server, serverip, origin, blksize, windowsize, progress, limit )
+        try:
+            while ( data := runner.run( _next_chunk( chunks ) ) ) is not None:
+                yield data
+        finally:
+            runner.run( chunks.aclose() )
+
+async def aiter_file( port: int, server: str, serverip: str, origin: str,
+                      blksize: int | None = None, windowsize: int = DEFAULT_WINDOWSIZE,
+                      progress: Callable[[TransferProgress], None] | None = None,
+                      limit: int = STREAM_BUFFER_SIZE ):
+    """
+    This async generator downloads the selected file from server,
+    yielding what has arrived since the last chunk. With more than
+    'limit' bytes waiting for the consumer, the transfer stops
+    acknowledging blocks until they are taken. An error of the transfer
+    is raised once the chunks received before it are consumed.
+    """
+    sink = _ChunkSink( limit )
+
+    async def transfer() -> TransferResult:
+        try:
+            return await aget_stream( port, server, serverip, origin, sink,
+                                      blksize, windowsize, False, progress )
+        finally:
+            sink.close()
+
+    task = asyncio.ensure_future( transfer() )
+    try:
+        while data := await sink.read():
+            yield data
+        await task
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+async def _next_chunk( chunks ) -> bytes | None:
+    return await anext( chunks, None )
+
+class _ChunkSink:
+    """
+    The file of the transfer behind aiter_file(): the blocks written are
+    kept until read, and drain() holds the transfer back while more than
+    'limit' bytes wait.
+    """
+    __slots__ = ('_chunks', '_size', '_limit', '_closed', '_readable', '_writable')
+
+    def __init__(self, limit: int):
+        self._chunks = []
+        self._size = 0
+        self._limit = limit
+        self._closed = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def write(self, data: bytes) -> int:
+        # The data may be a view of a buffer about to be reused.
+        self._chunks.append(bytes(data))
+        self._size += len(data)
+        self._readable.set()
+        if self._size >= self._limit:
+            self._writable.clear()
+        return len(data)
+
+    async def drain(self):
+        await self._writable.wait()
+
+    async def read(self) -> bytes:
+        """
+        Returns everything written so far, b'' once closed and empty.
+        """
+        await self._readable.wait()
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self._size = 0
+        if not self._closed:
+            self._readable.clear()
+        self._writable.set()
+        return data
+
+    def close(self):
+        self._closed = True
+        self._readable.set()
+
+def _stream_reader(source) -> Callable[[memoryview], int]:
+    """
+    This method returns a readinto() for 'source', a readable binary
+    object or an iterable of bytes, that fills the whole buffer unless
+    the end is reached: a pipe gives what it has, but a short block
+    would end the transfer.
+    """
+    if hasattr(source, 'readinto'):
+        read = source.readinto
+    elif hasattr(source, 'read'):
+        def read(view: memoryview) -> int:
+            data = source.read(len(view))
+            view[:len(data)] = data
+            return len(data)
+    else:
+        read = _IteratorReader(source).readinto
+
+    def readinto(view: memoryview) -> int:
+        size = read(view) or 0
+        while size and size < len(view):
+            more = read(view[size:]) or 0
+            if not more:
+                break
+            size += more
+        return size
+
+    return readinto
+
+class _IteratorReader:
+    """
+    A readinto() over an iterable of bytes, chunks of any size.
+    """
+    __slots__ = ('_chunks', '_pending')
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readinto(self, view: memoryview) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk).cast('B')
+        size = min(len(view), len(self._pending))
+        view[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+class ContentCache:
+    """
+    A read-through cache of downloads in 'directory', shared by every
+    process that uses it. A file is kept under a key made of the server,
+    its address, the port and the name and of its date and size in the
+    DIR_LISTING of the server, fetched at most every LISTING_TTL seconds,
+    so that a file changed in the server is a new key; a file the
+    listing does not show (or a server without one) is only kept for
+    'ttl' seconds.
+    Entries are written to a temporary file and renamed into place, so
+    a concurrent process sees either none or all of them, and served by
+    a reflink (or a copy) or, with 'link', a hard link: the fastest, but
+    then the file got must not be changed in place. The least recently
+    used ones are evicted past 'limit' bytes. 'hits' and 'misses' count
+    the downloads served from it and from the network.
+    """
+
+    def __init__(self, directory: str, limit: int = CACHE_SIZE, ttl: float = CACHE_TTL,
+                 link: bool = False):
+        self.directory = directory
+        self.limit = limit
+        self.ttl = ttl
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._listings = {}     # (serverip, port) => [ expiry, index or None ]
+        os.makedirs(directory, exist_ok=True)
+
+    async def aget(self, port: int, server: str, serverip: str, origin: str, destination: str,
+                   blksize: int | None, download: Callable[[], Awaitable[TransferResult]],
+                   digest: str | None = None, expected: str | None = None) -> TransferResult:
+        """
+        This coroutine gets 'origin' into 'destination' from the cache or,
+        when not there, by awaiting 'download' and keeps what it got.
+        """
+        start = time.monotonic()
+        stamp = await self._astamp(port, server, serverip, origin, blksize)
+        # The name alone is not enough: every address without a reverse
+        # name is the same 'Unnamed' server to client.py.
+        key = hashlib.sha256('\0'.join((server or '', serverip, str(port), origin, *(stamp or ('', ''))))
+                             .encode()).hexdigest()
+        entry = os.path.join(self.directory, key)
+        try:
+            stat = os.stat(entry)
+            if stamp is None and time.time() - stat.st_mtime > self.ttl:
+                raise FileNotFoundError(entry)
+            result = self._serve(entry, destination, digest, expected)
+            # Entries are evicted by their access time, kept by hand as
+            # file systems mounted noatime do not.
+            os.utime(entry, (time.time(), stat.st_mtime))
+        except (OSError, TFTPGeneralError):
+            pass
+        else:
+            self.hits += 1
+            result.elapsed = time.monotonic() - start
+            return result
+        self.misses += 1
+        result = await download()
+        temporary = os.path.join(self.directory, f'.{key}.{os.getpid()}.tmp')
+        try:
+            _clone(destination, temporary, self.link)
+            os.replace(temporary, entry)
+            self._evict()
+        except OSError:
+            # A file that cannot be cached is just not kept.
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return result
+
+    async def _astamp(self, port: int, server: str, serverip: str, origin: str,
+                      blksize: int | None) -> tuple[str, str] | None:
+        """
+        This coroutine returns the date and size of 'origin' in the listing
+        of the server, or None when it is not listed.
+        """
+        cached = self._listings.get((serverip, port))
+        if cached is None or cached[0] < time.monotonic():
+            file = io.BytesIO()
+            try:
+                await aget_stream(port, server, serverip, DIR_LISTING, file, blksize)
+                index = index_listing(parse_listing(file.getvalue()))
+            except TFTPGeneralError:
+                index = None
+            cached = self._listings[(serverip, port)] = [time.monotonic() + LISTING_TTL, index]
+        return cached[1] and cached[1].get(origin)
+
+    def _serve(self, entry: str, destination: str, digest: str | None,
+               expected: str | None) -> TransferResult:
+        if expected is not None and digest is None:
+            digest = digest_of(expected)
+        strDigest = None
+        if digest:
+            hasher = new_digest(digest)
+            with open(entry, 'rb') as file:
+                while chunk := file.read(IO_CHUNK_SIZE):
+                    hasher.update(chunk)
+            strDigest = check_digest(hasher, expected)
+        temporary = f'{destination}.{os.getpid()}.tmp'
+        try:
+            _clone(entry, temporary, self.link)
+            os.replace(temporary, destination)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return TransferResult(os.stat(destination).st_size, 0, 0, 0, None, 0.0, strDigest, True)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for item in scan:
+                if item.name.startswith('.') or not item.is_file():
+                    continue
+                stat = item.stat()
+                entries.append((stat.st_atime, stat.st_size, item.path))
+                total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Evicted by another process already.
+                pass
+            total -= size
+
+def _clone(origin: str, destination: str, link: bool = False):
+    """
+    This method makes 'destination' a hard link to 'origin', with 'link',
+    or else a reflink of it, where the file system shares the data of
+    files (btrfs, XFS), or a copy.
+    """
+    if link:
+        try:
+            os.link(origin, destination)
+            return
+        except OSError:
+            # Across file systems, say: copied instead.
+            pass
+    if os.name != 'nt':
+        with open(origin, 'rb') as source, open(destination, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(origin, destination)
+
+# Downloads by aget_file() go through it when set.
+cache: ContentCache | None = None
+
+class _WriteBehind:
+    """
+    A file written behind a download by a thread of its own. Blocks are
+    gathered in memory and handed over IO_CHUNK_SIZE bytes at a time, so
+    that the writes are all of the same size and aligned in the file but
+    the last one, and receiving a block and acknowledging it never waits
+    on the disk:
+    drain() holds the transfer back only while more than 'limit' bytes
+    wait to be written. truncate() is queued along with the data, in
+    order; aclose() waits for all of it and, with 'fsync', for the data
+    to reach the disk.
+    """
+    __slots__ = ('_file', '_limit', '_fsync', '_chunk', '_fill', '_queue', '_cond', '_pending',
+                 '_error', '_discard', '_loop', '_room', '_done', '_thread')
+
+    def __init__(self, file, limit: int = IO_BUFFER_SIZE, fsync: bool = False):
+        self._file = file
+        self._limit = limit
+        self._fsync = fsync
+        self._chunk = bytearray(IO_CHUNK_SIZE)
+        self._fill = 0                      # bytes of '_chunk' gathered
+        self._queue = collections.deque()   # chunks and calls, None to stop
+        self._cond = threading.Condition()
+        self._pending = 0                   # bytes queued, not written yet
+        self._error = None
+        self._discard = False
+        self._loop = asyncio.get_running_loop()
+        self._room = None                   # future drain() waits on
+        self._done = self._loop.create_future()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def fileno(self) -> int:
+        return self._file.fileno()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            size = min(len(view), IO_CHUNK_SIZE - self._fill)
+            self._chunk[self._fill:self._fill + size] = view[:size]
+            self._fill += size
+            view = view[size:]
+            if self._fill == IO_CHUNK_SIZE:
+                self._put(self._chunk)
+                self._chunk = bytearray(IO_CHUNK_SIZE)
+                self._fill = 0
+
+    def _put_rest(self):
+        if self._fill:
+            self._put(self._chunk[:self._fill])
+            self._fill = 0
+
+    def truncate(self, size: int | None = None):
+        self._put_rest()
+        self._put(lambda: self._file.truncate(size))
+
+    def _put(self, item):
+        with self._cond:
+            self._queue.append(item)
+            if isinstance(item, bytearray):
+                self._pending += len(item)
+            self._cond.notify()
+
+    async def drain(self):
+        while self._pending > self._limit and self._error is None:
+            with self._cond:
+                if self._pending <= self._limit:
+                    break
+                self._room = room = self._loop.create_future()
+            await room
+        if self._error is not None:
+            raise self._error
+
+    async def aclose(self, discard: bool = False):
+        self._discard = discard
+        self._put_rest()
+        if self._fsync and not discard:
+            self._put(self._sync)
+        self._put(None)
+        await self._done
+        if self._error is not None and not discard:
+            raise self._error
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                item = self._queue.popleft()
+            if item is None:
+                break
+            if self._error is None and not self._discard:
+                try:
+                    if isinstance(item, bytearray):
+                        self._file.write(item)
                     else:
-                        err_msg = f"Bad transfer: block {intBlockAck} instead of {intBlock}."
-                        raise TFTPGeneralError(err_msg)
-                    if len( msg ) < MAX_DATA_LEN + 4:
-                        sock.sendto( msg, plug )
+                        item()
+                except (OSError, ValueError) as e:
+                    self._error = e
+            if isinstance(item, bytearray):
+                with self._cond:
+                    self._pending -= len(item)
+                    room = self._room
+                    if room is not None and (self._pending <= self._limit or self._error is not None):
+                        self._room = None
+                        self._loop.call_soon_threadsafe(_resolve, room)
+        self._loop.call_soon_threadsafe(_resolve, self._done)
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+class _ReadAhead:
+    """
+    A readinto() over a file read ahead of an upload by a thread of its
+    own, IO_CHUNK_SIZE bytes at a time and up to 'limit' bytes ahead, so
+    that sending a block does not wait on the disk unless the disk is
+    slower than the network.
+    """
+    __slots__ = ('_file', '_limit', '_chunks', '_cond', '_ready', '_current',
+                 '_eof', '_error', '_closed', '_thread')
+
+    def __init__(self, file, limit: int = IO_BUFFER_SIZE):
+        self._file = file
+        self._limit = limit
+        self._chunks = collections.deque()
+        self._cond = threading.Condition()
+        self._ready = 0                     # bytes read, not taken yet
+        self._current = memoryview(b'')
+        self._eof = False
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='read-ahead', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._ready >= self._limit and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            try:
+                chunk = self._file.read(IO_CHUNK_SIZE)
+            except (OSError, ValueError) as e:
+                chunk = b''
+                self._error = e
+            with self._cond:
+                if chunk:
+                    self._chunks.append(memoryview(chunk))
+                    self._ready += len(chunk)
+                else:
+                    self._eof = True
+                self._cond.notify_all()
+            if not chunk:
+                return
+
+    def readinto(self, view: memoryview) -> int:
+        size = 0
+        while size < len(view):
+            if not self._current:
+                with self._cond:
+                    while not self._chunks and not self._eof:
+                        self._cond.wait()
+                    if self._error is not None:
+                        raise self._error
+                    if not self._chunks:
                         break
-                elif unpack_opcode( packet ) == ERR:
-                    error_code, error_msg = unpack_err( packet )
-                    err_msg = f"\n\nError {error_code}: {error_msg}"
-                    raise TFTPGeneralError(err_msg)
-            except TimeoutError:
-                if intStatusCode == 0:
-                    err_msg = f"Could not establish connection to {plug[0]}:{plug[1]}."
-                    raise TimeoutError( err_msg )
+                    self._current = self._chunks.popleft()
+                    self._ready -= len(self._current)
+                    self._cond.notify_all()
+            more = min(len(view) - size, len(self._current))
+            view[size:size + more] = self._current[:more]
+            self._current = self._current[more:]
+            size += more
+        return size
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        # At most a chunk being read: the file is closed next.
+        self._thread.join()
+
+class NetasciiEncoder:
+    """
+    Translates text to netascii (RFC 764, as RFC 1350 asks for) chunk by
+    chunk: the local line ends to CR LF and any other CR to CR NUL, each
+    with a bulk replace over the whole chunk. Where the local line end
+    is CR LF, a CR at the end of a chunk is held until the next one tells
+    whether a LF follows it; flush() gives it at the end of the text.
+    """
+    __slots__ = ('_pending',)
+
+    def __init__(self):
+        self._pending = b''
+
+    def encode(self, data) -> bytes:
+        data = self._pending + data
+        if _LOCAL_NEWLINE == b'\r\n':
+            self._pending = b'\r' if data.endswith(b'\r') else b''
+            data = data[:len(data) - len(self._pending)].replace(b'\r\n', b'\n')
+        return data.replace(b'\r', b'\r\x00').replace(b'\n', b'\r\n')
+
+    def flush(self) -> bytes:
+        data, self._pending = self._pending, b''
+        return data.replace(b'\r', b'\r\x00')
+
+class NetasciiDecoder:
+    """
+    Translates netascii back, chunk (block) by chunk: CR LF to the local
+    line end and CR NUL to CR. A CR at the end of a chunk is held until
+    the next one, which starts with the other half of the pair; flush()
+    gives it, as it is, at the end of the text.
+    """
+    __slots__ = ('_pending',)
+
+    def __init__(self):
+        self._pending = b''
+
+    def decode(self, data) -> bytes:
+        data = self._pending + data
+        self._pending = b'\r' if data.endswith(b'\r') else b''
+        # A CR always starts a pair, so the replaces cannot overlap.
+        data = data[:len(data) - len(self._pending)].replace(b'\r\n', b'\n').replace(b'\r\x00', b'\r')
+        if _LOCAL_NEWLINE != b'\n':
+            data = data.replace(b'\n', _LOCAL_NEWLINE)
+        return data
+
+    def flush(self) -> bytes:
+        data, self._pending = self._pending, b''
+        return data
+
+def netascii_size(data: memoryview) -> int:
+    """
+    Returns the size of 'data' once translated to netascii, e.g. for
+    tsize, translating NETASCII_CHUNK bytes at a time and keeping none.
+    """
+    encoder = NetasciiEncoder()
+    size = 0
+    for offset in range(0, len(data), NETASCII_CHUNK):
+        size += len(encoder.encode(data[offset:offset + NETASCII_CHUNK].tobytes()))
+    return size + len(encoder.flush())
+
+class NetasciiReader:
+    """
+    A readinto() that translates what another one reads to netascii,
+    NETASCII_CHUNK bytes at a time, filling whole blocks with the result.
+    """
+    __slots__ = ('_read', '_encoder', '_chunk', '_pending', '_done')
+
+    def __init__(self, readinto: Callable[[memoryview], int]):
+        self._read = readinto
+        self._encoder = NetasciiEncoder()
+        self._chunk = memoryview(bytearray(NETASCII_CHUNK))
+        self._pending = bytearray()
+        self._done = False
+
+    def readinto(self, view: memoryview) -> int:
+        while len(self._pending) < len(view) and not self._done:
+            size = self._read(self._chunk)
+            if size:
+                self._pending += self._encoder.encode(self._chunk[:size].tobytes())
+            else:
+                self._pending += self._encoder.flush()
+                self._done = True
+        size = min(len(view), len(self._pending))
+        view[:size] = self._pending[:size]
+        # Cheap: a bytearray just moves its start when cut at the front.
+        del self._pending[:size]
+        return size
+
+def new_compressor(name: str):
+    """
+    This method returns a new streaming compressor, with compress() and
+    flush(), for 'name', one of COMPRESSIONS.
+    """
+    if name == 'zlib':
+        return zlib.compressobj(ZLIB_LEVEL)
+    if name == 'lzma':
+        return lzma.LZMACompressor(lzma.FORMAT_XZ, preset=LZMA_PRESET)
+    raise TFTPValueError(f'Compression {name} not supported')
+
+class CompressingReader:
+    """
+    A readinto() that compresses what another one reads, COMPRESS_CHUNK
+    bytes at a time, filling whole blocks with the result. 'size' counts
+    the bytes read, before compression.
+    """
+    __slots__ = ('_read', '_engine', '_chunk', '_pending', '_done', 'size')
+
+    def __init__(self, readinto: Callable[[memoryview], int], name: str):
+        self._read = readinto
+        self._engine = new_compressor(name)
+        self._chunk = memoryview(bytearray(COMPRESS_CHUNK))
+        self._pending = bytearray()
+        self._done = False
+        self.size = 0
+
+    def readinto(self, view: memoryview) -> int:
+        while len(self._pending) < len(view) and not self._done:
+            size = self._read(self._chunk)
+            if size:
+                self.size += size
+                self._pending += self._engine.compress(self._chunk[:size])
+            else:
+                self._pending += self._engine.flush()
+                self._done = True
+        size = min(len(view), len(self._pending))
+        view[:size] = self._pending[:size]
+        del self._pending[:size]
+        return size
+
+class Decompressor:
+    """
+    Undoes a CompressingReader, block by block: decompress() gives the
+    data in chunks of COMPRESS_CHUNK bytes at most, however much a block
+    expands (zeros do, a thousand times), and flush() checks at the end
+    that the stream was whole. 'size' counts the bytes given.
+    """
+    __slots__ = ('name', '_engine', 'size')
+
+    def __init__(self, name: str):
+        if name not in COMPRESSIONS:
+            raise TFTPValueError(f'Compression {name} not supported')
+        self.name = name
+        self._engine = zlib.decompressobj() if name == 'zlib' else lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        self.size = 0
+
+    def decompress(self, data) -> Iterator[bytes]:
+        engine = self._engine
+        if engine.eof:
+            if data:
+                raise TFTPGeneralError('Data past the end of the compressed stream.')
+            return
+        try:
+            chunk = engine.decompress(data, COMPRESS_CHUNK)
+            while True:
+                if chunk:
+                    self.size += len(chunk)
+                    yield chunk
+                if self.name == 'zlib':
+                    # Past the end, what follows stays in the tail.
+                    if not engine.unconsumed_tail or engine.eof:
+                        break
+                    chunk = engine.decompress(engine.unconsumed_tail, COMPRESS_CHUNK)
                 else:
-                    if intAttempt >= MAX_ATTEMPTS:
-                        err_msg = f"Block {intBlock} lost. Maximum retry attempts reached."
-                        raise TimeoutError( err_msg )
-                    logit( 2, f"Block {intBlock} lost. Retransmitting...{intAttempt}",
-                          intStatusCode == 2 )
-                    intStatusCode = 2
-                    intAttempt += 1
-    sock.close()
-    if intFileSize == ( intBlock - 1 ) * MAX_DATA_LEN + len( binData ):
-        print( f"Sent file '{origin}' {intFileSize} bytes.\n" )
-    else:
-        err_msg = "Size mismatch: bad transfer. Try again"
-        raise TFTPGeneralError(err_msg)
-    show_cursor()
-#    print( f"tftp put -p {port} {serverip} {origin} {destination}" )
+                    if engine.needs_input or engine.eof:
+                        break
+                    chunk = engine.decompress(b'', COMPRESS_CHUNK)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise TFTPGeneralError(f'Bad compressed data: {e}')
+        if engine.eof and engine.unused_data:
+            raise TFTPGeneralError('Data past the end of the compressed stream.')
+
+    def flush(self):
+        if not self._engine.eof:
+            raise TFTPGeneralError('The compressed stream was cut short.')
+
+async def aprobe( port: int, serverips: list[str], name: str,
+                  timeout: float = PROBE_TIMEOUT ) -> str:
+    """
+    This coroutine sends a RRQ of 'name' to every server at once and
+    returns the first one to answer, whatever the answer: even an error
+    tells that the server is up. The transfers the probes start are
+    cancelled with an ERR, in the background for the servers that
+    answer after the first one.
+    """
+    dicEndpoints = {}
+    lstTasks = []
+    msg = pack_rrq( name )
+    try:
+        for strIP in serverips:
+            dicEndpoints[strIP] = _open_endpoint( DEFAULT_BUFFER_SIZE, address_family( strIP ) )
+        for _ in range( PROBE_ATTEMPTS ):
+            for strIP, sock in dicEndpoints.items():
+                sock.sendto( msg, ( strIP, port ) )
+            lstTasks = [ asyncio.create_task( _probe_answer( sock, strIP, timeout ) )
+                         for strIP, sock in dicEndpoints.items() ]
+            for task in asyncio.as_completed( lstTasks ):
+                strIP = await task
+                if strIP is not None:
+                    return strIP
+    finally:
+        # Not awaited: the transfer goes on while the others answer.
+        task = asyncio.ensure_future( _probe_linger( lstTasks, list( dicEndpoints.values() ) ) )
+        _lingering.add( task )
+        task.add_done_callback( _lingering.discard )
+    err_msg = f"Could not establish connection to {', '.join( serverips )}."
+    raise TFTPUnreachableError( err_msg )
+
+async def _probe_answer( sock: "_TransferEndpoint", serverip: str, timeout: float ) -> str | None:
+    try:
+        _, addr = await sock.recvfrom( timeout )
+    except TimeoutError:
+        return None
+    sock.sendto( pack_err( ERR_NOT_DEFINED, "Probe" ), addr )
+    return serverip
+
+async def _probe_linger( tasks: list[asyncio.Task], endpoints: list["_TransferEndpoint"] ):
+    try:
+        await asyncio.gather( *tasks, return_exceptions=True )
+    finally:
+        for sock in endpoints:
+            sock.close()
+
+_lingering = set()      # the tasks of _probe_linger(), not to be collected while they run
+
+async def afailover( transfer, port: int, server: str, serverips: list[str], name: str,
+                     *args, **kwargs ) -> TransferResult:
+    """
+    This coroutine runs 'transfer' (aget_file, aput_stream...) against
+    the first of 'serverips', addresses of the server or of its mirrors;
+    when that one does not answer the request, the others are probed
+    with a request of 'name' and the transfer goes to the first to
+    answer, and so on until one of them answers the transfer too.
+    The remaining arguments are those of 'transfer' after serverip.
+    """
+    lstCandidates = list( serverips )
+    strIP = lstCandidates[0]
+    while True:
+        try:
+            return await transfer( port, server, strIP, *args, **kwargs )
+        except TFTPUnreachableError:
+            lstCandidates.remove( strIP )
+            if not lstCandidates:
+                raise
+        if len( lstCandidates ) > 1:
+            strIP = await aprobe( port, lstCandidates, name )
+        else:
+            strIP = lstCandidates[0]
+
+def failover( transfer, port: int, server: str, serverips: list[str], name: str,
+              *args, **kwargs ) -> TransferResult:
+    """
+    This method runs afailover() on an event loop of its own.
+    """
+    return run( afailover( transfer, port, server, serverips, name, *args, **kwargs ) )
+
+def run(coro):
+    """
+    This method runs a coroutine of this module, e.g. many transfers
+    gathered together, to completion on a new event loop. The transfers
+    need a selector event loop, which is not the default on Windows.
+    """
+    with asyncio.Runner(loop_factory=asyncio.SelectorEventLoop) as runner:
+        return runner.run(coro)
+
+class _TransferEndpoint:
+    """
+    The UDP endpoint of a single transfer on the event loop. Datagrams
+    are read with recvfrom_into straight into a buffer preallocated for
+    the transfer and reused for every one of them, so what recvfrom()
+    returns is a view that is only valid until it is called again.
+    """
+    __slots__ = ('_sock', '_group', '_loop', '_buffer', '_waiter', '_inet6', '_peer', '_stale',
+                 '_request', 'from_group', 'trace')
+
+    def __init__(self, sock: socket.socket, size: int, buffer: memoryview | None = None,
+                 stale: INET4Address | None = None):
+        self._sock = sock
+        self._group = None
+        self._inet6 = sock.family == socket.AF_INET6
+        self._loop = asyncio.get_running_loop()
+        self._buffer = buffer if buffer is not None else memoryview(bytearray(size))
+        self._waiter = None
+        self._peer = None       # the last address received from
+        self._stale = stale     # the peer of the last transfer on a pooled socket
+        self._request = None    # the address of the request, the first packet sent
+        self.from_group = False
+        self.trace = None       # records every packet, see PacketTrace
+        self._loop.add_reader(sock.fileno(), self._readable)
+
+    def _readable(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def sendto(self, data: bytes, addr: INET4Address):
+        if self._request is None:
+            self._request = addr
+            if addr == self._stale:
+                # A port taking requests is no transfer ID.
+                self._stale = None
+        if self.trace is not None:
+            self.trace(TRACE_OUT, data, addr)
+        try:
+            self._sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            # The send buffer is full: as good as lost on the way, the
+            # retransmission timer takes care of it.
+            pass
+
+    async def recvfrom(self, timeout: float) -> tuple[memoryview, INET4Address]:
+        timer = None
+        try:
+            while True:
+                try:
+                    size, addr = self._sock.recvfrom_into(self._buffer)
+                    self.from_group = False
+                    if self._inet6:
+                        # Without the flow info and scope id, to be
+                        # compared with the (address, port) sent to.
+                        addr = addr[:2]
+                    if self._stale is not None:
+                        # A late retransmission of the transfer that had
+                        # the socket before is not the answer awaited.
+                        if addr == self._stale:
+                            continue
+                        self._stale = None
+                    self._peer = addr
+                    if self.trace is not None:
+                        self.trace(TRACE_IN, self._buffer[:size], addr)
+                    return self._buffer[:size], addr
+                except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+                    pass
+                if self._group is not None:
+                    try:
+                        size, addr = self._group.recvfrom_into(self._buffer)
+                        self.from_group = True
+                        if self.trace is not None:
+                            self.trace(TRACE_IN, self._buffer[:size], addr)
+                        return self._buffer[:size], addr
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                if timer is None:
+                    timer = self._loop.call_later(timeout, self._expire)
+                self._waiter = self._loop.create_future()
+                await self._waiter
+        finally:
+            self._waiter = None
+            if timer is not None:
+                timer.cancel()
+
+    def _expire(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_exception(TimeoutError())
+
+    def reserve(self, size: int):
+        """
+        Grows the kernel receive buffer so that it can hold 'size' bytes
+        of datagrams, e.g. a whole window, while the loop is busy.
+        """
+        # The kernel doubles the value set, for its own bookkeeping.
+        for sock in (self._sock, self._group):
+            if sock is not None and sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < 2 * size:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * size)
+
+    def join(self, group: str, port: int, interface: str):
+        """
+        Joins the multicast 'group' on 'interface': the datagrams sent to
+        it on 'port' are received along with those of the transfer, with
+        'from_group' telling them apart.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(False)
+        # Bound to the group, other groups on the same port are left out,
+        # but Windows only binds to local addresses.
+        sock.bind((group if os.name == 'posix' else '', port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        socket.inet_aton(group) + socket.inet_aton(interface))
+        self._group = sock
+        self._loop.add_reader(sock.fileno(), self._readable)
+
+    def close(self):
+        self._loop.remove_reader(self._sock.fileno())
+        pool = endpoints if self._group is None else None
+        # Only the transfer ID of a server may be stale: what comes from
+        # the port of the request, e.g. an ERR, is no retransmission.
+        peer = self._peer if self._peer != self._request else None
+        if pool is None or not pool.give(self._sock, self._buffer, peer):
+            self._sock.close()
+        if self._group is not None:
+            self._loop.remove_reader(self._group.fileno())
+            self._group.close()
+
+def _local_address(serverip: str) -> str:
+    """
+    This method returns the address of the interface that reaches
+    'serverip', where a multicast group must be joined.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect((serverip, 9))
+            return sock.getsockname()[0]
+        except OSError:
+            return '0.0.0.0'
+
+def _open_endpoint(size: int, family: int = socket.AF_INET) -> _TransferEndpoint:
+    """
+    This method opens the endpoint of a transfer whose datagrams
+    take up to 'size' bytes.
+    """
+    if endpoints is not None:
+        pooled = endpoints.take(family, size)
+        if pooled is not None:
+            return _TransferEndpoint(*pooled)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(('::' if family == socket.AF_INET6 else '0.0.0.0', 0))
+    return _TransferEndpoint(sock, size)
+
+class EndpointPool:
+    """
+    The sockets of the transfers that are done, kept open, up to 'limit'
+    of them, for the next ones along with their receive buffers, which
+    spares a session of many transfers, e.g. the shell of client.py,
+    opening a socket and growing its buffers for every one of them.
+    A socket is drained when given back and, when taken again, drops
+    what still comes from the peer of its last transfer until another
+    peer answers: late retransmissions of a transfer done must not be
+    taken for the first answer to the next request (RFC 1350, TIDs).
+    It is safe to share among threads, each with its own event loop.
+    """
+    __slots__ = ('limit', '_idle', '_lock')
+
+    def __init__(self, limit: int = POOLED_ENDPOINTS):
+        self.limit = limit
+        self._idle = []             # (socket, buffer, peer), the last given back at the end
+        self._lock = threading.Lock()
+
+    def take(self, family: int, size: int) -> tuple[socket.socket, int, memoryview | None,
+                                                     INET4Address | None] | None:
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                sock, buffer, peer = self._idle[i]
+                if sock.family == family:
+                    del self._idle[i]
+                    return sock, size, buffer if len(buffer) >= size else None, peer
+        return None
+
+    def give(self, sock: socket.socket, buffer: memoryview, peer: INET4Address | None) -> bool:
+        """
+        Keeps 'sock' for another transfer, unless the pool is full: then
+        the caller closes it.
+        """
+        while True:
+            try:
+                sock.recvfrom_into(buffer)
+            except (InterruptedError, ConnectionRefusedError):
+                pass
+            except BlockingIOError:
+                break
+            except OSError:
+                return False
+        with self._lock:
+            if len(self._idle) >= self.limit:
+                return False
+            self._idle.append((sock, buffer, peer))
+        return True
+
+    def close(self):
+        with self._lock:
+            for sock, _, _ in self._idle:
+                sock.close()
+            self._idle.clear()
+
+endpoints: EndpointPool | None = None
 
 ##############################################################
 ##                                                          ## 
@@ -316,19 +2960,23 @@ def put_file( port: int, server: str, serverip: str, origin: str, destination: s
 ##                                                          ##
 ############################################################## 
 
-def pack_rrq(filename: str, mode: str = DEFAULT_MODE) -> bytes:
-    return _pack_rrq_wrq(RRQ, filename, mode)
+def pack_rrq(filename: str, mode: str = DEFAULT_MODE,
+             options: dict[str, int | str] | None = None) -> bytes:
+    return _pack_rrq_wrq(RRQ, filename, mode, options)
 
-def pack_wrq(filename: str, mode: str = DEFAULT_MODE) -> bytes:
-    return _pack_rrq_wrq(WRQ, filename, mode)
+def pack_wrq(filename: str, mode: str = DEFAULT_MODE,
+             options: dict[str, int | str] | None = None) -> bytes:
+    return _pack_rrq_wrq(WRQ, filename, mode, options)
 
-def _pack_rrq_wrq(opcode: int, filename: str, mode: str = DEFAULT_MODE) -> bytes:
+def _pack_rrq_wrq(opcode: int, filename: str, mode: str = DEFAULT_MODE,
+                  options: dict[str, int | str] | None = None) -> bytes:
     if not is_ascii_printable(filename):
         raise TFTPValueError(f"Invalid filename: {filename}. Not ASCII printable")
     filename_bytes = filename.encode() + b'\x00'
     mode_bytes = mode.encode() + b'\x00'
-    fmt = f'!H{len(filename_bytes)}s{len(mode_bytes)}s'
-    return struct.pack(fmt, opcode, filename_bytes, mode_bytes)
+    options_bytes = _pack_options(options or {})
+    fmt = f'!H{len(filename_bytes)}s{len(mode_bytes)}s{len(options_bytes)}s'
+    return struct.pack(fmt, opcode, filename_bytes, mode_bytes, options_bytes)
 
 def unpack_rrq(packet: bytes) -> tuple[str, str]:
     return _unpack_rrq_wrq(RRQ, packet)
@@ -340,24 +2988,58 @@ def _unpack_rrq_wrq(opcode: int, packet: bytes) -> tuple[str, str]:
     received_opcode = unpack_opcode(packet)
     if opcode != received_opcode:
         raise TFTPValueError(f'Invalid opcode: {received_opcode}. Expected opcode: {opcode}')
-    delim_pos = packet.index(b'\x00', 2)
-    filename = packet[2: delim_pos].decode()
-    mode = packet[delim_pos + 1:-1].decode()
-    return filename, mode
+    fields = packet[2:].split(b'\x00')
+    if len(fields) < 3:
+        raise TFTPValueError('Invalid request: missing filename or mode')
+    try:
+        return fields[0].decode(), fields[1].decode()
+    except UnicodeDecodeError:
+        raise TFTPValueError('Invalid request: filename or mode not in UTF-8')
+
+def unpack_request_options(packet: bytes) -> dict[str, str]:
+    """
+    Returns the options (RFC 2347) appended to a RRQ or WRQ packet.
+    """
+    opcode = unpack_opcode(packet)
+    if opcode not in (RRQ, WRQ):
+        raise TFTPValueError(f'Invalid opcode: {opcode}. Expected opcode: {RRQ=} or {WRQ=}')
+    return _unpack_options(packet[2:].split(b'\x00')[2:-1])
+
+def pack_oack(options: dict[str, int | str]) -> bytes:
+    options_bytes = _pack_options(options)
+    return struct.pack(f'!H{len(options_bytes)}s', OACK, options_bytes)
+
+def unpack_oack(packet: bytes) -> dict[str, str]:
+    opcode = unpack_opcode(packet)
+    if opcode != OACK:
+        raise TFTPValueError(f'Invalid opcode: {opcode}. Expected opcode: {OACK=}')
+    return _unpack_options(packet[2:].split(b'\x00')[:-1])
 
-def pack_dat(block_number:int, data: bytes) -> bytes:
+def _pack_options(options: dict[str, int | str]) -> bytes:
+    return b''.join(f'{name}\x00{value}\x00'.encode() for name, value in options.items())
+
+def _unpack_options(fields: list[bytes]) -> dict[str, str]:
+    if len(fields) % 2:
+        raise TFTPValueError('Invalid options: option without value')
+    # Option names are case insensitive (RFC 2347).
+    try:
+        return {fields[i].decode().lower(): fields[i + 1].decode()
+                for i in range(0, len(fields), 2)}
+    except UnicodeDecodeError:
+        raise TFTPValueError('Invalid options: not in UTF-8')
+
+def pack_dat(block_number:int, data: bytes, blksize: int = MAX_DATA_LEN) -> bytes:
     if not 0 <= block_number <= MAX_BLOCK_NUMBER:
         err_msg = f'Block number {block_number} larger than allowed ({MAX_BLOCK_NUMBER})'
         raise TFTPValueError(err_msg)
-    if len(data) > MAX_DATA_LEN:
-        err_msg = f'Data size {block_number} larger than allowed ({MAX_DATA_LEN})'
+    if len(data) > blksize:
+        err_msg = f'Data size {len(data)} larger than allowed ({blksize})'
         raise TFTPValueError(err_msg)
     
-    fmt = f'!HH{len(data)}s'
-    return struct.pack(fmt, DAT, block_number, data)
+    return _HEADER.pack(DAT, block_number) + data
 
 def unpack_dat(packet: bytes) -> tuple[int, bytes]:
-    opcode, block_number = struct.unpack('!HH', packet[:4])
+    opcode, block_number = _HEADER.unpack_from(packet)
     if opcode != DAT:
         raise TFTPValueError(f'Invalid opcode {opcode}. Expecting {DAT=}.')
     return block_number, packet[4:]
@@ -367,10 +3049,10 @@ def pack_ack(block_number: int) -> bytes:
         err_msg = f'Block number {block_number} larger than allowed ({MAX_BLOCK_NUMBER})'
         raise TFTPValueError(err_msg)
     
-    return struct.pack(f'!HH', ACK, block_number)
+    return _HEADER.pack(ACK, block_number)
 
 def unpack_ack(packet: bytes) -> int:
-    opcode, block_number = struct.unpack('!HH', packet)
+    opcode, block_number = _HEADER.unpack(packet)
     if opcode != ACK:
         raise TFTPValueError(f'Invalid opcode {opcode}. Expecting {DAT=}.')
     return block_number
@@ -385,14 +3067,16 @@ def pack_err(error_code: int, error_msg: str | None = None) -> bytes:
     return struct.pack(fmt, ERR, error_code, error_msg_bytes)
 
 def unpack_err(packet: bytes) -> tuple[int, str]:
-    opcode, error_code = struct.unpack('!HH', packet[:4])
+    opcode, error_code = _HEADER.unpack_from(packet)
     if opcode != ERR:
         raise TFTPValueError(f'Invalid opcode: {opcode}. Expected opcode: {ERR=}')
     return error_code, packet[4:-1].decode()
 
 def unpack_opcode(packet: bytes) -> int:
-    opcode, *_ = struct.unpack('!H', packet[:2])
-    if opcode not in (RRQ, WRQ, DAT, ACK, ERR):
+    if len(packet) < _OPCODE.size:
+        raise TFTPValueError(f'Packet too short: {len(packet)} bytes')
+    opcode, = _OPCODE.unpack_from(packet)
+    if opcode not in (RRQ, WRQ, DAT, ACK, ERR, OACK):
         raise TFTPValueError(f'Invalid opcode {opcode}')
     return opcode
 
@@ -413,9 +3097,283 @@ class TFTPGeneralError(ValueError):
     General transmission errors.
     """
 
+class TFTPPeerError(TFTPGeneralError):
+    """
+    The peer ended the transfer with an ERR packet of 'code'.
+    """
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"\n\nError {code}: {message}")
+        self.code = code
+
+class TFTPUnreachableError(TimeoutError):
+    """
+    The server never answered the request: another one may be tried.
+    """
+
 ###############################################################
 ##                                                           ##
 ##                     COMMON UTILITIES                      ##
 ##              Mostly related to network tasks              ##
 ##                                                           ##     
 ###############################################################
+
+def get_path_mtu(serverip: str) -> int:
+    """
+    This method asks the kernel for the MTU of the route to the
+    server, falling back to Ethernet's where that is not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return DEFAULT_MTU
+    try:
+        with socket.socket(address_family(serverip), socket.SOCK_DGRAM) as sock:
+            sock.connect((serverip, 9))
+            if sock.family == socket.AF_INET6:
+                # IPV6_MTU (24) is not always exported either.
+                return sock.getsockopt(socket.IPPROTO_IPV6, getattr(socket, 'IPV6_MTU', 24))
+            # IP_MTU (14) is not exported by the socket module.
+            return sock.getsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_MTU', 14))
+    except OSError:
+        # keep quiet!
+        return DEFAULT_MTU
+
+def address_family(ip: str) -> int:
+    return socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+def default_blksize(serverip: str) -> int:
+    """
+    This method sizes the data blocks so that each DAT packet fits
+    in a single, unfragmented, IP datagram on the way to the server.
+    """
+    blksize = get_path_mtu(serverip) - IP_UDP_TFTP_HEADERS
+    if address_family(serverip) == socket.AF_INET6:
+        blksize -= IPV6_EXTRA_HEADER
+    return max(MAX_DATA_LEN, min(blksize, MAX_BLKSIZE))
+
+def check_mode(mode: str) -> str:
+    """
+    This method returns the transfer mode in lower case, as modes are
+    case insensitive, if it is one we can do.
+    """
+    if mode.lower() not in (DEFAULT_MODE, NETASCII_MODE):
+        raise TFTPValueError(f'Mode {mode} not supported')
+    return mode.lower()
+
+_DIGEST_LENGTHS = {'sha256': 64, 'blake2b': 128, 'crc32': 8}   # hex digits
+
+class _Crc32:
+    """
+    zlib.crc32() behind the interface of the hashlib objects.
+    """
+    __slots__ = ('_value',)
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f'{self._value:08x}'
+
+def new_digest(name: str):
+    """
+    This method returns a new hash object, with update() and hexdigest(),
+    for the digest 'name', one of DIGESTS.
+    """
+    if name == 'crc32':
+        return _Crc32()
+    if name not in DIGESTS:
+        raise TFTPValueError(f'Digest {name} not supported')
+    return hashlib.new(name)
+
+def digest_of(expected: str) -> str:
+    """
+    This method tells which of DIGESTS an expected value is, by its size.
+    """
+    for name, length in _DIGEST_LENGTHS.items():
+        if len(expected.strip()) == length:
+            return name
+    raise TFTPValueError(f'Invalid digest: {expected}')
+
+def parse_listing(data: bytes) -> list[list[str]]:
+    """
+    This method splits the lines of a DIR_LISTING in their fields, name
+    first and size last, leaving the listing itself out.
+    """
+    listing = []
+    for line in data.decode(errors='replace').splitlines():
+        fields = line.split()
+        if len(fields) < 3 or fields[0] == DIR_LISTING:
+            continue
+        listing.append(fields)
+    return listing
+
+def index_listing(listing: list[list[str]]) -> dict[str, tuple[str, str]]:
+    """
+    This method indexes the lines of a listing by name, keeping their
+    date and size. Tftpd64 writes the date in more than one column, so
+    the size is taken from the end of the line.
+    """
+    return {fields[0]: (' '.join(fields[1:-1]), fields[-1]) for fields in listing}
+
+def check_digest(hasher, expected: str | None) -> str | None:
+    """
+    This method returns the digest computed by 'hasher', if any, after
+    checking it against the one expected.
+    """
+    if hasher is None:
+        return None
+    digest = hasher.hexdigest()
+    if expected is not None and digest != expected.strip().lower():
+        raise TFTPGeneralError(f'Digest mismatch: {digest} instead of {expected}.')
+    return digest
+
+def _hashing_reader(readinto: Callable[[memoryview], int], hasher) -> Callable[[memoryview], int]:
+    def read(view: memoryview) -> int:
+        size = readinto(view)
+        hasher.update(view[:size])
+        return size
+    return read
+
+def check_blksize(blksize: int):
+    if not MIN_BLKSIZE <= blksize <= MAX_BLKSIZE:
+        err_msg = f'Block size {blksize} out of range ({MIN_BLKSIZE}..{MAX_BLKSIZE})'
+        raise TFTPValueError(err_msg)
+
+def negotiated_blksize(options: dict[str, str], requested: int) -> int:
+    """
+    This method validates the block size acknowledged by the server
+    in an OACK. A server that ignored the option keeps the 512 bytes
+    of RFC 1350.
+    """
+    if 'blksize' not in options:
+        return MAX_DATA_LEN
+    try:
+        blksize = int(options['blksize'])
+    except ValueError:
+        raise TFTPValueError(f"Invalid blksize: {options['blksize']}")
+    if not MIN_BLKSIZE <= blksize <= requested:
+        raise TFTPValueError(f'Invalid blksize: {blksize}. Requested: {requested}')
+    return blksize
+
+def check_windowsize(windowsize: int):
+    if not 1 <= windowsize <= MAX_WINDOWSIZE:
+        err_msg = f'Window size {windowsize} out of range (1..{MAX_WINDOWSIZE})'
+        raise TFTPValueError(err_msg)
+
+def negotiated_windowsize(options: dict[str, str], requested: int) -> int:
+    """
+    This method validates the window size acknowledged by the server
+    in an OACK. A server that ignored the option keeps the lock-step
+    exchange of RFC 1350.
+    """
+    if 'windowsize' not in options:
+        return DEFAULT_WINDOWSIZE
+    try:
+        windowsize = int(options['windowsize'])
+    except ValueError:
+        raise TFTPValueError(f"Invalid windowsize: {options['windowsize']}")
+    if not 1 <= windowsize <= requested:
+        raise TFTPValueError(f'Invalid windowsize: {windowsize}. Requested: {requested}')
+    return windowsize
+
+def negotiated_tsize(options: dict[str, str]) -> int | None:
+    """
+    This method returns the file size announced by the server in an
+    OACK, or None when the server did not acknowledge the option.
+    """
+    if 'tsize' not in options:
+        return None
+    try:
+        tsize = int(options['tsize'])
+    except ValueError:
+        raise TFTPValueError(f"Invalid tsize: {options['tsize']}")
+    if tsize < 0:
+        raise TFTPValueError(f'Invalid tsize: {tsize}')
+    return tsize
+
+def check_compress(compress: str | None, mode: str = DEFAULT_MODE):
+    if compress is None:
+        return
+    if compress not in COMPRESSIONS:
+        raise TFTPValueError(f'Compression {compress} not supported')
+    if mode != DEFAULT_MODE:
+        raise TFTPValueError('Compression is only done in octet mode.')
+
+def negotiated_compress(options: dict[str, str], requested: str | None) -> str | None:
+    """
+    This method returns the compression of the block stream acknowledged
+    by the server in an OACK, or None when it did not acknowledge the
+    option: the transfer then goes plain. The stream is the file
+    compressed whole, while tsize, when known, is still its size.
+    """
+    if 'compress' not in options:
+        return None
+    if options['compress'] != requested:
+        raise TFTPValueError(f"Invalid compress: {options['compress']}. Requested: {requested}")
+    return requested
+
+def negotiated_multicast(options: dict[str, str]) -> tuple[str | None, int | None, bool] | None:
+    """
+    This method returns the multicast group and port and whether we are
+    the master client, from the 'multicast' option of an OACK (RFC 2090),
+    or None when the server did not acknowledge it. The group and port
+    may be left empty in the OACKs that only make us master.
+    """
+    if 'multicast' not in options:
+        return None
+    try:
+        addr, port, master = options['multicast'].split(',')
+        if addr:
+            socket.inet_aton(addr)
+        port = int(port) if port else None
+        if master not in ('0', '1'):
+            raise ValueError
+    except (ValueError, OSError):
+        raise TFTPValueError(f"Invalid multicast: {options['multicast']}")
+    return addr or None, port, master == '1'
+
+def request_options(blksize: int, windowsize: int, tsize: int | None = None,
+                    compress: str | None = None) -> dict[str, int | str]:
+    """
+    This method builds the options of a RRQ/WRQ, leaving out those
+    with the default values of RFC 1350 so that plain requests stay
+    plain. A RRQ asks for the size of the file with a tsize of 0.
+    """
+    options = {}
+    if blksize != MAX_DATA_LEN:
+        options['blksize'] = blksize
+    if windowsize != DEFAULT_WINDOWSIZE:
+        options['windowsize'] = windowsize
+    if tsize is not None:
+        options['tsize'] = tsize
+    if compress is not None:
+        options['compress'] = compress
+    return options
+
+def check_size(size: int, blocks: int, blksize: int, last_len: int,
+               tsize: int | None = None) -> bool:
+    """
+    This method checks the bytes transferred against the count of
+    blocks (never rolled over) and, when known, the announced tsize.
+    """
+    if size != (blocks - 1) * blksize + last_len:
+        return False
+    return tsize is None or size == tsize
+
+def preallocate(file, size: int):
+    """
+    This method reserves the disk space of a file about to be written,
+    so that it is not grown block by block and a full disk is found
+    before the transfer instead of in the middle of it.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return
+        except OSError as e:
+            # Not every filesystem supports it.
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    file.truncate(size)